@@ -15,53 +15,127 @@
 # 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 import logging
+from bisect import bisect_left, insort
 import pyxmpp
 
 from cjc import ui
 from cjc.ui import cmdtable
 from cjc import common
 
+def prefix_range(keys,prefix):
+    """Return the (start,end) range of the items of a sorted list of tuples
+    with the first element starting with `prefix`."""
+    start=bisect_left(keys,(prefix,))
+    end=start
+    while end<len(keys) and keys[end][0].startswith(prefix):
+        end+=1
+    return start,end
+
 class UserCompletion(ui.Completion):
     def __init__(self,app):
         ui.Completion.__init__(self)
         self.app=app
         self.__logger=logging.getLogger("cjc.UserCompletion")
+        # sorted (key,jid,is_name) for roster items, key is the item name
+        # (lowercased unless case sensitive) or the JID if there is no name
+        self.roster_keys=[]
+        self.roster_entries={}
+        self.roster=None
+        self.case_sensitive=None
+        # sorted (jid,JID) for app.user_info keys, kept in sync by the
+        # "user info added" events
+        self.index_user_jids()
+        app.add_event_handler("roster updated",self.ev_roster_updated)
+        app.add_event_handler("user info added",self.ev_user_info_added)
+
+    def roster_entry(self,item):
+        jid=item.jid.as_unicode()
+        name=item.name
+        if name is None:
+            return (jid,jid,False)
+        if not self.case_sensitive:
+            name=name.lower()
+        return (name,jid,True)
+
+    def index_roster(self):
+        self.roster=self.app.roster
+        self.case_sensitive=self.app.settings["case_sensitive"]
+        self.roster_entries={}
+        if self.roster:
+            for item in self.roster.get_items():
+                entry=self.roster_entry(item)
+                self.roster_entries[entry[1]]=entry
+        self.roster_keys=self.roster_entries.values()
+        self.roster_keys.sort()
+
+    def index_roster_item(self,jid):
+        ujid=jid.as_unicode()
+        entry=self.roster_entries.get(ujid)
+        if entry:
+            del self.roster_keys[bisect_left(self.roster_keys,entry)]
+            del self.roster_entries[ujid]
+        try:
+            item=self.roster.get_item_by_jid(jid)
+        except KeyError:
+            return
+        entry=self.roster_entry(item)
+        self.roster_entries[ujid]=entry
+        insort(self.roster_keys,entry)
+
+    def index_user_jids(self):
+        self.user_jids=[(jid.as_unicode(),jid) for jid in self.app.user_info.keys()]
+        self.user_jids.sort()
+
+    def ev_roster_updated(self,event,arg):
+        if (arg is None or self.roster is not self.app.roster
+                or self.case_sensitive!=self.app.settings["case_sensitive"]):
+            self.index_roster()
+        else:
+            self.index_roster_item(arg)
+
+    def ev_user_info_added(self,event,arg):
+        entry=(arg.as_unicode(),arg)
+        i=bisect_left(self.user_jids,entry)
+        if i<len(self.user_jids) and self.user_jids[i][0]==entry[0]:
+            return
+        self.user_jids.insert(i,entry)
+
     def complete(self,word):
         self.__logger.debug("UserCompletion.complete(self,%r)" % (word,))
+        if (self.roster is not self.app.roster
+                or self.case_sensitive!=self.app.settings["case_sensitive"]):
+            self.index_roster()
         matches=[]
-        case_sensitive=self.app.settings["case_sensitive"]
-        if case_sensitive:
+        matched={}
+        if self.case_sensitive:
             mword=word
         else:
             mword=word.lower()
-        if self.app.roster:
-            for ri in self.app.roster.get_items():
-                name=ri.name
-                if not case_sensitive and name:
-                    name=name.lower()
-                if mword==name:
-                    items=self.app.roster.get_items_by_name(name,case_sensitive)
-                    if len(items)>1:
-                        for i in items:
-                            matches.append(i.jid.as_unicode())
-                        continue
-                if name is None:
-                    name=ri.jid.as_unicode()
-                if (name.startswith(mword)
-                        and name not in matches
-                        and ri.jid.as_unicode() not in matches):
-                    matches.append(name)
-        for jid in self.app.user_info.keys():
-            if self.app.roster:
+        start,end=prefix_range(self.roster_keys,mword)
+        same_name=[e[1] for e in self.roster_keys[start:end]
+                                    if e[2] and e[0]==mword]
+        if len(same_name)>1:
+            for jid in same_name:
+                matches.append(jid)
+                matched[jid]=True
+        for name,jid,is_name in self.roster_keys[start:end]:
+            if len(same_name)>1 and is_name and name==mword:
+                continue
+            if not matched.has_key(name) and not matched.has_key(jid):
+                matches.append(name)
+                matched[name]=True
+        start,end=prefix_range(self.user_jids,word)
+        for ujid,jid in self.user_jids[start:end]:
+            if self.roster:
                 try:
-                    name=self.app.roster.get_item_by_jid(jid).name
-                    if name in matches:
+                    name=self.roster.get_item_by_jid(jid).name
+                    if matched.has_key(name):
                         continue
                 except KeyError:
                     pass
-            jid=jid.as_unicode()
-            if jid.startswith(word) and jid not in matches:
-                matches.append(jid)
+            if not matched.has_key(ujid):
+                matches.append(ujid)
+                matched[ujid]=True
         self.__logger.debug("roster completion matches for %r: %r" % (word,matches))
         matches=[[m,1] for m in matches]
         return self.make_result("",word,matches)
@@ -109,18 +183,28 @@ class CommandCompletion(ui.Completion):
         ui.Completion.__init__(self)
         self.app=app
         self.__logger=logging.getLogger("cjc.CommandCompletion")
+        self.alias_names=None
+        self.command_names=None
+        self.names=[]
+    def aliases_changed(self):
+        self.alias_names=None
     def complete(self,word):
+        command_names=cmdtable.get_active_command_names()
+        if self.alias_names is None or command_names is not self.command_names:
+            if self.alias_names is None:
+                self.alias_names=self.app.aliases.keys()
+            self.command_names=command_names
+            names={}
+            for name in self.alias_names+command_names:
+                names[name]=True
+            self.names=names.keys()
+            self.names.sort()
         matches=[]
-        for a in self.app.aliases.keys():
-            if a.startswith(word):
-                matches.append(a)
-        for t in cmdtable.command_tables:
-            if not t.active:
-                continue
-            for cmd in t.get_command_names():
-                if cmd.startswith(word) and cmd not in matches:
-                    matches.append(cmd)
-        matches=[[m,1] for m in matches]
+        for i in range(bisect_left(self.names,word),len(self.names)):
+            name=self.names[i]
+            if not name.startswith(word):
+                break
+            matches.append([name,1])
         return self.make_result("",word,matches)
 
 # vi: sts=4 et sw=4
@@ -0,0 +1,185 @@
+# Console Jabber Client
+# Copyright (C) 2004-2010 Jacek Konieczny
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""Select-based event loop waiting for file descriptors and timers."""
+
+import os
+import time
+import heapq
+import errno
+import select
+import threading
+
+class Timer(object):
+    """A callback scheduled with `EventLoop.add_timer`.
+
+    :Ivariables:
+        - `deadline`: time (as returned by `time.time`) when the timer fires
+        - `callback`: function to call
+        - `args`: arguments for the callback
+        - `cancelled`: `True` when the timer has been cancelled
+    """
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevent the timer from firing."""
+        self.cancelled = True
+
+class EventLoop(object):
+    """Single `select` call waiting for input on registered file
+    descriptors and for the nearest timer deadline.
+
+    Timers may be added and the loop may be woken up from any thread, the
+    loop itself should be run by one thread only.
+
+    :Ivariables:
+        - `_readers`: file descriptor to callback mapping
+        - `_timers`: heap of (deadline, sequence number, `Timer`) tuples
+        - `_seq`: sequence number of the last timer added, keeps timers with
+          equal deadlines in order
+        - `_lock`: lock protecting `_timers`
+        - `_wakeup_pipe`: (read fd, write fd) pair used to interrupt the
+          `select` call
+        - `_wakeup_pending`: `True` when there is a byte waiting in the
+          wakeup pipe
+    """
+    def __init__(self):
+        self._readers = {}
+        self._timers = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._wakeup_pipe = os.pipe()
+        self._wakeup_pending = False
+
+    def add_reader(self, fd, callback):
+        """Call `callback` whenever `fd` is readable."""
+        self._readers[fd] = callback
+        self.wakeup()
+
+    def remove_reader(self, fd):
+        """Stop watching `fd`."""
+        try:
+            del self._readers[fd]
+        except KeyError:
+            pass
+
+    def add_timer(self, delay, callback, *args):
+        """Call `callback(*args)` after `delay` seconds.
+
+        :Return: the new `Timer` object, which may be used to cancel it."""
+        timer = Timer(time.time() + delay, callback, args)
+        self._lock.acquire()
+        try:
+            self._seq += 1
+            heapq.heappush(self._timers, (timer.deadline, self._seq, timer))
+            first = self._timers[0][2] is timer
+        finally:
+            self._lock.release()
+        if first:
+            self.wakeup()
+        return timer
+
+    def wakeup(self):
+        """Interrupt the current (or the next) `loop_iter` wait."""
+        self._lock.acquire()
+        try:
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        finally:
+            self._lock.release()
+        os.write(self._wakeup_pipe[1], "x")
+
+    def _next_timeout(self):
+        """Return number of seconds until the nearest timer deadline or `None`
+        if there are no timers."""
+        self._lock.acquire()
+        try:
+            while self._timers and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            if not self._timers:
+                return None
+            return max(0, self._timers[0][0] - time.time())
+        finally:
+            self._lock.release()
+
+    def _pop_timer(self, now):
+        """Remove and return the first timer due at `now` or return `None`."""
+        self._lock.acquire()
+        try:
+            while self._timers:
+                timer = self._timers[0][2]
+                if timer.cancelled:
+                    heapq.heappop(self._timers)
+                elif timer.deadline <= now:
+                    heapq.heappop(self._timers)
+                    return timer
+                else:
+                    return None
+            return None
+        finally:
+            self._lock.release()
+
+    def run_timers(self):
+        """Call the callbacks of the timers which are due."""
+        now = time.time()
+        while True:
+            timer = self._pop_timer(now)
+            if timer is None:
+                break
+            timer.callback(*timer.args)
+
+    def loop_iter(self, timeout = None):
+        """Wait for input or for the nearest timer (at most `timeout` seconds
+        if given) and dispatch the events.
+
+        After the wait is interrupted by a signal all the readers are called,
+        as there may be input buffered outside of the file descriptors (e.g.
+        a curses KEY_RESIZE after SIGWINCH).
+
+        :Return: `True` if any reader was called."""
+        timer_timeout = self._next_timeout()
+        if timeout is None or (timer_timeout is not None
+                                        and timer_timeout < timeout):
+            timeout = timer_timeout
+        wakeup_fd = self._wakeup_pipe[0]
+        fds = self._readers.keys() + [wakeup_fd]
+        try:
+            ready = select.select(fds, [], [], timeout)[0]
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            ready = self._readers.keys()
+        if wakeup_fd in ready:
+            ready.remove(wakeup_fd)
+            self._lock.acquire()
+            try:
+                os.read(wakeup_fd, 16)
+                self._wakeup_pending = False
+            finally:
+                self._lock.release()
+        for fd in ready:
+            callback = self._readers.get(fd)
+            if callback:
+                callback()
+        self.run_timers()
+        return bool(ready)
+
+# vi: sts=4 et sw=4
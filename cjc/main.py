@@ -46,6 +46,7 @@ from cjc import ui
 from cjc.ui import buffer as ui_buffer
 from cjc.ui import keytable as ui_keytable
 from cjc.ui import cmdtable as ui_cmdtable
+from cjc.ui import text_input as ui_text_input
 from cjc.ui.form_buffer import FormBuffer
 from cjc import version
 from cjc import themes
@@ -53,6 +54,8 @@ from cjc import common
 from cjc import tls
 from cjc import completions
 from cjc import cjc_globals
+from cjc import event_loop
+from cjc.user_info import BareUserInfo
 from cjc.plugins import PluginContainer
 from cjc.plugin import PluginBase, Configurable
 
@@ -84,10 +87,16 @@ global_settings={
     "editor": ("Editor for message composition. Default: $EDITOR or 'vi'", (str, None)),
     "editor_encoding": ("Character encoding for edited messages. Default: locale specific", (str, None)),
     "scrollback": ("Length of the scrollback buffers (default: 500).", int, "set_scrollback"),
+    "max_fps": ("Maximum number of screen updates per second, 0 for no limit (default: 20).", int, "set_max_fps"),
     "ipv6": ("Enable IPv6 support (auto if unset).", (bool, None), "set_ipv6"),
     "dual_stack": ("Allow IPv4 too when IPv6 is enabled.", bool, "set_dual_stack"),
+    "paste_as_message": ("Send multi-line pastes as a single message instead of line by line.", bool, "set_paste_as_message"),
+    "single_thread": ("Handle the network connection in the UI loop instead of a separate thread (experimental, active after restart).", bool),
 }
 
+# interval (in seconds) of the "idle" events
+idle_event_interval=60
+
 global_theme_attrs=(
     ("default", curses.COLOR_WHITE,curses.COLOR_BLACK,curses.A_NORMAL, curses.A_NORMAL),
     ("error", curses.COLOR_RED,curses.COLOR_BLACK,curses.A_BOLD, curses.A_STANDOUT),
@@ -168,10 +177,14 @@ class Application(tls.TLSMixIn,jabber.Client):
             "status_buffer_preference":1,
             "debug":False,
             "scrollback":500,
+            "max_fps":20,
             "ipv6": None,
             "dual_stack": True,
+            "single_thread": False,
+            "paste_as_message": False,
             }
         self.set_scrollback(0, self.settings['scrollback'])
+        self.set_max_fps(0, self.settings['max_fps'])
         self.aliases={}
         self.available_settings=global_settings
         self.base_dir=base_dir
@@ -188,7 +201,13 @@ class Application(tls.TLSMixIn,jabber.Client):
         self.user_info={}
         self.info_handlers={}
         self.exiting=0
-        self.ui_thread=None
+        self.event_loop=event_loop.EventLoop()
+        self.last_active=time.time()
+        self.idle_timer=None
+        self.today=datetime.date.today()
+        self.single_thread=False
+        self.stream_fd=None
+        self.stream_timer=None
         self.stream_thread=None
         self.roster_window=None
         self.status_window=None
@@ -203,7 +222,8 @@ class Application(tls.TLSMixIn,jabber.Client):
         ui.set_default_command_handler(self.unknown_command)
         completions.SettingCompletion(self).register("setting")
         completions.UserCompletion(self).register("user")
-        completions.CommandCompletion(self).register("command")
+        self.command_completion=completions.CommandCompletion(self)
+        self.command_completion.register("command")
 
     def add_event_handler(self,event,handler):
         self.lock.acquire()
@@ -364,6 +384,7 @@ class Application(tls.TLSMixIn,jabber.Client):
     def run(self, screen):
         signal.signal(signal.SIGINT,signal.SIG_IGN)
         cjc_globals.screen = screen
+        screen.event_loop = self.event_loop
         cjc_globals.theme_manager = themes.ThemeManager(self)
         try:
             cjc_globals.theme_manager.load()
@@ -412,26 +433,27 @@ class Application(tls.TLSMixIn,jabber.Client):
             self.__logger.info("PgUp/PgDown to scroll window content")
 
         self.update_status_bars()
-        if self.profile:
-            self.__logger.info("Running UI thread under profiler")
-            self.ui_thread=threading.Thread(None,self.ui_loop_prof,"UI")
-        else:
-            self.ui_thread=threading.Thread(None,self.ui_loop,"UI")
-        self.ui_thread.setDaemon(1)
-        if self.profile:
+        self.single_thread=self.settings.get("single_thread")
+        if self.single_thread:
+            self.__logger.debug("Running in single thread mode")
+        elif self.profile:
             self.__logger.info("Running Stream thread under profiler")
             self.stream_thread=threading.Thread(None,self.stream_loop_prof,"Stream")
         else:
             self.stream_thread=threading.Thread(None,self.stream_loop,"Stream")
-        self.stream_thread.setDaemon(1)
-
-        self.ui_thread.start()
-        self.stream_thread.start()
+        if self.stream_thread:
+            self.stream_thread.setDaemon(1)
+            self.stream_thread.start()
 
         if self.settings["autoconnect"]:
             self.cmd_connect()
-        self.main_loop()
-
+        if self.profile:
+            self.__logger.info("Running UI loop under profiler")
+            self.ui_loop_prof()
+        else:
+            self.ui_loop()
+        self.send_event("exit")
+        cjc_globals.screen.close()
 
         for th in threading.enumerate():
             if th is threading.currentThread():
@@ -489,6 +511,14 @@ class Application(tls.TLSMixIn,jabber.Client):
             self.__logger.info(u"Unencrypted connection to %s established."
                 % (unicode(self.stream.peer),))
 
+    def connect(self,register=False):
+        jabber.Client.connect(self,register)
+        self.state_changed.acquire()
+        try:
+            self.state_changed.notifyAll()
+        finally:
+            self.state_changed.release()
+
     def disconnected(self):
         self.disconnecting=0
         for user,info in self.user_info.items():
@@ -497,6 +527,7 @@ class Application(tls.TLSMixIn,jabber.Client):
             if info.has_key("resources"):
                 del info["resources"]
         self.__logger.warning("Disconnected")
+        self.event_loop.wakeup()
 
     def message_error(self,stanza):
         self.__logger.warning(u"Message error from: "+stanza.get_from().as_unicode())
@@ -867,6 +898,12 @@ class Application(tls.TLSMixIn,jabber.Client):
 
     def set_scrollback(self,oldval,newval):
         ui.TextBuffer.default_length = newval
+
+    def set_max_fps(self,oldval,newval):
+        ui.Screen.max_fps = newval
+
+    def set_paste_as_message(self,oldval,newval):
+        ui_text_input.TextInput.paste_as_message = newval
     
     def set_ipv6(self, oldval, newval):
         if newval:
@@ -928,6 +965,7 @@ class Application(tls.TLSMixIn,jabber.Client):
                 self.__logger.info("There is no such alias")
             return
         self.aliases[name]=value
+        self.command_completion.aliases_changed()
 
     def cmd_unalias(self,args):
         name=args.shift()
@@ -939,6 +977,7 @@ class Application(tls.TLSMixIn,jabber.Client):
         args.finish()
         if self.aliases.has_key(name):
             del self.aliases[name]
+            self.command_completion.aliases_changed()
         else:
             self.__logger.info("There is no such alias")
 
@@ -1250,15 +1289,19 @@ class Application(tls.TLSMixIn,jabber.Client):
                 self.disconnect()
         self.state_changed.acquire()
         self.exiting=time.time()
-        self.state_changed.notify()
+        self.state_changed.notifyAll()
         self.state_changed.release()
+        # wake up the UI loop to check exit_time() again after the timeout
+        self.event_loop.add_timer(self.settings["disconnect_timeout"],
+                self.event_loop.wakeup)
+        self.event_loop.wakeup()
 
     def exit_time(self):
         if not self.exiting:
             return 0
         if not self.stream:
             return 1
-        if self.exiting>time.time()+self.settings["disconnect_timeout"]:
+        if time.time()>=self.exiting+self.settings["disconnect_timeout"]:
             return 1
         return 0
 
@@ -1270,40 +1313,65 @@ class Application(tls.TLSMixIn,jabber.Client):
         p.dump_stats("cjc-ui.prof")
 
     def ui_loop(self):
-        self.__logger.debug("UI thread started")
-        last_time=datetime.datetime.now()
-        last_active=last_time
-        idle=0
-        second=datetime.timedelta(seconds=1)
-        dt_now=datetime.datetime.now
+        self.__logger.debug("UI loop started")
+        self.event_loop.add_reader(sys.stdin.fileno(),self.input_ready)
+        self.schedule_day_change()
+        self.user_active()
         while not self.exit_time():
             try:
-                act=ui.keypressed()
+                if self.single_thread:
+                    self.watch_stream()
+                self.event_loop.loop_iter()
             except (KeyboardInterrupt,SystemExit),e:
                 self.exit_request(str(e))
                 self.__logger.exception("Exception:")
-                act=1
             except common.non_errors:
                 raise
             except:
                 self.__logger.exception("Exception:")
-                act=0
-            now=dt_now()
-            if now.day!=last_time.day:
-                self.send_event("day changed")
-            dif=now-last_active
-            if act:
-                if dif>=second:
-                    self.send_event("keypressed")
-                idle=0
-                last_active=now
-            else:
-                if dif>datetime.timedelta(seconds=idle):
-                    idle=dif.seconds+24L*60*60*dif.days
-                    self.send_event("idle",idle)
-            last_time=now
         self.__logger.debug("UI loop exiting")
 
+    def input_ready(self):
+        act=0
+        try:
+            while ui.keypressed():
+                act=1
+        finally:
+            if act:
+                self.user_active()
+
+    def user_active(self):
+        now=time.time()
+        if now-self.last_active>=1:
+            self.send_event("keypressed")
+        self.last_active=now
+        if self.idle_timer:
+            self.idle_timer.cancel()
+        self.idle_timer=self.event_loop.add_timer(idle_event_interval,
+                self.idle_timeout)
+
+    def idle_timeout(self):
+        idle=int(time.time()-self.last_active)
+        self.idle_timer=self.event_loop.add_timer(idle_event_interval,
+                self.idle_timeout)
+        self.send_event("idle",idle)
+
+    def schedule_day_change(self):
+        now=datetime.datetime.now()
+        midnight=datetime.datetime.combine(now.date()+datetime.timedelta(1),
+                datetime.time())
+        delay=midnight-now
+        delay=delay.days*86400+delay.seconds+delay.microseconds/1000000.0
+        # check at least every hour, so clock changes are not missed
+        self.event_loop.add_timer(min(delay+0.1,3600),self.check_day_change)
+
+    def check_day_change(self):
+        self.schedule_day_change()
+        today=datetime.date.today()
+        if today!=self.today:
+            self.today=today
+            self.send_event("day changed")
+
     def stream_loop_prof(self):
         import profile
         p=profile.Profile()
@@ -1316,57 +1384,94 @@ class Application(tls.TLSMixIn,jabber.Client):
         while not self.exit_time():
             self.state_changed.acquire()
             stream=self.stream
-            if not stream:
-                self.state_changed.wait(1)
+            if not stream and not self.exiting:
+                self.state_changed.wait()
                 stream=self.stream
             self.state_changed.release()
             if not stream:
                 continue
-            try:
-                act = self.stream.loop_iter(1)
-                if not act:
-                    self.stream.idle()
-            except (pyxmpp.FatalStreamError,pyxmpp.StreamEncryptionRequired),e:
-                self.state_changed.acquire()
-                try:
-                    self.__logger.error(unicode(e))
-                    if isinstance(e, pyxmpp.exceptions.TLSError):
-                        self.__logger.error(
-                                u"You may try disabling encryption" 
-                                    "(/set tls_enable false) or certificate"
-                                    " verification (/set tls_verify false) ")
-                    try:
-                        self.stream.close()
-                    except:
-                        pass
-                    self.stream=None
-                    self.state_changed.notify()
-                finally:
-                    self.state_changed.release()
-            except pyxmpp.StreamError,e:
-                self.__logger.error(str(e))
-                self.disconnecting = 1
-                self.disconnect()
-            except (KeyboardInterrupt,SystemExit),e:
-                self.exit_request(unicode(str(e)))
-                self.__logger.exception("Exception:")
-            except common.non_errors:
-                raise
-            except:
-                self.__logger.error("Other error cought")
-                self.__logger.exception("Exception:")
+            self.stream_iter(1)
         self.__logger.debug("Stream loop exiting")
 
-    def main_loop(self):
-        while not self.exit_time():
+    def watch_stream(self):
+        stream=self.stream
+        if stream and stream.socket:
+            fd=stream.socket.fileno()
+        else:
+            fd=None
+        if fd==self.stream_fd:
+            return
+        if self.stream_fd is not None:
+            self.event_loop.remove_reader(self.stream_fd)
+        if self.stream_timer:
+            self.stream_timer.cancel()
+            self.stream_timer=None
+        self.stream_fd=fd
+        if fd is not None:
+            self.event_loop.add_reader(fd,self.stream_ready)
+            self.stream_timer=self.event_loop.add_timer(1,self.stream_idle)
+
+    def stream_ready(self):
+        if self.stream:
+            self.stream_iter(0)
+        # select() does not see data already decrypted and buffered by the
+        # TLS layer, read it before waiting again
+        while self.stream and self.stream_pending():
+            self.stream_iter(0,True)
+
+    def stream_pending(self):
+        socket=self.stream.socket
+        pending=getattr(socket,"pending",None)
+        if pending is None:
+            return 0
+        try:
+            return pending()
+        except Exception:
+            return 0
+
+    def stream_idle(self):
+        self.stream_timer=self.event_loop.add_timer(1,self.stream_idle)
+        if self.stream:
+            self.stream_iter(0)
+
+    def stream_iter(self,timeout,pending=False):
+        try:
+            if pending:
+                self.stream.process()
+                return
+            act = self.stream.loop_iter(timeout)
+            if not act:
+                self.stream.idle()
+        except (pyxmpp.FatalStreamError,pyxmpp.StreamEncryptionRequired),e:
+            self.state_changed.acquire()
             try:
-                self.state_changed.acquire()
-                self.state_changed.wait(1)
+                self.__logger.error(unicode(e))
+                if isinstance(e, pyxmpp.exceptions.TLSError):
+                    self.__logger.error(
+                            u"You may try disabling encryption" 
+                                "(/set tls_enable false) or certificate"
+                                " verification (/set tls_verify false) ")
+                try:
+                    self.stream.close()
+                except:
+                    pass
+                self.stream=None
+                self.state_changed.notify()
+            finally:
                 self.state_changed.release()
-            except (KeyboardInterrupt,SystemExit),e:
-                self.exit_request(unicode(str(e)))
-                self.__logger.exception("Exception:")
-        self.__logger.debug("Main loop exiting")
+            self.event_loop.wakeup()
+        except pyxmpp.StreamError,e:
+            self.__logger.error(str(e))
+            self.disconnecting = 1
+            self.disconnect()
+        except (KeyboardInterrupt,SystemExit),e:
+            self.exit_request(unicode(str(e)))
+            self.__logger.exception("Exception:")
+        except common.non_errors:
+            raise
+        except:
+            self.__logger.error("Other error cought")
+            self.__logger.exception("Exception:")
 
     def get_users(self,name):
         if "@" in name:
@@ -1436,50 +1541,43 @@ class Application(tls.TLSMixIn,jabber.Client):
     def get_bare_user_info(self,jid,var=None):
         if jid.resource:
             jid=jid.bare()
-        if not self.user_info.has_key(jid):
+        uinf=self.user_info.get(jid)
+        if uinf is None:
             return None
         if var is None:
-            return self.user_info[jid]
-        return self.user_info[jid].get(var)
+            return uinf
+        return uinf.get(var)
 
     def get_user_info(self,jid,var=None):
-        uinf=self.get_bare_user_info(jid)
+        if jid.resource:
+            uinf=self.user_info.get(jid.bare())
+        else:
+            uinf=self.user_info.get(jid)
         if uinf is None:
             return None
-        uinf=uinf.copy()
-        if uinf.has_key("resources") and uinf["resources"].has_key(jid.resource):
-            uinf.update(uinf["resources"][jid.resource])
         if var is None:
-            return uinf
-        return uinf.get(var)
+            return uinf.merged(jid.resource)
+        return uinf.lookup(jid.resource,var)
 
     def set_user_info(self, jid, var, val):
         self.__logger.debug("set_user_info(%r,%r,%r)" % (jid, var, val))
         if not jid.resource:
             return self.set_bare_user_info(jid, var, val)
         bare = jid.bare()
-        if self.user_info.has_key(bare):
-            uinf = self.user_info[bare]
-            if not uinf.has_key("resources"):
-                uinf["resources"] = {}
-        else:
-            uinf = {"resources": {}, "jid": bare}
+        uinf = self.user_info.get(bare)
+        if uinf is None:
+            uinf = BareUserInfo(bare)
             self.user_info[bare] = uinf
-
-        if uinf["resources"].has_key(jid.resource):
-            fuinf = uinf["resources"][jid.resource]
-        else:
-            fuinf = {"jid":jid}
-            uinf["resources"][jid.resource] = fuinf
-        fuinf[var] = val
+            self.send_event("user info added", bare)
+        uinf.get_resource_info(jid, True)[var] = val
 
     def set_bare_user_info(self,jid,var,val):
         bare=jid.bare()
-        if self.user_info.has_key(bare):
-            uinf=self.user_info[bare]
-        else:
-            uinf={"jid":bare}
+        uinf=self.user_info.get(bare)
+        if uinf is None:
+            uinf=BareUserInfo(bare)
             self.user_info[bare]=uinf
+            self.send_event("user info added",bare)
         uinf[var]=val
 
     def roster_updated(self,jid=None):
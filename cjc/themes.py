@@ -35,6 +35,22 @@ formatted_re=re.compile(r"(?<!\%)\%\{([^}]*)\}",re.UNICODE)
 case_re=re.compile(r"(?<!\\)\:",re.UNICODE)
 param_re=re.compile(r"(?<!\\)\,",re.UNICODE)
 
+conversion_flags="#0- +"
+conversion_types="diouxXeEfFgGcrs"
+
+# compiled template node types
+NODE_TEXT=0
+NODE_PARAM=1
+NODE_TYPED=2
+NODE_COND=3
+NODE_POSITIONAL=4
+NODE_ERROR=5
+NODE_ATTR=6
+NODE_INCLUDE=7
+
+# maximum number of ad-hoc (not named) formats kept compiled
+cache_size=256
+
 attributes_by_name={}
 colors_by_val={}
 colors_by_name={}
@@ -81,11 +97,55 @@ def color2name(color):
         return "default"
     return colors_by_val[color]
 
+def parse_conversion(text,start):
+    """Parse a '%' conversion specifier starting at `start`.
+
+    Return (end, key, spec) tuple, where `key` is the mapping key (`None` if
+    none given) and `spec` the rest of the specifier without the '%' sign.
+    Raise `ValueError` on invalid specifier."""
+    length=len(text)
+    i=start+1
+    if i<length and text[i]==u"%":
+        return i+1,None,u"%"
+    key=None
+    if i<length and text[i]==u"(":
+        depth=1
+        i+=1
+        while depth:
+            if i>=length:
+                raise ValueError,"incomplete format key"
+            if text[i]==u"(":
+                depth+=1
+            elif text[i]==u")":
+                depth-=1
+            i+=1
+        key=text[start+2:i-1]
+    spec_start=i
+    while i<length and text[i] in conversion_flags:
+        i+=1
+    while i<length and (text[i].isdigit() or text[i]==u"*"):
+        i+=1
+    if i<length and text[i]==u".":
+        i+=1
+        while i<length and text[i].isdigit():
+            i+=1
+    while i<length and text[i] in "hlL":
+        i+=1
+    if i>=length:
+        raise ValueError,"incomplete format"
+    if text[i] not in conversion_types:
+        raise ValueError,("unsupported format character %r (0x%x) at index %i"
+                % (text[i],ord(text[i]),i))
+    return i+1,key,text[spec_start:i+1]
+
 class ThemeManager:
     def __init__(self,app):
         self.attrs={}
         self.attr_defs={}
         self.formats={}
+        self.templates={}
+        self.format_cache={}
+        self.text_cache={}
         self.pairs={}
         self.next_pair=1
         self.app=app
@@ -236,15 +296,16 @@ class ThemeManager:
 
     def set_format(self,name,format):
         self.formats[name]=format
+        self.templates[name]=self.compile_format(format)
 
     def set_default_format(self,name,format):
         if not self.formats.has_key(name):
-            self.formats[name]=format
+            self.set_format(name,format)
 
     def set_default_formats(self,formats):
         for name,format in formats:
             if not self.formats.has_key(name):
-                self.formats[name]=format
+                self.set_format(name,format)
 
     def format_buffers(self,attr,params):
         ret=[]
@@ -266,104 +327,263 @@ class ThemeManager:
                 format="buffer_active3"
             else:
                 format="buffer_inactive"
-            format=self.formats.get(format)
-            if not format:
+            if not self.formats.get(format):
                 continue
-            f_buf=self.do_format_string(format,attr,p)
+            f_buf=self.evaluate_format(self.templates[format],attr,p)
             if ret:
                 ret.append((self.attrs.get(attr,self.attrs["default"]),","))
             ret+=f_buf
         return ret
 
     def format_string(self,fname,params):
-        format=self.formats[fname]
-        return self.do_format_string(format,"default",params)
+        template=self.templates[fname]
+        if type(params) in (UnicodeType,StringType):
+            params={u"msg":params}
+        else:
+            params=params.copy()
+        return self.evaluate_format(template,"default",params)
 
     def do_format_string(self,format,attr,params):
         if type(params) in (UnicodeType,StringType):
             params={u"msg":params}
         else:
             params=params.copy()
-        l=attr_sel_re.split(format,1)
-        if len(l)==3:
-            format=l[0]
-            next_attr=l[1]
-            if "%" in next_attr:
-                next_attr=self.substitute(next_attr,params)
-            next=l[2]
-        else:
-            next=None
-
-        l=formatted_re.split(format,1)
-        if len(l)==3:
-            before,name,after=l
-            if name.startswith(u"@"):
-                val=name[1:]
-            elif params.has_key(name):
-                val=params[name]
+        template=self.format_cache.get(format)
+        if template is None:
+            if len(self.format_cache)>=cache_size:
+                self.format_cache.clear()
+            template=self.compile_format(format)
+            self.format_cache[format]=template
+        return self.evaluate_format(template,attr,params)
+
+    def substitute(self,format,params):
+        nodes=self.text_cache.get(format)
+        if nodes is None:
+            if len(self.text_cache)>=cache_size:
+                self.text_cache.clear()
+            nodes=self.compile_text(format)
+            self.text_cache[format]=nodes
+        return self.evaluate_text(nodes,params)
+
+    def compile_format(self,format):
+        """Compile a format string into a list of template nodes.
+
+        The string is split on attribute selectors (``%[attr]``) and
+        sub-format references (``%{name}``) and the remaining text is compiled
+        with `compile_text`."""
+        template=[]
+        pieces=attr_sel_re.split(format)
+        for i in range(0,len(pieces)):
+            piece=pieces[i]
+            if i%2:
+                if "%" in piece:
+                    template.append((NODE_ATTR,None,self.compile_text(piece)))
+                else:
+                    template.append((NODE_ATTR,piece,None))
+                continue
+            parts=formatted_re.split(piece)
+            for j in range(0,len(parts)):
+                part=parts[j]
+                if j%2:
+                    if part.startswith(u"@"):
+                        template.append((NODE_INCLUDE,part,part[1:]))
+                    else:
+                        template.append((NODE_INCLUDE,part,None))
+                elif part:
+                    template+=self.compile_text(part)
+        return template
+
+    def compile_text(self,text):
+        """Compile a '%'-style format string (with the CJC extensions for
+        typed and conditional parameters) into a list of text nodes."""
+        nodes=[]
+        literal=[]
+        i=0
+        length=len(text)
+        while i<length:
+            j=text.find(u"%",i)
+            if j<0:
+                literal.append(text[i:])
+                break
+            if j>i:
+                literal.append(text[i:j])
+            try:
+                i,key,spec=parse_conversion(text,j)
+            except ValueError,e:
+                return [(NODE_ERROR,unicode(e),None,text,None)]
+            if spec==u"%":
+                literal.append(u"%")
+                continue
+            if literal:
+                nodes.append((NODE_TEXT,"".join(literal)))
+                literal=[]
+            nodes.append(self.compile_conversion(key,u"%"+spec,text[j:i]))
+        if literal:
+            nodes.append((NODE_TEXT,"".join(literal)))
+        return nodes
+
+    def compile_conversion(self,key,fmt,raw):
+        if key is None:
+            return (NODE_POSITIONAL,None,fmt,raw,None)
+        if u"?" in key:
+            val,expr=key.split(u"?",1)
+            if u":" in val:
+                source=self.compile_conversion(val,u"%s",None)
             else:
-                val=self.find_format_param(name,params)
-            if val is not None:
-                ret=[]
-                if before:
-                    ret+=self.do_format_string(before,attr,params)
-                if callable(val):
-                    ret+=val(attr,params)
-                elif type(val) is ListType:
-                    ret+=val
-                elif self.formats.has_key(val):
-                    f=self.formats[val]
-                    ret+=self.do_format_string(f,attr,params)
+                source=None
+            options=param_re.split(expr)
+            if not case_re.search(options[0]):
+                # yes/no choice
+                yes=self.compile_text(options[0].replace("\\:",":"))
+                if len(options)>1:
+                    no=self.compile_text(options[1].replace("\\:",":"))
                 else:
-                    format=u"%s%%%%{%s}%s" % (before,name,after)
-                    ret+=self.do_format_string(format,attr,params)
-                    before=None
-                    after=None
-                if after:
-                    ret+=self.do_format_string(after,attr,params)
-                if next:
-                    ret+=self.do_format_string(next,next_attr,params)
-                return ret
+                    no=None
+                choice=(yes,None,no)
+            else:
+                # case-like choice
+                cases=[]
+                default=None
+                for opt in options:
+                    if not case_re.search(opt):
+                        default=self.compile_text(opt.replace("\\:",":"))
+                        break
+                    test,val1=case_re.split(opt,1)
+                    cases.append((test.replace("\\:",":"),
+                            self.compile_text(val1.replace("\\:",":"))))
+                choice=(None,cases,default)
+            return (NODE_COND,key,fmt,raw,(val,source,choice))
+        elif u":" in key:
+            sp=key.split(u":",2)
+            if len(sp)==2:
+                typ,param=sp
+                form=None
             else:
-                format=u"%s%%%%{%s}%s" % (before,name,after)
-                return self.do_format_string(format,attr,params)
+                typ,param,form=sp
+            if typ in (u"T",u"J"):
+                return (NODE_TYPED,key,fmt,raw,(typ,param,form))
+        return (NODE_PARAM,key,fmt,raw,None)
 
-        s=self.substitute(format,params)
+    def evaluate_format(self,template,attr,params):
+        ret=[]
+        text=[]
+        for node in template:
+            kind=node[0]
+            if kind==NODE_TEXT:
+                text.append(node[1])
+                continue
+            elif kind==NODE_ATTR:
+                self.flush_text(ret,text,attr)
+                if node[2] is None:
+                    attr=node[1]
+                else:
+                    attr=self.evaluate_text(node[2],params)
+                continue
+            elif kind!=NODE_INCLUDE:
+                text.append(self.evaluate_node(node,params))
+                continue
+            name,val=node[1:]
+            if val is None:
+                if params.has_key(name):
+                    val=params[name]
+                else:
+                    val=self.find_format_param(name,params)
+            if callable(val):
+                self.flush_text(ret,text,attr)
+                ret+=val(attr,params)
+            elif type(val) is ListType:
+                self.flush_text(ret,text,attr)
+                ret+=val
+            elif val is not None and self.templates.has_key(val):
+                self.flush_text(ret,text,attr)
+                ret+=self.evaluate_format(self.templates[val],attr,params)
+            else:
+                text.append(u"%%{%s}" % (name,))
+        self.flush_text(ret,text,attr)
+        return ret
 
+    def flush_text(self,ret,text,attr):
+        if not text:
+            return
+        s="".join(text)
+        del text[:]
+        if not s:
+            return
         if self.attrs.has_key(attr):
-            attr=self.attrs[attr]
+            ret.append((self.attrs[attr],s))
         else:
-            attr=self.attrs["default"]
+            ret.append((self.attrs["default"],s))
 
+    def evaluate_text(self,nodes,params):
         ret=[]
-        if s:
-            ret.append((attr,s))
-        if next:
-            ret+=self.do_format_string(next,next_attr,params)
-        return ret
-
-    def substitute(self,format,params):
-        while 1:
-            try:
-                s=format % params
-                break
-            except (ValueError,TypeError),e:
-                s=u"[%s: %r, %r]" % (unicode(e),format,params)
+        for node in nodes:
+            if node[0]==NODE_TEXT:
+                ret.append(node[1])
+            else:
+                ret.append(self.evaluate_node(node,params))
+        return "".join(ret)
+
+    def evaluate_node(self,node,params):
+        kind,key,fmt,raw,data=node
+        if kind==NODE_ERROR:
+            return u"[%s: %r, %r]" % (key,raw,params)
+        if kind==NODE_POSITIONAL:
+            val=params
+        elif params.has_key(key):
+            val=params[key]
+        elif kind==NODE_PARAM:
+            val=self.find_format_param(key,params)
+            if not val:
+                return raw
+        elif kind==NODE_TYPED:
+            typ,param,form=data
+            if params.has_key(param):
+                val=params[param]
+            else:
+                val=self.find_format_param(param,params)
+                if val is None:
+                    return raw
+            val=self.format_typed_param(typ,form,val)
+            params[key]=val
+        else:
+            val=self.evaluate_condition(data,params)
+            if val is None:
+                return raw
+            params[key]=val
+        if fmt==u"%s" and type(val) is UnicodeType:
+            return val
+        try:
+            return fmt % (val,)
+        except (ValueError,TypeError),e:
+            return u"[%s: %r, %r]" % (unicode(e),raw,params)
+
+    def evaluate_condition(self,data,params):
+        val,source,choice=data
+        if params.has_key(val):
+            value=params[val]
+        elif source is not None:
+            if self.evaluate_node(source,params) is None:
+                return None
+            value=params[val]
+        else:
+            return None
+        yes,cases,default=choice
+        if cases is None:
+            # yes/no choice
+            if value:
+                return self.evaluate_text(yes,params)
+            elif default is not None:
+                return self.evaluate_text(default,params)
+            return u""
+        # case-like choice
+        nodes=default
+        for test,case_nodes in cases:
+            if value==test:
+                nodes=case_nodes
                 break
-            except KeyError,key:
-                key=key.args[0]
-                if "?" in key:
-                    format=self.process_format_cond(format,key,params)
-                elif ":" in key:
-                    format=self.process_format_param(format,key,params)
-                else:
-                    val=self.find_format_param(key,params)
-                    if not val:
-                        format=self.quote_format_param(format,key)
-        return s
-
-    def quote_format_param(self,format,key):
-        return format.replace(u"%%(%s)" % (key,),u"%%%%(%s)" % (key,))
+        if not nodes:
+            return u""
+        return self.evaluate_text(nodes,params)
 
     def find_format_param(self,key,params):
         if key.startswith(u"$"):
@@ -391,55 +611,7 @@ class ThemeManager:
         params[key]=val
         return val
 
-    def process_format_cond(self,format,key,params):
-        sp=key.split(u"?",1)
-        val,expr=sp
-        if not params.has_key(val) and u":" in val:
-            val=self.process_format_param(format,val,params)
-        if not params.has_key(val):
-            return self.quote_format_param(format,key)
-        value=params[val]
-        options=param_re.split(expr)
-        if not case_re.search(options[0]):
-            # yes/no choice
-            if value:
-                params[key]=self.substitute(options[0].replace("\\:",":"),params)
-            else:
-                if len(options)>1:
-                    params[key]=self.substitute(options[1].replace("\\:",":"),params)
-                else:
-                    params[key]=u""
-            return format
-        # case-like choice
-        retval=u""
-        for opt in options:
-            if not case_re.search(opt):
-                retval=opt.replace("\\:",":")
-                break
-            test,val=case_re.split(opt,1)
-            test=test.replace("\\:",":")
-            if value==test:
-                retval=val.replace("\\:",":")
-                break
-        if retval:
-            retval=self.substitute(retval,params)
-        params[key]=retval
-        return format
-
-    def process_format_param(self,format,key,params):
-        sp=key.split(u":",2)
-        if len(sp)==2:
-            typ,param=sp
-            form=None
-        else:
-            typ,param,form=sp
-        if params.has_key(param):
-            val=params[param]
-        else:
-            val=self.find_format_param(param,params)
-            if val is None:
-                return self.quote_format_param(format,key)
-
+    def format_typed_param(self,typ,form,val):
         if typ==u"T":
             if form:
                 form=form.encode(self.encoding,"replace")
@@ -449,66 +621,60 @@ class ThemeManager:
                     formatted=val.strftime("%H:%M")
                 else:
                     formatted=val.strftime("%Y-%m-%d %H:%M")
-            params[key]=unicode(formatted,self.encoding,"replace")
-            return format
-        elif typ==u"J":
-            if not isinstance(val,pyxmpp.JID):
-                try:
-                    val=pyxmpp.JID(val)
-                except pyxmpp.JIDError:
-                    params[key]=u""
-                    return format
-            if form == u"nick":
-                nick =  self.app.get_user_info(val, "nick")
-                if not nick:
-                    nick = self.app.get_user_info(val,"rostername")
-                if nick:
-                    params[key] = nick
+            return unicode(formatted,self.encoding,"replace")
+        if not isinstance(val,pyxmpp.JID):
+            try:
+                val=pyxmpp.JID(val)
+            except pyxmpp.JIDError:
+                return u""
+        if form == u"nick":
+            nick =  self.app.get_user_info(val, "nick")
+            if not nick:
+                nick = self.app.get_user_info(val,"rostername")
+            if nick:
+                return nick
+            else:
+                return val.node
+        elif form==u"node":
+            return val.node
+        elif form==u"domain":
+            return val.domain
+        elif form==u"resource":
+            return val.resource
+        elif form==u"bare":
+            return val.bare().as_unicode()
+        elif form in (u"show",u"status"):
+            pr=self.app.get_user_info(val,"presence")
+            if form==u"show":
+                if pr is None or pr.get_type()=="unavailable":
+                    val=u"offline"
+                elif pr.get_type()=="error":
+                    val=u"error"
                 else:
-                    params[key] = val.node
-            elif form==u"node":
-                params[key]=val.node
-            elif form==u"domain":
-                params[key]=val.domain
-            elif form==u"resource":
-                params[key]=val.resource
-            elif form==u"bare":
-                params[key]=val.bare().as_unicode()
-            elif form in (u"show",u"status"):
-                pr=self.app.get_user_info(val,"presence")
-                if form==u"show":
-                    if pr is None or pr.get_type()=="unavailable":
-                        val=u"offline"
-                    elif pr.get_type()=="error":
-                        val=u"error"
-                    else:
-                        val=pr.get_show()
-                        if not val or val=="":
-                            val=u"online"
-                elif form==u"status":
-                    if pr is None:
+                    val=pr.get_show()
+                    if not val or val=="":
+                        val=u"online"
+            elif form==u"status":
+                if pr is None:
+                    val=""
+                elif pr.get_type()==u"error":
+                    err=pr.get_error()
+                    val=err.get_message()
+                else:
+                    val=pr.get_status()
+                    if val is None:
                         val=""
-                    elif pr.get_type()==u"error":
-                        err=pr.get_error()
-                        val=err.get_message()
-                    else:
-                        val=pr.get_status()
-                        if val is None:
-                            val=""
-                params[key]=val
-            elif form in (u"full",None):
-                params[key]=val.as_unicode()
-            else:
-                ival=self.app.get_user_info(val,form)
-                if not ival:
-                    val=u""
-                elif ival not in (StringType,UnicodeType):
-                    if self.app.info_handlers.has_key(form):
-                        val=self.app.info_handlers[form](form,ival)[1]
-                    else:
-                        val=unicode(ival)
-                params[key]=val
-            return format
+            return val
+        elif form in (u"full",None):
+            return val.as_unicode()
         else:
-            return self.quote_format_param(format,key)
+            ival=self.app.get_user_info(val,form)
+            if not ival:
+                val=u""
+            elif ival not in (StringType,UnicodeType):
+                if self.app.info_handlers.has_key(form):
+                    val=self.app.info_handlers[form](form,ival)[1]
+                else:
+                    val=unicode(ival)
+            return val
 # vi: sts=4 et sw=4
@@ -135,6 +135,9 @@ class Buffer:
     def format(self,width,height):
         pass
 
+    def window_resized(self,width,height):
+        pass
+
     def update(self,now=1):
         window=self.window
         if window:
@@ -58,6 +58,16 @@ class Command:
         self.usage=usage
         self.descr=descr
         self.hints=hints
+        # (hint, option words or None) for each hint
+        if hints:
+            self.parsed_hints=[]
+            for hint in hints:
+                if hint.startswith("-"):
+                    self.parsed_hints.append((hint,hint.split()))
+                else:
+                    self.parsed_hints.append((hint,None))
+        else:
+            self.parsed_hints=None
     def run(self,object,args):
         try:
             return self.handler(object,args)
@@ -123,6 +133,39 @@ class CommandTable:
         install(self)
 
 command_tables=[]
+
+# cache:
+# command name -> (table,command) for all active commands
+active_commands=None
+# sorted names of all active commands
+active_command_names=None
+
+def invalidate_active_commands():
+    global active_commands,active_command_names
+    active_commands=None
+    active_command_names=None
+
+def get_active_commands():
+    global active_commands
+    if active_commands is None:
+        commands={}
+        for t in command_tables:
+            if not t.active:
+                continue
+            for name,command in t.commands.items():
+                if not commands.has_key(name):
+                    commands[name]=(t,command)
+        active_commands=commands
+    return active_commands
+
+def get_active_command_names():
+    global active_command_names
+    if active_command_names is None:
+        names=get_active_commands().keys()
+        names.sort()
+        active_command_names=names
+    return active_command_names
+
 def install(command_table):
     pos=len(command_tables)
     for i in range(0,len(command_tables)):
@@ -130,6 +173,7 @@ def install(command_table):
             pos=i
             break
     command_tables.insert(pos,command_table)
+    invalidate_active_commands()
 
 def uninstall(name):
     try:
@@ -143,6 +187,7 @@ def uninstall(name):
             command_tables.remove(table)
         except ValueError:
             pass
+    invalidate_active_commands()
 
 def lookup_table(name):
     for t in command_tables:
@@ -154,6 +199,7 @@ def activate(name,object):
     table=lookup_table(name)
     table.active=1
     table.object=object
+    invalidate_active_commands()
 
 def deactivate(name,object=None):
     try:
@@ -164,8 +210,14 @@ def deactivate(name,object=None):
         return
     table.active=0
     table.object=None
+    invalidate_active_commands()
 
 def lookup_command(name,active_only=0,with_help_only=0):
+    if active_only and not with_help_only:
+        try:
+            return get_active_commands()[name][1]
+        except KeyError:
+            raise CommandNotFoundError, name
     for ctb in command_tables:
         if active_only and not ctb.active:
             continue
@@ -182,13 +234,12 @@ def run_command(cmd,args=None):
         args=CommandArgs(cmd)
         cmd=args.shift()
     cmd=cmd.lower()
-    for t in command_tables:
-        if not t.active:
-            continue
-        try:
-            return t.run_command(cmd,args)
-        except CommandNotFoundError:
-            continue
+    try:
+        table,command=get_active_commands()[cmd]
+    except KeyError:
+        pass
+    else:
+        return command.run(table.object,args)
     if default_handler:
         return default_handler(cmd,args)
     __logger.error("Unknown command: /"+cmd)
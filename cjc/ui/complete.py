@@ -101,7 +101,8 @@ def complete_command_args(s):
     except KeyError:
         __logger.debug("Command not found: "+`cmd`)
         return None,None,None,0
-    if not cmd.hints:
+    hints=cmd.parsed_hints
+    if not hints:
         __logger.debug("No completion hints for command: "+`cmd`)
         return None,None,None,0
     hi=0
@@ -128,27 +129,27 @@ def complete_command_args(s):
                 option=None
             if arg.startswith("-"):
                 hi1=hi
-                while (hi1<len(cmd.hints) and cmd.hints[hi1].startswith("-")):
-                    hint_sp=cmd.hints[hi1].split()
-                    if hint_sp[0]==arg:
-                        option=hint_sp
+                while hi1<len(hints) and hints[hi1][1]:
+                    if hints[hi1][1][0]==arg:
+                        option=hints[hi1][1]
                         option_arg=0
                         break
+                    hi1+=1
                 if option:
                     __logger.debug("complete: %r is %r"
                             % (arg,option[option_arg]))
                     continue
-            elif hi<len(cmd.hints) and cmd.hints[hi].startswith("-"):
-                while (hi<len(cmd.hints) and cmd.hints[hi].startswith("-")):
+            elif hi<len(hints) and hints[hi][1]:
+                while hi<len(hints) and hints[hi][1]:
                     hi+=1
-            if hi<len(cmd.hints):
-                __logger.debug("complete: %r is %r" % (arg,cmd.hints[hi]))
+            if hi<len(hints):
+                __logger.debug("complete: %r is %r" % (arg,hints[hi][0]))
             hi+=1
     except cmdtable.CommandError:
         if not unfinished_quoted_arg_re.match(args.args):
             __logger.debug("Argument parse error not on open quotes")
             return None,None,None,0
-    if hi>=len(cmd.hints):
+    if hi>=len(hints):
         __logger.debug("More args than hints")
         return None,None,None,0
     if args.args:
@@ -166,25 +167,23 @@ def complete_command_args(s):
         if option_arg<len(option):
             hint=option[option_arg]
         else:
-            hint=cmd.hints[hi]
+            hint=hints[hi][0]
     else:
-        hint=cmd.hints[hi]
+        hint=hints[hi][0]
 
     if hint.startswith("-"):
         if word.startswith("-"):
             options=[]
-            while (hi<len(cmd.hints)
-                and cmd.hints[hi].startswith("-")):
-                options.append(cmd.hints[hi].split()[0])
+            while hi<len(hints) and hints[hi][1]:
+                options.append(hints[hi][1][0])
                 hi+=1
             compl=GenericCompletion(options)
             return head,word,compl,0
         else:
-            while (hi<len(cmd.hints)
-                and cmd.hints[hi].startswith("-")):
+            while hi<len(hints) and hints[hi][1]:
                 hi+=1
-            if hi<len(cmd.hints):
-                hint=cmd.hints[hi]
+            if hi<len(hints):
+                hint=hints[hi][0]
             else:
                 __logger.debug("More args than hints")
                 return None,None,None,0
@@ -114,9 +114,10 @@ class FormBuffer(TextBuffer):
             field = fields_iter.next()
         except StopIteration:
             return self.main_menu()
-        old_content = [list(l) for l in self.lines]
+        old_content = [list(l) for l in self.lines[self._first:]]
         def post_edit_callback():
             self.lines[:] = old_content 
+            self._reset_index()
             self.pos = None
             self.update_pos()
             self.redraw()
@@ -124,7 +124,7 @@ class Input(Widget):
             else:
                 self.prompt_win=None
                 self.input_win=curses.newwin(self.h,self.w,self.y,self.x)
-            self.input_win.timeout(100)
+            self.input_win.nodelay(1)
             if self.input_widget:
                 self.input_widget.set_parent(self)
         finally:
@@ -16,8 +16,11 @@
 
 
 import re
+import sys
 import curses
+import select
 import logging
+import unicodedata
 from types import StringType,UnicodeType
 
 from cjc import common
@@ -115,6 +118,7 @@ class KeyTable:
         self.object=None
         self.active=0
         self.default_handler=None
+        self.paste_handler=None
         self.input_window=None
 
     def __repr__(self):
@@ -215,6 +219,7 @@ class KeyTable:
             fun=binding.fun
         for k in binding.keys:
             self.keytable[k]=(fun,binding.arg)
+        invalidate_dispatch()
 
     def unbind(self,keyname):
         (c,meta)=keyname_to_code(keyname)
@@ -222,6 +227,7 @@ class KeyTable:
             del self.keytable[c,meta]
         except KeyError:
             pass
+        invalidate_dispatch()
 
     def install(self):
         install(self)
@@ -297,9 +303,55 @@ keytables=[]
 # cache:
 active_input_window=None
 default_handler=None
-unhandled_keys={}
-
-is_key_unhandled=unhandled_keys.has_key
+paste_handler=None
+# (code,meta) -> (function,arg,object) for all active bindings,
+# rebuilt on the first keypress after keytables or bindings change
+key_dispatch=None
+
+def invalidate_dispatch():
+    global key_dispatch
+    key_dispatch=None
+
+def get_key_dispatch():
+    global key_dispatch
+    if key_dispatch is None:
+        key_dispatch=build_key_dispatch()
+    return key_dispatch
+
+def build_key_dispatch():
+    """Merge bindings of all active keytables into a single mapping.
+
+    Bindings from higher priority tables win, bindings to functions which
+    are not available at the moment are skipped."""
+    dispatch={}
+    for t in keytables:
+        if not t.active:
+            continue
+        for key,(fun,arg) in t.keytable.items():
+            if dispatch.has_key(key):
+                continue
+            object=None
+            if not isinstance(fun,KeyFunction):
+                try:
+                    fun=t.lookup_function(fun)
+                except FunctionNotFoundError:
+                    try:
+                        fun,object=lookup_function(fun,1)
+                    except FunctionNotFoundError:
+                        continue
+            if object is None:
+                object=t.object
+            dispatch[key]=(fun,arg,object)
+    try:
+        erasechar=curses.erasechar()
+    except curses.error:
+        return dispatch
+    for m in (0,1):
+        # workaround for bad terminfo
+        if (not dispatch.has_key((erasechar,m))
+                and dispatch.has_key((curses.KEY_BACKSPACE,m))):
+            dispatch[erasechar,m]=dispatch[curses.KEY_BACKSPACE,m]
+    return dispatch
 
 def install(keytable):
     pos=len(keytables)
@@ -309,8 +361,7 @@ def install(keytable):
             break
     keytables.insert(pos,keytable)
     find_default_handler()
-    global unhandled_keys
-    unhandled_keys={}
+    invalidate_dispatch()
 
 def lookup_table(name):
     for t in keytables:
@@ -319,11 +370,13 @@ def lookup_table(name):
     raise KeyTableNotFoundError, name
 
 def find_default_handler():
-    global default_handler
+    global default_handler, paste_handler
     default_handler = None
+    paste_handler = None
     for t in keytables:
         if t.active and t.default_handler:
             default_handler=t.default_handler
+            paste_handler=t.paste_handler
             break
 
 def find_active_input_window():
@@ -334,16 +387,17 @@ def find_active_input_window():
             active_input_window=t.input_window
             return
 
-def activate(name,object,default_handler=None,input_window=None):
+def activate(name,object,default_handler=None,input_window=None,
+        paste_handler=None):
     table=lookup_table(name)
     table.active=1
     table.object=object
     table.default_handler=default_handler
+    table.paste_handler=paste_handler
     table.input_window=input_window
     find_active_input_window()
     find_default_handler()
-    global unhandled_keys
-    unhandled_keys={}
+    invalidate_dispatch()
 
 def deactivate(name,object=None):
     table=lookup_table(name)
@@ -352,10 +406,10 @@ def deactivate(name,object=None):
     table.active=0
     table.object=None
     table.default_handler=None
+    table.paste_handler=None
     table.input_window=None
     find_default_handler()
-    global unhandled_keys
-    unhandled_keys={}
+    invalidate_dispatch()
 
 def lookup_function(name,active_only=0):
     for ktb in keytables:
@@ -373,20 +427,12 @@ def process_key(code):
     """Process a key press.
 
     `code` is ncurses key code or a single unicode character."""
-    global default_handler
-    if not is_key_unhandled((code,meta)):
-        for i in (1, 2):
-            for t in [t for t in keytables if t.active]:
-                try:
-                    return t.process_key(code,meta)
-                except (KeyBindingNotFoundError, FunctionNotFoundError):
-                    continue
-            if code == curses.erasechar():
-                # workaround for bad terminfo
-                code = curses.KEY_BACKSPACE
-            else:
-                break
-        unhandled_keys[code,meta]=True
+    try:
+        fun,arg,object=get_key_dispatch()[code,meta]
+    except KeyError:
+        pass
+    else:
+        return fun.invoke(object,arg)
     if default_handler:
         return default_handler(code,meta)
     else:
@@ -407,6 +453,12 @@ def keypressed():
         return 0
     __logger.debug("getch() returned: %r", ch)
     if ch==27:
+        text=read_bracketed_paste()
+        if text is not None:
+            meta=0
+            process_paste(text)
+            cjc_globals.screen.flush_updates()
+            return 1
         if meta:
             meta=0
             try:
@@ -415,6 +467,7 @@ def keypressed():
                 raise
             except:
                 __logger.exception("Exception during keybinding execution")
+            cjc_globals.screen.flush_updates()
             return 1
         else:
             meta=1
@@ -433,15 +486,103 @@ def keypressed():
         else:
             ch = unicode(chr(ch), cjc_globals.screen.encoding, "replace")
     try:
-        __logger.debug("processing key: %r", ch)
-        process_key(ch)
+        if paste_handler and not meta and is_text_key(ch):
+            # process a burst of typed (or pasted) characters as a whole
+            read_burst(ch)
+        else:
+            __logger.debug("processing key: %r", ch)
+            process_key(ch)
     except common.non_errors:
         raise
     except:
         __logger.exception("Exception during keybinding execution")
     meta=0
+    # user is waiting for the effect of the keypress - don't delay it
+    cjc_globals.screen.flush_updates()
     return 1
 
+def is_text_key(ch):
+    """Check if a key is a printable character not bound to any
+    function."""
+    if type(ch) is not unicode or unicodedata.category(ch)[0] == "C":
+        return False
+    return not get_key_dispatch().has_key((ch, 0))
+
+def read_burst(ch):
+    """Read all the printable characters immediately available after `ch`
+    and pass them to the paste handler at once."""
+    chars = [ch]
+    next_key = None
+    while True:
+        ch = active_input_window.getch()
+        if ch == -1:
+            break
+        if ch < 0x20 or ch == 0x7f or ch > 0xff:
+            curses.ungetch(ch)
+            break
+        if ch < 0x80 or not cjc_globals.screen.utf8_mode:
+            ch = unicode(chr(ch), cjc_globals.screen.encoding, "replace")
+        else:
+            try:
+                ch = read_utf8_keypress(ch)
+            except ValueError:
+                cjc_globals.screen.beep()
+                break
+        if not is_text_key(ch):
+            next_key = ch
+            break
+        chars.append(ch)
+    __logger.debug("processing %i typed characters", len(chars))
+    if len(chars) > 1:
+        paste_handler(u"".join(chars))
+    else:
+        process_key(chars[0])
+    if next_key is not None:
+        process_key(next_key)
+
+def read_bracketed_paste():
+    """Check if the escape character just read starts a bracketed paste
+    and read the pasted text if so.
+
+    :Return: the pasted text or `None` if this is not a paste, the input is
+        left intact then."""
+    read = []
+    for c in "[200~":
+        ch = active_input_window.getch()
+        if ch != -1:
+            read.append(ch)
+        if ch != ord(c):
+            read.reverse()
+            for ch in read:
+                curses.ungetch(ch)
+            return None
+    end = [27] + [ord(c) for c in "[201~"]
+    data = []
+    while data[-6:] != end:
+        ch = active_input_window.getch()
+        if ch != -1:
+            data.append(ch)
+        elif not select.select([sys.stdin], [], [], 1)[0]:
+            __logger.debug("Bracketed paste end not received")
+            end = []
+            break
+    if end:
+        data = data[:-6]
+    data = "".join([chr(c) for c in data if c < 0x100])
+    if cjc_globals.screen.utf8_mode:
+        return data.decode("utf-8", "replace")
+    else:
+        return data.decode(cjc_globals.screen.encoding, "replace")
+
+def process_paste(text):
+    """Pass pasted text to the paste handler or process it char by char
+    if there is none."""
+    __logger.debug("processing %i pasted characters", len(text))
+    if paste_handler:
+        return paste_handler(text)
+    for ch in text:
+        process_key(ch)
+
 def read_utf8_keypress(ch):
     """Process a single utf-8 keypress. It should be visible
     as two to six keypresess for each byte of the UTF-8 code."""
@@ -463,8 +604,10 @@ def read_utf8_keypress(ch):
         value = ch & 0x01
         bytes = 6
     for b in range(1, bytes):
-        ch = -1
+        ch = active_input_window.getch()
         while ch == -1:
+            # the rest of the sequence is not there yet
+            select.select([sys.stdin], [], [], 0.1)
             ch = active_input_window.getch()
         __logger.debug("getch() returned: %r", ch)
         if ch > 0xff or (ch & 0xc0) != 0x80:
@@ -18,6 +18,7 @@
 from types import StringType,IntType,UnicodeType
 import curses
 import logging
+import bisect
 
 from cjc import common
 from cjc.ui import keytable
@@ -35,8 +36,20 @@ class ListBuffer(Buffer):
         self.keys=[]
         self.items=[]
         self.pos=0
+        # key -> index mapping; always contains all the keys, but only
+        # the indices lower than index_valid are up to date
+        self.key_index={}
+        self.index_valid=0
+        # keys are kept in order unless append() breaks it
+        self.sorted=1
+        # rows drawn in the window the last time, the window is redrawn
+        # from them only when view_dirty is set
+        self.frame=[]
+        self.view_dirty=0
 
     def set_window(self,win):
+        self.frame=[]
+        self.view_dirty=1
         Buffer.set_window(self,win)
         if win:
             keytable.activate("list-buffer",self)
@@ -47,72 +60,126 @@ class ListBuffer(Buffer):
         return self.keys
 
     def has_key(self,key):
-        return key in self.keys;
+        return key in self.key_index
 
     def index(self,key):
-        return self.keys.index(key)
+        i=self._index(key)
+        if i is None:
+            raise ValueError,"Item not found"
+        return i
+
+    def _index(self,key):
+        i=self.key_index.get(key)
+        if i is None or i<self.index_valid:
+            return i
+        if self.sorted:
+            return bisect.bisect_left(self.keys,key)
+        for j in range(self.index_valid,len(self.keys)):
+            self.key_index[self.keys[j]]=j
+        self.index_valid=len(self.keys)
+        return self.key_index[key]
+
+    def _insert(self,i,key,view):
+        self.keys.insert(i,key)
+        self.items.insert(i,view)
+        self.key_index[key]=i
+        if i<len(self.keys)-1:
+            self.index_valid=min(self.index_valid,i)
+        elif self.index_valid==i:
+            self.index_valid=i+1
 
     def append(self,key,view):
         self.lock.acquire()
         try:
-            if key in self.keys:
+            if key in self.key_index:
                 raise ListBufferError,"Item already exists"
             view=self.clean_item(view)
             i=len(self.keys)
-            self.keys.append(key)
-            self.items.append(view)
+            if i and key<self.keys[-1]:
+                self.sorted=0
+            self._insert(i,key,view)
+            self.activity(1)
+            self.changed(i)
+        finally:
+            self.lock.release()
+
+    def load_items(self,items):
+        """Replace the buffer content with `items` (sequence of (key,view)
+        pairs) sorted by key."""
+        self.lock.acquire()
+        try:
+            items=[(key,self.clean_item(view)) for key,view in items]
+            items.sort(key=lambda x: x[0])
+            keys=[key for key,view in items]
+            key_index=dict([(key,i) for i,key in enumerate(keys)])
+            if len(key_index)!=len(keys):
+                raise ListBufferError,"Item already exists"
+            self.keys=keys
+            self.items=[view for key,view in items]
+            self.key_index=key_index
+            self.index_valid=len(self.keys)
+            self.sorted=1
+            if self.pos>=len(self.keys):
+                self.pos=0
             self.activity(1)
-            self.display(i)
+            self.view_dirty=1
         finally:
             self.lock.release()
 
+    def load_themed_items(self,items):
+        """Replace the buffer content with `items` (sequence of
+        (key,format,params) tuples) sorted by key."""
+        format_string=cjc_globals.theme_manager.format_string
+        self.load_items([(key,format_string(format,params))
+                for key,format,params in items])
+
     def insert_sorted(self,key,view):
         self.lock.acquire()
         try:
-            if key in self.keys:
+            if key in self.key_index:
                 raise ListBufferError,"Item already exists"
             view=self.clean_item(view)
-            last=1
-            for i in range(0,len(self.keys)):
-                if self.keys[i]>key:
-                    self.keys.insert(i,key)
-                    self.items.insert(i,view)
-                    last=0
-                    break
-            if last:
+            if self.sorted:
+                i=bisect.bisect_right(self.keys,key)
+            else:
                 i=len(self.keys)
-                self.keys.append(key)
-                self.items.append(view)
+                for j in range(0,len(self.keys)):
+                    if self.keys[j]>key:
+                        i=j
+                        break
+            self._insert(i,key,view)
             self.activity(1)
-            self.display(i,1)
+            self.changed(i)
         finally:
             self.lock.release()
 
     def update_item(self,key,view):
         self.lock.acquire()
         try:
-            try:
-                i=self.keys.index(key)
-            except ValueError:
+            i=self._index(key)
+            if i is None:
                 raise ListBufferError,"Item not found"
             view=self.clean_item(view)
             self.items[i]=view
             self.activity(1)
-            self.display(i)
+            self.changed(i)
         finally:
             self.lock.release()
 
     def remove_item(self,key):
         self.lock.acquire()
         try:
-            try:
-                i=self.keys.index(key)
-            except ValueError:
+            i=self._index(key)
+            if i is None:
                 raise ListBufferError,"Item not found"
             del self.items[i]
             del self.keys[i]
+            del self.key_index[key]
+            self.index_valid=min(self.index_valid,i)
+            if not self.keys:
+                self.sorted=1
             self.activity(1)
-            self.undisplay(i)
+            self.changed(i)
         finally:
             self.lock.release()
 
@@ -137,8 +204,11 @@ class ListBuffer(Buffer):
         try:
             self.keys=[]
             self.items=[]
-            if self.window:
-                self.window.clear()
+            self.key_index={}
+            self.index_valid=0
+            self.sorted=1
+            self.pos=0
+            self.view_dirty=1
         finally:
             self.lock.release()
 
@@ -150,62 +220,63 @@ class ListBuffer(Buffer):
             self.lock.release()
 
     def _format(self,width,height):
-        ret=[]
-        for i in range(self.pos,min(self.pos+height,len(self.keys))):
-            ret.append(self.items[i])
+        ret=self.items[self.pos:self.pos+height]
+        self.frame=ret
+        self.view_dirty=0
         return ret
 
-    def display(self, i, insert=0):
+    def changed(self,i):
+        """Note that item `i` was changed, inserted or removed. The window
+        needs to be redrawn only when that affects the visible rows."""
+        if self.window and i<self.pos+self.window.ih:
+            self.view_dirty=1
+
+    def update(self,now=1):
+        self.render()
+        Buffer.update(self,now)
+
+    def render(self):
+        """Redraw the rows of the window which changed since the last
+        frame."""
         self.lock.acquire()
         try:
-            if not self.window:
+            if not self.window or not self.view_dirty:
                 return
             cjc_globals.screen.lock.acquire()
             try:
                 if not cjc_globals.screen.active:
                     return
-                if i < self.pos:
-                    return
-                if i >= self.pos+self.window.ih:
-                    return
+                rows=self.items[self.pos:self.pos+self.window.ih]
+                frame=self.frame
                 self.window.win.scrollok(0)
-                self.__logger.debug("Updating item #%i" % (i,))
-                if i >= len(self.items):
-                    self.window.win.move(0, i - self.pos)
-                    self.window.clrtoeol()
-                    return
-                view = self.items[i]
-                attr, s = view[0]
-                self.__logger.debug("Item: %r" % (view,))
-                if insert:
-                    self.window.insert_line(i - self.pos)
-                self.window.write_at(0, i - self.pos, s, attr)
-                for attr, s in view[1:]:
-                    self.window.write(s, attr)
-                y, x = self.window.win.getyx()
-                if y == i - self.pos:
-                    self.window.clrtoeol()
+                try:
+                    for y in range(max(len(rows),len(frame))):
+                        if y<len(rows):
+                            view=rows[y]
+                        else:
+                            view=None
+                        if y<len(frame) and frame[y]==view:
+                            continue
+                        self.draw_row(y,view)
+                finally:
+                    self.window.win.scrollok(1)
+                self.frame=rows
+                self.view_dirty=0
             finally:
                 cjc_globals.screen.lock.release()
-                self.window.win.scrollok(1)
         finally:
             self.lock.release()
 
-    def undisplay(self,i):
-        self.lock.acquire()
-        try:
-            if not self.window:
-                return
-            if i<self.pos:
-                return
-            if i>=self.pos+self.window.ih:
-                return
-            self.__logger.debug("Erasing item #%i" % (i,))
-            self.window.delete_line(i-self.pos)
-            if len(self.items)>=self.pos+self.window.ih:
-                self.display(self,self.pos+self.window.ih-1)
-        finally:
-            self.lock.release()
+    def draw_row(self,y,view):
+        self.window.win.move(y,0)
+        if not view:
+            self.window.clrtoeol()
+            return
+        for attr,s in view:
+            self.window.write(s,attr)
+        cy,cx=self.window.win.getyx()
+        if cy==y:
+            self.window.clrtoeol()
 
     def page_up(self):
         self.lock.acquire()
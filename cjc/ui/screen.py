@@ -15,7 +15,9 @@
 # 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 
+import sys
 import threading
+import time
 import locale
 import curses
 import logging
@@ -27,6 +29,7 @@ from cjc.ui import keytable
 from cjc.ui import complete
 
 class Screen:
+    max_fps=20
     def __init__(self,screen):
         self.__logger=logging.getLogger("cjc.ui.Screen")
         self.scr=screen
@@ -41,6 +44,10 @@ class Screen:
         self.input_handler=None
         self.escape=0
         self.lock=threading.RLock()
+        self.dirty=[]
+        self.last_update=0
+        self.update_timer=None
+        self.event_loop=None
         lc,self.encoding=locale.getlocale()
         if self.encoding is None:
             self.encoding="us-ascii"
@@ -48,6 +55,7 @@ class Screen:
             self.utf8_mode = True
         else:
             self.utf8_mode = False
+        self.set_bracketed_paste(True)
         keytable.activate("screen",self,input_window=self.scr)
         cmdtable.activate("screen",self)
         complete.ActiveBufferDefinedCompletion().register("text")
@@ -78,6 +86,8 @@ class Screen:
         try:
             self.content=widget
             self.windows=[]
+            # the old widgets may be gone, the new ones will be drawn anyway
+            self.dirty=[]
             widget.set_parent(self)
             for b in buffer.buffer_list:
                 if b is None:
@@ -118,6 +128,79 @@ class Screen:
     def redraw(self):
         self.update(1,1)
 
+    def schedule_update(self,widget):
+        self.lock.acquire()
+        try:
+            if not self.active:
+                return
+            if widget not in self.dirty:
+                self.dirty.append(widget)
+            if self.update_timer:
+                return
+            if self.max_fps>0:
+                delay=self.last_update+1.0/self.max_fps-time.time()
+            else:
+                delay=0
+            if delay<=0:
+                self.flush_updates()
+            elif self.event_loop:
+                self.update_timer=self.event_loop.add_timer(delay,
+                                                    self.flush_updates)
+            else:
+                self.update_timer=threading.Timer(delay,self.flush_updates)
+                self.update_timer.setDaemon(1)
+                self.update_timer.start()
+        finally:
+            self.lock.release()
+
+    def is_attached(self,widget):
+        """Check if `widget` is still a part of the current screen
+        layout."""
+        while widget is not None:
+            parent=widget.parent
+            if parent is self:
+                return widget is self.content
+            widget=parent
+        return False
+
+    def flush_updates(self):
+        self.lock.acquire()
+        try:
+            if self.update_timer:
+                self.update_timer.cancel()
+                self.update_timer=None
+            if not self.active or not self.dirty:
+                return
+            dirty=self.dirty
+            self.dirty=[]
+            for widget in dirty:
+                if self.is_attached(widget):
+                    widget.update(0)
+            curses.doupdate()
+            self.cursync()
+            self.last_update=time.time()
+        finally:
+            self.lock.release()
+
+    def set_bracketed_paste(self,enable):
+        if enable:
+            sys.__stdout__.write("\x1b[?2004h")
+        else:
+            sys.__stdout__.write("\x1b[?2004l")
+        sys.__stdout__.flush()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.set_bracketed_paste(False)
+            self.active=False
+            self.dirty=[]
+            if self.update_timer:
+                self.update_timer.cancel()
+                self.update_timer=None
+        finally:
+            self.lock.release()
+
     def _beep(self):
         if not self.active:
             return
@@ -334,6 +417,7 @@ class Screen:
         self.lock.acquire()
         try:
             self.active=False
+            self.set_bracketed_paste(False)
             curses.reset_shell_mode()
         finally:
             self.lock.release()
@@ -342,6 +426,7 @@ class Screen:
         self.lock.acquire()
         try:
             curses.reset_prog_mode()
+            self.set_bracketed_paste(True)
             self.active=True
             self.redraw()
         finally:
@@ -48,6 +48,9 @@ class StatusBar(Widget):
             cjc_globals.screen.lock.release()
 
     def update(self,now=1,redraw=0):
+        if now and not redraw:
+            cjc_globals.screen.schedule_update(self)
+            return
         cjc_globals.screen.lock.acquire()
         try:
             if not cjc_globals.screen.active:
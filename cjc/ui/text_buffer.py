@@ -22,6 +22,7 @@ from __future__ import absolute_import
 
 import collections
 import logging
+from bisect import bisect_left, bisect_right
 
 from .buffer import Buffer
 from . import keytable
@@ -36,23 +37,45 @@ class TextBuffer(Buffer):
 
     `TextBuffer` contains a list of 'lines'. Each line is a list
     of (attribute, string) tuples. 
+
+    When the buffer is full the oldest lines are dropped by advancing
+    `_first` (and replacing the lines with `None`), so it is not needed
+    to copy the whole list for each new line. Dropped lines are removed
+    from the list only when there are at least `length` of them.
+    Buffer positions are indices in `lines`, including the dropped entries.
     
     `TextBuffer` class is responsible for keeping track of the visible part of
     the text and writting it to a `curses` window.
     
     :Ivariables:
-        - `lines`: the buffer content
+        - `lines`: the buffer content. Only `lines[_first:]` are valid.
+        - `_first`: index of the first valid line in `lines`
         - `pos`: current position in the buffer of the window top-left corner.
           `None` means the window will follow the end of the buffer.
         - `_underflow_data`: when in 'fillinig up underflow' mode the
           data to be added at the beginig of `lines`. `None` when not in
           the 'filling up the underflow' mode.
+        - `_line_lengths`: length (in characters) of each line in `lines`
+        - `_row_index`: screen line index for each window width used.
+          Item `i` of each list is the number of screen lines taken by
+          `lines[:i]`. The lists are extended on demand.
+        - `_wrapped`: cache of lines already split into screen lines
+          of `_wrapped_width` characters, by line index
+        - `_wrapped_width`: the screen line width `_wrapped` is valid for
     :Types:
         - `lines`: `list`
+        - `_first`: `int`
         - `pos`: `BufferPosition`
         - `_underflow_data`: `list`
+        - `_line_lengths`: `list` of `int`
+        - `_row_index`: `dict` of `int` -> `list` of `int`
+        - `_wrapped`: `dict` of `int` -> `list` of lists of (attribute,
+          string) tuples
+        - `_wrapped_width`: `int`
     """
     default_length = 200
+    max_row_indexes = 4
+    max_wrapped_lines = 1000
     def __init__(self, info, descr_format = "default_buffer_descr",
                 command_table = None, command_table_object = None,
                                                         length = None):
@@ -80,6 +103,11 @@ class TextBuffer(Buffer):
         else:
             self.length = self.default_length
         self.lines = []
+        self._first = 0
+        self._line_lengths = []
+        self._row_index = {}
+        self._wrapped = {}
+        self._wrapped_width = None
         self.pos = None
         self.update_pos()
         self._underflow_data = None
@@ -92,6 +120,12 @@ class TextBuffer(Buffer):
         else:
             keytable.deactivate("text-buffer", self)
 
+    def window_resized(self, width, height):
+        """Drop the wrapped lines cache when the window size changes."""
+        with self.lock:
+            self._wrapped = {}
+            self._wrapped_width = width
+
     def append(self, text, attr = "default", activity_level = 1):
         """Add some text to the buffer.
         
@@ -107,7 +141,35 @@ class TextBuffer(Buffer):
         with self.lock:
             return self._append(text, attr, activity_level)
 
-    def _append(self, text, attr, activity_level = 1):
+    def append_many(self, items, activity_level = 1):
+        """Add many pieces of text to the buffer at once.
+
+        The buffer is locked only once and the window is redrawn once,
+        after all the text is added.
+        
+        :Parameters:
+            - `items`: (text, attribute) pairs, as would be passed to
+              `self.append`
+            - `activity_level`: 'importance level' of the action
+        :Types:
+            - `items`: iterable of (`unicode`, `str` or `int`) tuples
+            - `activity_level`: `int`
+        """
+        with self.lock:
+            for text, attr in items:
+                self._append(text, attr, activity_level, write = False)
+            self._redraw_appended()
+
+    def _redraw_appended(self):
+        """Update the window after text has been added with `_append`
+        with `write = False`."""
+        if self._underflow_data is not None or not self.window:
+            return
+        if self.pos is None:
+            self.window.draw_buffer()
+        self.window.update()
+
+    def _append(self, text, attr, activity_level = 1, write = True):
         """Add some text to the buffer.
 
         This one, as opposed to `self.append` assummes `self.lock`
@@ -117,20 +179,24 @@ class TextBuffer(Buffer):
             - `text`: the text
             - `attr`: attribute (color) of the string
             - `activity_level`: 'importance level' of the action
+            - `write`: if `False` the text will not be written to the window,
+              even if visible
         :Types:
             - `text`: `unicode`
             - `attr`: `str` or `int`
             - `activity_level`: `int`
+            - `write`: `bool`
 
         """
         if self._underflow_data is not None:
             target = self._underflow_data
             display = False
         else:
-            display = self.window and self.pos is None
+            display = write and self.window and self.pos is None
             target = self.lines
         if attr is not None and not isinstance(attr, int):
             attr = cjc_globals.theme_manager.attrs[attr]
+        first_changed = max(len(target) - 1, 0)
         if not target:
             target[:] = [[]]
         elif display and target[-1] == []:
@@ -161,8 +227,11 @@ class TextBuffer(Buffer):
                                 win_y = self.window.ih - 1
                     else:
                         self.window.write(line, attr)
-        if len(self.lines) > self.length and self.pos is None:
-            self.lines = self.lines[-self.length:]
+        if target is self.lines:
+            self._lines_changed(first_changed)
+        excess = len(self.lines) - self._first - self.length
+        if self.length and excess > 0 and self.pos is None:
+            self._trim(excess)
         if not self.window or self.pos is not None and activity_level:
             self.activity(activity_level)
 
@@ -212,9 +281,31 @@ class TextBuffer(Buffer):
             - `params`: mapping
             - `activity_level`: `int`
         """
-        for attr, text in cjc_globals.theme_manager.format_string(
-                                                            theme_fmt, params):
-            self.append(text, attr, activity_level)
+        formatted = cjc_globals.theme_manager.format_string(theme_fmt, params)
+        with self.lock:
+            for attr, text in formatted:
+                self._append(text, attr, activity_level)
+
+    def append_themed_many(self, items, activity_level = 1):
+        """Add many messages formatted via a CJC theme to the buffer at once.
+
+        The buffer is locked only once and the window is redrawn once,
+        after all the messages are added.
+
+        :Parameters:
+            - `items`: (theme format name, message data) pairs, as would be
+              passed to `self.append_themed`
+            - `activity_level`: 'importance level' of the action
+        :Types:
+            - `items`: iterable of (`str`, mapping) tuples
+            - `activity_level`: `int`
+        """
+        format_string = cjc_globals.theme_manager.format_string
+        with self.lock:
+            for theme_fmt, params in items:
+                for attr, text in format_string(theme_fmt, params):
+                    self._append(text, attr, activity_level, write = False)
+            self._redraw_appended()
 
     def write(self, text):
         """Write a text to the buffer using default attributes.
@@ -235,9 +326,92 @@ class TextBuffer(Buffer):
         with self.lock:
             self.pos = None
             self.lines = [[]]
+            self._reset_index()
             if self.window:
                 self.window.clear()
 
+    def _reset_index(self):
+        """Rebuild the line length cache and drop the screen line index.
+
+        Must be called after `lines` is modified in other ways than via
+        `_append`. The new `lines` must not contain any dropped entries."""
+        self._first = 0
+        self._line_lengths = [self._line_length(line) for line in self.lines]
+        self._row_index = {}
+        self._wrapped = {}
+
+    def _lines_changed(self, index):
+        """Update the line length cache and the screen line index after
+        lines starting at `index` have been changed or appended.
+
+        :Parameters:
+            - `index`: index of the first line changed
+        :Types:
+            - `index`: `int`
+        """
+        lengths = self._line_lengths
+        for i in xrange(index, len(lengths)):
+            self._wrapped.pop(i, None)
+        del lengths[index:]
+        for line in self.lines[index:]:
+            lengths.append(self._line_length(line))
+        for rows in self._row_index.values():
+            del rows[index + 1:]
+
+    def _trim(self, count):
+        """Remove `count` lines from the top of the buffer.
+
+        :Parameters:
+            - `count`: number of lines to remove
+        :Types:
+            - `count`: `int`
+        """
+        first = self._first + count
+        for i in xrange(self._first, first):
+            self.lines[i] = None
+            self._wrapped.pop(i, None)
+        self._first = first
+        if first < self.length:
+            return
+        del self.lines[:first]
+        del self._line_lengths[:first]
+        self._wrapped = {}
+        for width, rows in self._row_index.items():
+            if len(rows) > first:
+                del rows[:first]
+            else:
+                del self._row_index[width]
+        self._first = 0
+
+    def _rows(self, width, end):
+        """Get the screen line index for given window width, valid
+        at least up to line `end`.
+
+        :Parameters:
+            - `width`: window width ('screen line' width)
+            - `end`: the last line index needed
+        :Types:
+            - `width`: `int`
+            - `end`: `int`
+
+        :Returns: list of screen lines taken by `lines[:i]` for each `i`,
+            offset by an arbitrary value
+        :Returntype: `list` of `int`
+        """
+        rows = self._row_index.get(width)
+        if rows is None:
+            if len(self._row_index) >= self.max_row_indexes:
+                self._row_index.clear()
+            rows = [0]
+            self._row_index[width] = rows
+        if len(rows) <= end:
+            lengths = self._line_lengths
+            total = rows[-1]
+            for i in xrange(len(rows) - 1, end):
+                total += lengths[i] // width + 1
+                rows.append(total)
+        return rows
+
     @staticmethod
     def _line_length(line):
         """Compute the length of a buffer line.
@@ -281,35 +455,41 @@ class TextBuffer(Buffer):
         :Returntype: `BufferPosition`
         """
         # FIXME: what about pos.c
-        if not self.lines:
-            return BufferPosition(0, 0)
+        first = self._first
+        if len(self.lines) <= first:
+            return BufferPosition(first, 0)
         if pos is None or pos.l >= len(self.lines):
             if self.lines[-1] == []:
                 pos_l = len(self.lines) - 1
             else:
                 pos_l = len(self.lines)
-            if pos_l <= 0:
-                return 0, 0
+            if pos_l <= first:
+                return BufferPosition(first, 0)
         else:
-            pos_l = pos.l
-        while back > 0 and pos_l > 0:
-            pos_l -= 1
-            line = self.lines[pos_l]
-            line_len = self._line_length(line)
-            line_height = line_len / width + 1
-            back -= line_height
+            pos_l = max(pos.l, first)
+        if back > 0 and pos_l > first:
+            rows = self._rows(width, pos_l)
+            target = rows[pos_l] - back
+            if target < rows[first]:
+                back = rows[first] - target
+                pos_l = first
+            else:
+                start_l = pos_l
+                pos_l = bisect_right(rows, target, first, pos_l + 1) - 1
+                back -= rows[start_l] - rows[pos_l]
         if back > 0:
             if not fill_underflow:
-                return BufferPosition(0, 0)
+                return BufferPosition(first, 0)
             self._underflow_data = []
             try:
                 self.fill_top_underflow(back + 1)
                 if self._underflow_data and self._underflow_data[-1] == []:
                     self._underflow_data = self._underflow_data[:-1]
                 if not self._underflow_data:
-                    return BufferPosition(0, 0)
+                    return BufferPosition(self._first, 0)
                 pos_l = len(self._underflow_data)
-                self.lines = self._underflow_data + self.lines
+                self.lines = self._underflow_data + self.lines[self._first:]
+                self._reset_index()
             finally:
                 self._underflow_data = None
             return self.offset_back(width, back, BufferPosition(pos_l, 0))
@@ -336,16 +516,17 @@ class TextBuffer(Buffer):
         if pos is None:
             return pos
 
+        first = self._first
         if pos.l >= len(self.lines):
             pos_l = len(self.lines) - 1
             if self.lines[-1] == []:
                 pos_l -= 1
-            if pos_l > 0:
+            if pos_l > first:
                 return BufferPosition(pos_l, 0)
             else:
-                return BufferPosition(0, 0)
+                return BufferPosition(first, 0)
         else:
-            pos_l = pos.l
+            pos_l = max(pos.l, first)
 
         if pos.c > 0:
             right = self._split_text(self.lines[pos_l], pos.c)[1]
@@ -357,21 +538,24 @@ class TextBuffer(Buffer):
         if self.lines[-1] == []:
             end -= 1
 
-        pos_l -= 1
-        while forward > 0 and pos_l < end - 1:
-            pos_l += 1
-            line = self.lines[pos_l]
-            line_len = self._line_length(line)
-            line_height = line_len / width + 1
-            forward -= line_height
+        if forward > 0 and pos_l < end:
+            rows = self._rows(width, end)
+            target = rows[pos_l] + forward
+            next_l = bisect_left(rows, target, pos_l + 1, end + 1)
+            if next_l > end:
+                next_l = end
+            forward -= rows[next_l] - rows[pos_l]
+            pos_l = next_l - 1
+        else:
+            pos_l -= 1
 
         if forward >= 0:
             return BufferPosition(pos_l, 0)
 
-        if pos_l > 0:
+        if pos_l > first:
             return BufferPosition(pos_l - 1, 0)
         else:
-            return BufferPosition(0, 0)
+            return BufferPosition(first, 0)
 
     @staticmethod
     def _split_text(text, index):
@@ -403,7 +587,7 @@ class TextBuffer(Buffer):
         for attr, text in line:
             start_index = index
             index += len(text)
-            if index < cut_position:
+            if index <= cut_position:
                 left.append( (attr, text) )
             elif start_index < cut_position and index > cut_position:
                 left.append( (attr, text[:cut_position - index]) )
@@ -412,6 +596,40 @@ class TextBuffer(Buffer):
                 right.append( (attr, text) )
         return left, right
 
+    def _wrap_line(self, index, width):
+        """Split a buffer line into screen lines.
+
+        The result is cached until the line or window width changes.
+
+        :Parameters:
+            - `index`: index of the line in `lines`
+            - `width`: window width ('screen line' width)
+        :Types:
+            - `index`: `int`
+            - `width`: `int`
+
+        :Returns: the screen lines
+        :Returntype: `list` of lists of (attribute, text) tuples
+        """
+        if width != self._wrapped_width:
+            self._wrapped = {}
+            self._wrapped_width = width
+        parts = self._wrapped.get(index)
+        if parts is not None:
+            return parts
+        parts = []
+        line = self.lines[index]
+        while line is not None:
+            if self._line_length(line) > width:
+                part, line = self._cut_line(line, width)
+            else:
+                part, line = line, None
+            parts.append(part)
+        if len(self._wrapped) >= self.max_wrapped_lines:
+            self._wrapped = {}
+        self._wrapped[index] = parts
+        return parts
+
     def format(self, width, height):
         """Return the buffer content starting from the current position
         as a list of (attribute, text) pairs to be displayed in a window
@@ -469,14 +687,8 @@ class TextBuffer(Buffer):
             end -= 1
 
         while height > 0 and pos_l < end:
-            line = self.lines[pos_l]
-            while line is not None and height > 0:
-                line_len = self._line_length(line)
-                if line_len > width:
-                    part, line = self._cut_line(line, width)
-                else:
-                    part, line = line, None
-                if part == [] and height == 1:
+            for part in self._wrap_line(pos_l, width):
+                if height <= 0 or part == [] and height == 1:
                     break
                 ret.append(part)
                 height -= 1
@@ -487,7 +699,8 @@ class TextBuffer(Buffer):
         """Update current position information in the buffer meta-data and
         visible description."""
         if self.pos:
-            self.update_info({"bufrow": self.pos[0], "bufcol": self.pos[1]})
+            self.update_info({"bufrow": self.pos[0] - self._first,
+                                                    "bufcol": self.pos[1]})
         else:
             self.update_info({"bufrow": "", "bufcol":""})
 
@@ -506,7 +719,7 @@ class TextBuffer(Buffer):
             self.pos = self.offset_back(self.window.iw, self.window.ih - 1, pos)
             logger.debug("  after offset back: self.pos = {0!r}"
                                                         .format(self.pos))
-            if self.pos == (0, 0):
+            if self.pos == (self._first, 0):
                 formatted = self._format(self.window.iw, self.window.ih + 1)
                 if len(formatted) < self.window.ih:
                     logger.debug("  formated content is {0} lines high"
@@ -539,7 +752,7 @@ class TextBuffer(Buffer):
         with self.lock:
             ret = u""
             num_lines = len(self.lines)
-            for i in range(0, num_lines):
+            for i in range(self._first, num_lines):
                 for dummy, text in self.lines[i]:
                     ret += text
                 if i < num_lines - 1:
@@ -26,6 +26,7 @@ from cjc.ui import keytable
 from cjc import cjc_globals
 
 class TextInput(InputWidget):
+    paste_as_message=False
     def __init__(self,abortable,required,default=u"",history_len=0, private=False):
         InputWidget.__init__(self,abortable,required)
         self.capture_rest=0
@@ -42,7 +43,8 @@ class TextInput(InputWidget):
     def set_parent(self,parent):
         InputWidget.set_parent(self,parent)
         if parent:
-            keytable.activate("text-input",self,self.keypressed,self.win)
+            keytable.activate("text-input",self,self.keypressed,self.win,
+                    self.paste)
         else:
             keytable.deactivate("text-input",self)
 
@@ -75,6 +77,51 @@ class TextInput(InputWidget):
         else:
             cjc_globals.screen._beep()
 
+    def paste(self,text):
+        cjc_globals.screen.lock.acquire()
+        try:
+            return self._paste(text)
+        finally:
+            cjc_globals.screen.lock.release()
+
+    def _paste(self,text):
+        self.completing=0
+        text=text.replace(u"\r\n",u"\n").replace(u"\r",u"\n")
+        text=text.replace(u"\t",u" ")
+        lines=[]
+        for line in text.split(u"\n"):
+            lines.append(u"".join([c for c in line if self.is_printable(c)]))
+        if len(lines)==1:
+            self.insert_text(lines[0])
+            return
+        if self.paste_as_message:
+            while lines and not lines[-1]:
+                lines.pop()
+            self.content=(self.content[:self.pos]+u"\n".join(lines)
+                                            +self.content[self.pos:])
+            self.key_enter()
+            return
+        for i in range(0,len(lines)-1):
+            self.insert_text(lines[i])
+            self.key_enter()
+            handler=keytable.paste_handler
+            if handler!=self.paste:
+                # the input widget has changed (question answered)
+                if handler:
+                    handler(u"\n".join(lines[i+1:]))
+                return
+        self.insert_text(lines[-1])
+
+    def insert_text(self,s):
+        if not s:
+            return
+        self.content=self.content[:self.pos]+s+self.content[self.pos:]
+        self.pos+=len(s)
+        if self.pos>self.offset+self.w-2:
+            self.scroll_right()
+        else:
+            self.redraw()
+
     def left_scroll_mark(self):
         if self.offset>0:
             cjc_globals.screen.lock.acquire()
@@ -120,6 +120,7 @@ class Window(Widget):
             cjc_globals.screen.lock.release()
         self.status_bar.set_parent(self)
         if self.buffer:
+            self.buffer.window_resized(self.iw,self.ih)
             self.draw_buffer()
 
         if self not in cjc_globals.screen.windows:
@@ -283,6 +284,9 @@ class Window(Widget):
             self.win.addstr(s)
 
     def update(self,now=1,redraw=0):
+        if now and not redraw:
+            cjc_globals.screen.schedule_update(self)
+            return
         self.status_bar.update(now)
         cjc_globals.screen.lock.acquire()
         try:
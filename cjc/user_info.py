@@ -0,0 +1,224 @@
+# Console Jabber Client
+# Copyright (C) 2004-2010 Jacek Konieczny
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""Compact records of the information known about users.
+
+Records behave like the dictionaries used before: variables which were
+never set are missing (`has_key` returns `False`), which is different from
+being set to `None`."""
+
+import heapq
+import itertools
+
+# variables stored in slots, anything else goes to the `extra` dictionary
+slot_fields = ("jid", "presence", "weight", "nick", "rostername")
+_slot_fields = frozenset(slot_fields)
+
+_unset = object()
+
+# orders resources of equal priority, the one available first wins
+_sequence = itertools.count()
+
+class UserInfo(object):
+    """Information about a single JID (bare or full).
+
+    :Ivariables:
+        - `jid`: the JID
+        - `presence`: last presence received
+        - `weight`: weight of the current presence (see
+          `cjc.main.Application.get_best_user`)
+        - `nick`: nickname (e.g. in a MUC room)
+        - `rostername`: name from the roster
+        - `extra`: dictionary of other variables or `None`
+    """
+    __slots__ = ("jid", "presence", "weight", "nick", "rostername", "extra")
+    def __init__(self, jid):
+        self.jid = jid
+        self.extra = None
+
+    def get(self, var, default = None):
+        """Return value of a variable or `default` if it is not set."""
+        if var in _slot_fields:
+            return getattr(self, var, default)
+        if self.extra:
+            return self.extra.get(var, default)
+        return default
+
+    def has_key(self, var):
+        return self.get(var, _unset) is not _unset
+
+    def __getitem__(self, var):
+        value = self.get(var, _unset)
+        if value is _unset:
+            raise KeyError, var
+        return value
+
+    def __setitem__(self, var, value):
+        if var in _slot_fields:
+            setattr(self, var, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[var] = value
+
+    def __delitem__(self, var):
+        if var in _slot_fields:
+            try:
+                delattr(self, var)
+            except AttributeError:
+                raise KeyError, var
+        elif self.extra and var in self.extra:
+            del self.extra[var]
+        else:
+            raise KeyError, var
+
+    def items(self):
+        """Return list of (name, value) pairs of the variables set."""
+        result = []
+        for var in slot_fields:
+            value = getattr(self, var, _unset)
+            if value is not _unset:
+                result.append((var, value))
+        if self.extra:
+            result += self.extra.items()
+        return result
+
+class BareUserInfo(UserInfo):
+    """Information about a bare JID, including its resources.
+
+    :Ivariables:
+        - `resources`: resource name to `UserInfo` mapping or `None`
+        - `_available`: resource name to heap entry mapping for the
+          available resources
+        - `_heap`: heap of (-priority, sequence number, resource name)
+          entries; entries not in `_available` are stale and are dropped
+          lazily
+    """
+    __slots__ = ("resources", "_available", "_heap")
+    def __init__(self, jid):
+        UserInfo.__init__(self, jid)
+        self.resources = None
+        self._available = None
+        self._heap = None
+
+    def get(self, var, default = None):
+        if var == "resources":
+            if self.resources is None:
+                return default
+            return self.resources
+        return UserInfo.get(self, var, default)
+
+    def __setitem__(self, var, value):
+        if var == "resources":
+            self.resources = value
+            self._available = None
+            self._heap = None
+        else:
+            UserInfo.__setitem__(self, var, value)
+
+    def __delitem__(self, var):
+        if var == "resources":
+            if self.resources is None:
+                raise KeyError, var
+            self.resources = None
+            self._available = None
+            self._heap = None
+        else:
+            UserInfo.__delitem__(self, var)
+
+    def items(self):
+        result = UserInfo.items(self)
+        if self.resources is not None:
+            result.append(("resources", self.resources))
+        return result
+
+    def get_resource_info(self, jid, create = False):
+        """Return the record for a full JID.
+
+        :Parameters:
+            - `jid`: the full JID
+            - `create`: if `True` a new record is created when there is none
+        :Return: the `UserInfo` or `None`"""
+        if self.resources is None:
+            if not create:
+                return None
+            self.resources = {}
+        info = self.resources.get(jid.resource)
+        if info is None and create:
+            info = UserInfo(jid)
+            self.resources[jid.resource] = info
+        return info
+
+    def set_resource_priority(self, resource, priority):
+        """Record priority of an available resource.
+
+        :Parameters:
+            - `resource`: the resource name
+            - `priority`: presence priority or `None` if the resource is not
+              available"""
+        if self._available is None:
+            if priority is None:
+                return
+            self._available = {}
+            self._heap = []
+        if priority is None:
+            self._available.pop(resource, None)
+            if not self._available:
+                self._heap = []
+            return
+        old = self._available.get(resource)
+        if old is not None and old[0] == -priority:
+            return
+        entry = (-priority, _sequence.next(), resource)
+        self._available[resource] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._available) + 8:
+            self._heap = self._available.values()
+            heapq.heapify(self._heap)
+
+    def best_resource(self):
+        """Return the available resource with the highest priority.
+
+        :Return: (resource, priority) tuple or `None`"""
+        if not self._available:
+            return None
+        heap = self._heap
+        while self._available.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+        return heap[0][2], -heap[0][0]
+
+    def lookup(self, resource, var, default = None):
+        """Return value of a variable for a resource, falling back to the
+        bare JID value when it is not set for the resource."""
+        if resource and self.resources and var != "resources":
+            info = self.resources.get(resource)
+            if info is not None:
+                value = info.get(var, _unset)
+                if value is not _unset:
+                    return value
+        return self.get(var, default)
+
+    def merged(self, resource):
+        """Return a dictionary with all the variables of the bare JID
+        overridden by those of the resource."""
+        result = dict(self.items())
+        if resource and self.resources:
+            info = self.resources.get(resource)
+            if info is not None:
+                result.update(info.items())
+        return result
+
+# vi: sts=4 et sw=4
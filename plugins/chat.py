@@ -72,6 +72,7 @@ class ChatBuffer(ui.TextBuffer):
         records.reverse()
         self.last_record = records[0][0]
         logger.debug("Got {0} records:".format(len(records)))
+        messages = []
         for record_id, record in records:
             logger.debug("Record {0!r}: {1!r}".format(record_id, record))
             fparams = dict(self.conversation.fparams)
@@ -85,10 +86,11 @@ class ChatBuffer(ui.TextBuffer):
                 fparams["timestamp"] = record.timestamp
             if record.body.startswith(u"/me "):
                 fparams["msg"] = record.body[4:]
-                self.append_themed("chat.action", fparams)
-                return
+                messages.append(("chat.action", fparams))
+                continue
             fparams["msg"] = record.body
-            self.append_themed(theme_fmt, fparams)
+            messages.append((theme_fmt, fparams))
+        self.append_themed_many(messages)
 
 class Conversation:
     def __init__(self,plugin,me,peer,thread=None, start_time = None):
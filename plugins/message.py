@@ -304,6 +304,7 @@ class MessagesBuffer(ui.TextBuffer):
             return
         records.reverse()
         logger.debug("Got {0} records:".format(len(records)))
+        messages = []
         for record_id, record in records:
             logger.debug("Record {0!r}: {1!r}".format(record_id, record))
             fparams = dict()
@@ -318,8 +319,9 @@ class MessagesBuffer(ui.TextBuffer):
             fparams["subject"] = record.subject
             fparams["thread"] = record.thread
             fparams["body"] = record.body
-            self.append_themed(theme_fmt, fparams)
-        self.append_themed("message.archive_end", {})
+            messages.append((theme_fmt, fparams))
+        messages.append(("message.archive_end", {}))
+        self.append_themed_many(messages)
         self.last_record = records[0][0]
 
 
@@ -14,10 +14,13 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import re
 import string
 import curses
 import os
 import logging
+import threading
+from bisect import bisect_left
 
 import pyxmpp
 from pyxmpp.jabber import muc,delay
@@ -61,6 +64,11 @@ theme_formats=(
     ("muc.day_change",u"%{@day_change}"),
 )
 
+# maximum number of room history messages to keep before displaying them
+history_batch_size=100
+# maximum time (in seconds) room history messages wait to be displayed
+history_flush_delay=0.5
+
 class Room(muc.MucRoomHandler):
     def __init__(self,plugin,room,me):
         muc.MucRoomHandler.__init__(self)
@@ -79,6 +87,14 @@ class Room(muc.MucRoomHandler):
         self.buffer.append_themed("muc.joining",self.fparams)
         self.buffer._muc_room = self
         self.buffer.update()
+        self.history=[]
+        self.history_lock=threading.Lock()
+        self.history_timer=None
+        # sorted (lowercased nick, nick) pairs of the room occupants, updated
+        # by user_joined, user_left and nick_changed
+        self.nicks=[]
+        self.mention_nick=None
+        self.mention_re=None
 
     def user_format_params(self,user):
         fparams=dict(self.fparams)
@@ -112,30 +128,96 @@ class Room(muc.MucRoomHandler):
         d=delay.get_delay(stanza)
         if d:
             fparams["timestamp"]=d.get_datetime_local()
+        fr=stanza.get_from()
         if body.startswith(u"/me "):
             fparams["msg"]=body[4:]
-            self.buffer.append_themed("muc.action",fparams)
-            self.buffer.update()
-            return
-        else:
+            format="muc.action"
+        elif user is None:
             fparams["msg"]=body
-        fr=stanza.get_from()
-        if user is None:
-            self.buffer.append_themed("muc.info",fparams)
-            self.buffer.update()
-            return
+            format="muc.info"
         elif fr==self.room_state.room_jid:
+            fparams["msg"]=body
             self.plugin.cjc.send_event("own groupchat message received",body)
             format="muc.me"
-        elif self.room_state.me.nick.lower() in body.lower():
+        elif self.is_mention(body):
+            fparams["msg"]=body
             self.plugin.cjc.send_event("groupchat message to me received",body)
             format="muc.to_me"
         else:
+            fparams["msg"]=body
             self.plugin.cjc.send_event("groupchat message received",body)
             format="muc.other"
+        if d:
+            # room history is displayed in batches, the subject, the first
+            # live message or a short timeout ends the history
+            self.history_lock.acquire()
+            try:
+                self.history.append((format,fparams))
+                full=len(self.history)>=history_batch_size
+                if not full and not self.history_timer:
+                    self.history_timer=self.plugin.cjc.event_loop.add_timer(
+                            history_flush_delay,self.history_timeout)
+            finally:
+                self.history_lock.release()
+            if full:
+                self.flush_history()
+            return
+        self.flush_history()
         self.buffer.append_themed(format,fparams)
         self.buffer.update()
 
+    def is_mention(self,body):
+        nick=self.room_state.me.nick
+        if nick!=self.mention_nick:
+            self.mention_nick=nick
+            self.mention_re=re.compile(re.escape(nick),re.IGNORECASE|re.UNICODE)
+        return self.mention_re.search(body) is not None
+
+    def index_nick(self,nick):
+        entry=(nick.lower(),nick)
+        i=bisect_left(self.nicks,entry)
+        if i>=len(self.nicks) or self.nicks[i]!=entry:
+            self.nicks.insert(i,entry)
+
+    def unindex_nick(self,nick):
+        entry=(nick.lower(),nick)
+        i=bisect_left(self.nicks,entry)
+        if i<len(self.nicks) and self.nicks[i]==entry:
+            del self.nicks[i]
+
+    def complete_nick(self,word):
+        word=word.lower()
+        matches=[]
+        for i in range(bisect_left(self.nicks,(word,)),len(self.nicks)):
+            key,nick=self.nicks[i]
+            if not key.startswith(word):
+                break
+            matches.append(nick)
+        return matches
+
+    def flush_history(self):
+        self.history_lock.acquire()
+        try:
+            history=self.history
+            self.history=[]
+            if self.history_timer:
+                self.history_timer.cancel()
+                self.history_timer=None
+        finally:
+            self.history_lock.release()
+        if history:
+            self.buffer.append_themed_many(history)
+        return bool(history)
+
+    def history_timeout(self):
+        self.history_lock.acquire()
+        try:
+            self.history_timer=None
+        finally:
+            self.history_lock.release()
+        if self.flush_history():
+            self.buffer.update()
+
     def subject_changed(self,user,stanza):
         if user:
             fparams=self.user_format_params(user)
@@ -151,12 +233,14 @@ class Room(muc.MucRoomHandler):
         if d:
             fparams["timestamp"]=d.get_datetime_local()
         self.plugin.cjc.send_event("groupchat subject changed",self.room_state.subject)
+        self.flush_history()
         self.buffer.append_themed("muc.info",fparams)
         self.buffer.update()
         return
 
     def user_joined(self, user, stanza):
         self.plugin.cjc.set_user_info(user.room_jid, "nick", user.nick)
+        self.index_nick(user.nick)
         fparams = self.user_format_params(user)
         d = delay.get_delay(stanza)
         if d:
@@ -176,6 +260,11 @@ class Room(muc.MucRoomHandler):
             if d:
                 fparams["timestamp"]=d.get_datetime_local()
         self.plugin.cjc.send_event("groupchat user left",user.nick)
+        if user.same_as(self.room_state.me):
+            self.nicks=[]
+        else:
+            self.unindex_nick(user.nick)
+        self.flush_history()
         if user.same_as(self.room_state.me):
             self.buffer.append_themed("muc.me_left",fparams)
         else:
@@ -214,6 +303,8 @@ class Room(muc.MucRoomHandler):
     def nick_changed(self,user,old_nick,stanza):
         fparams=self.user_format_params(user)
         fparams["old_nick"]=old_nick
+        self.unindex_nick(old_nick)
+        self.index_nick(user.nick)
         d=delay.get_delay(stanza)
         if d:
             fparams["timestamp"]=d.get_datetime_local()
@@ -351,6 +442,14 @@ class Room(muc.MucRoomHandler):
     def cmd_close(self,args):
         args.finish()
         self.room_state.leave()
+        self.history_lock.acquire()
+        try:
+            self.history=[]
+            if self.history_timer:
+                self.history_timer.cancel()
+                self.history_timer=None
+        finally:
+            self.history_lock.release()
         self.buffer.close()
         return 1
 
@@ -381,10 +480,7 @@ class MucNickCompletion(ui.Completion):
         except AttributeError:
             return "", []
 
-        matches=[]
-        for w in muc_room.room_state.users.keys():
-            if w.startswith(word):
-                matches.append( [w, 1] )
+        matches=[ [nick, 1] for nick in muc_room.complete_nick(word) ]
         return self.make_result("", word,matches)
 
 ui.CommandTable("muc buffer",51,(
@@ -16,6 +16,7 @@
 
 import string
 import time
+import threading
 
 import pyxmpp
 
@@ -26,6 +27,8 @@ from cjc import cjc_globals
 theme_formats=(
     ("presence.available","%[info][%(T:timestamp)s] %(J:user)s (%(J:user:rostername)s) is %(J:user:show)s: %(J:user:status)s\n"),
     ("presence.unavailable","%[info][%(T:timestamp)s] %(J:user)s (%(J:user:rostername)s) is unavailable\n"),
+    ("presence.available_summary","%[info][%(T:timestamp)s] %(count)i contacts came online\n"),
+    ("presence.unavailable_summary","%[info][%(T:timestamp)s] %(count)i contacts went offline\n"),
     ("presence.subscribe","%[info][%(T:timestamp)s] %(J:user)s sent you a presence subscription request\n"),
     ("presence.subscribe_buffer","Subscription request from %(J:user)s"),
     ("presence.subscribe_accepted","%[info][%(T:timestamp)s] You have accepted presence subscription request from %(J:user)s\n"),
@@ -37,6 +40,16 @@ theme_formats=(
 
 show_weight = {"xa": 0, "away": 1, "dnd": 2, None: 3, "chat": 4}
 
+def available_priority(presence):
+    """Return priority of an available presence or `None` for any other
+    presence."""
+    if not presence:
+        return None
+    typ = presence.get_type()
+    if typ and typ != "available":
+        return None
+    return presence.get_priority()
+
 class Plugin(PluginBase):
     def __init__(self,app,name):
         PluginBase.__init__(self,app,name)
@@ -72,6 +85,13 @@ class Plugin(PluginBase):
                     " status description (reason).",bool),
             "no_auto_away_when": ("Modes in which now auto-away or auto-xa"
                     " should happen.",list),
+            "coalesce_time": ("Time (in seconds) for which presence changes"
+                    " are collected before they are displayed. Changes of"
+                    " the same user within that time are shown once"
+                    " (0 to disable).",float),
+            "summary_threshold": ("When more contacts than that come online"
+                    " or go offline at once, only their number is shown.",
+                    int),
             }
         self.settings={
             "priority": 1,
@@ -84,7 +104,9 @@ class Plugin(PluginBase):
             "buffer_preference": 50,
             "auto_popup": False,
             "keep_description": False,
-            "no_auto_away_when": ["away","xa","dnd"]
+            "no_auto_away_when": ["away","xa","dnd"],
+            "coalesce_time": 0.25,
+            "summary_threshold": 5,
             }
         app.add_info_handler("resources",self.info_resources)
         app.add_info_handler("presence",self.info_presence)
@@ -93,6 +115,10 @@ class Plugin(PluginBase):
         app.add_event_handler("idle",self.ev_idle)
         ui.activate_cmdtable("presence",self)
         self.away_saved_presence=None
+        self.pending_lock=threading.Lock()
+        self.pending_jids=[]
+        self.pending_formats={}
+        self.pending_timer=None
 
     def info_weight(self,k,v):
         return "Weight", `v`
@@ -354,7 +380,7 @@ class Plugin(PluginBase):
         self.cjc.stream.send(p)
         if not p.get_to():
             self.cjc.set_user_info(self.cjc.jid,"presence",p)
-            self.compute_current_resource(self.cjc.jid.bare())
+            self.update_current_resource(self.cjc.jid)
             self.cjc.send_event("presence changed",self.cjc.jid)
 
     def presence_error(self,stanza):
@@ -369,75 +395,154 @@ class Plugin(PluginBase):
             msg+=" ('%s')" % etxt
         self.debug(stanza.get_error().serialize())
 
-        if self.cjc.get_user_info(fr) and self.settings.get("show_errors"):
+        if self.cjc.get_bare_user_info(fr) and self.settings.get("show_errors"):
             self.warning(msg)
         else:
             self.debug(msg)
         if fr.resource:
             self.cjc.set_user_info(fr,"presence",stanza.copy())
-            self.compute_current_resource(fr.bare())
+            self.update_current_resource(fr)
         elif not self.cjc.get_bare_user_info(fr,"resources"):
             self.cjc.set_bare_user_info(fr,"presence",stanza.copy())
-        self.cjc.send_event("presence changed",fr)
+        self.queue_change(fr)
         return 1
 
     def presence_available(self,stanza):
         fr=stanza.get_from()
         p=self.cjc.get_user_info(fr, "presence")
         self.cjc.set_user_info(fr, "presence", stanza.copy())
-        self.compute_current_resource(fr.bare())
-        self.cjc.send_event("presence changed", fr)
+        self.update_current_resource(fr)
         if (not p or p!=stanza) and self.settings.get("show_changes"):
-            self.cjc.status_buf.append_themed("presence.available", {"user":fr})
-            self.cjc.status_buf.update()
+            self.queue_change(fr, "presence.available")
         else:
+            self.queue_change(fr)
             self.debug(fr.as_unicode()+u" is unavailable")
         return 1
 
     def presence_unavailable(self,stanza):
         fr=stanza.get_from()
-        if self.cjc.get_user_info(fr) and self.settings.get("show_changes"):
-            self.cjc.status_buf.append_themed("presence.unavailable", {"user":fr})
-            self.cjc.status_buf.update()
+        if self.cjc.get_bare_user_info(fr) and self.settings.get("show_changes"):
+            format="presence.unavailable"
         else:
+            format=None
             self.debug(fr.as_unicode()+u" is unavailable")
         self.cjc.set_user_info(fr,"presence",stanza.copy())
-        self.compute_current_resource(fr.bare())
-        self.cjc.send_event("presence changed",fr)
+        self.update_current_resource(fr)
+        self.queue_change(fr,format)
         return 1
 
+    def queue_change(self,jid,format=None):
+        """Schedule the "presence changed" event and the status line (if
+        `format` is given) for a presence change already stored.
+
+        During `coalesce_time` changes are collected, so a user changing
+        presence many times gets one event and one status line (the last
+        one) and a burst of presences (like the one after login) is
+        summarized.
+
+        With non-zero `coalesce_time` the event is sent by `flush_changes`
+        from the event loop thread, not from the stream thread, so
+        "presence changed" handlers may run concurrently with the stream
+        events (like "roster updated") and must lock any state they share
+        with them."""
+        delay=self.settings.get("coalesce_time")
+        if not delay or delay<=0:
+            self.cjc.send_event("presence changed",jid)
+            if format:
+                self.cjc.status_buf.append_themed(format,{"user":jid})
+                self.cjc.status_buf.update()
+            return
+        self.pending_lock.acquire()
+        try:
+            if not self.pending_formats.has_key(jid):
+                self.pending_jids.append(jid)
+                self.pending_formats[jid]=format
+            elif format:
+                self.pending_formats[jid]=format
+            if not self.pending_timer:
+                self.pending_timer=self.cjc.event_loop.add_timer(delay,
+                        self.flush_changes)
+        finally:
+            self.pending_lock.release()
+
+    def flush_changes(self):
+        """Dispatch the presence changes collected by `queue_change`.
+
+        Called by the event loop timer (in the event loop thread)."""
+        self.pending_lock.acquire()
+        try:
+            jids=self.pending_jids
+            formats=self.pending_formats
+            self.pending_jids=[]
+            self.pending_formats={}
+            self.pending_timer=None
+        finally:
+            self.pending_lock.release()
+        for jid in jids:
+            self.cjc.send_event("presence changed",jid)
+        lines=[(jid,formats[jid]) for jid in jids if formats[jid]]
+        if not lines:
+            return
+        threshold=self.settings.get("summary_threshold")
+        counts={}
+        for jid,format in lines:
+            counts[format]=counts.get(format,0)+1
+        for jid,format in lines:
+            if threshold is None or counts[format]<=threshold:
+                self.cjc.status_buf.append_themed(format,{"user":jid})
+        for format in ("presence.available","presence.unavailable"):
+            count=counts.get(format,0)
+            if threshold is not None and count>threshold:
+                self.cjc.status_buf.append_themed(format+"_summary",
+                        {"count":count})
+        self.cjc.status_buf.update()
+
     def compute_current_resource(self, jid):
-        resources = self.cjc.get_bare_user_info(jid, "resources")
-        if not resources:
-            p = self.cjc.get_bare_user_info(jid, "presence")
-            if p and p.get_type() != "error" and p.get_from().resource:
-                self.cjc.set_bare_user_info(jid, "presence", None)
-            self.cjc.set_bare_user_info(jid, "weight", None)
+        uinf = self.cjc.get_bare_user_info(jid)
+        if uinf is None or not uinf.resources:
+            self.set_no_resources(jid)
             return
-        presence = None
-        max_prio = -129
-        for r, d in resources.items():
-            fjid = pyxmpp.JID(jid.node, jid.domain, r, check = 0)
-            if not d.has_key("presence"):
-                continue
-            p = d["presence"]
-            if not p:
-                continue
-            typ = p.get_type()
-            if typ and typ != "available":
-                continue
-            prio = p.get_priority()
-            if prio > max_prio:
-                max_prio = prio
-                presence = p
-        if presence:
+        for r, d in uinf.resources.items():
+            uinf.set_resource_priority(r, available_priority(d.get("presence")))
+        self.set_current_resource(uinf)
+
+    def update_current_resource(self, jid):
+        """Update current presence and weight of a bare JID after presence
+        of one of its resources (the full `jid`) changed."""
+        if not jid.resource:
+            return self.compute_current_resource(jid)
+        uinf = self.cjc.get_bare_user_info(jid)
+        if uinf is None or not uinf.resources:
+            self.set_no_resources(jid)
+            return
+        d = uinf.resources.get(jid.resource)
+        if d is None:
+            presence = None
+        else:
+            presence = d.get("presence")
+        uinf.set_resource_priority(jid.resource, available_priority(presence))
+        self.set_current_resource(uinf)
+
+    def set_no_resources(self, jid):
+        p = self.cjc.get_bare_user_info(jid, "presence")
+        if p and p.get_type() != "error" and p.get_from().resource:
+            self.cjc.set_bare_user_info(jid, "presence", None)
+        self.cjc.set_bare_user_info(jid, "weight", None)
+
+    def set_current_resource(self, uinf):
+        best = uinf.best_resource()
+        if best:
+            resource, max_prio = best
+            presence = uinf.resources[resource]["presence"]
             weight = show_weight.get(presence.get_show(), show_weight[None]) * 1000 + max_prio
         else:
+            max_prio = -129
+            presence = None
             weight = 0
         if max_prio < 0:
             weight -= 10000
-        self.cjc.set_bare_user_info(jid, "presence", presence)
-        self.cjc.set_bare_user_info(jid, "weight", weight)
+        uinf["presence"] = presence
+        uinf["weight"] = weight
 
     def presence_subscribe(self,stanza):
         fr=stanza.get_from()
@@ -18,6 +18,8 @@ import string
 import curses
 import re
 import os
+import threading
+import cPickle
 
 import libxml2
 
@@ -25,7 +27,7 @@ import pyxmpp
 import pyxmpp.roster
 
 from cjc.plugin import PluginBase, NamedService
-from cjc.ui import ListBuffer,ListBufferError
+from cjc.ui import ListBuffer
 from cjc import common
 from cjc import ui
 from cjc import cjc_globals
@@ -56,6 +58,19 @@ theme_formats=(
 VG_ME=1
 VG_UNKNOWN=2
 
+ROSTER_NS="jabber:iq:roster"
+ROSTERVER_NS="urn:xmpp:features:rosterver"
+
+# version of the roster cache file format
+CACHE_FORMAT=1
+
+def get_ver(query):
+    """Return roster version from a roster query element or `None`."""
+    ver=query.prop("ver")
+    if ver is None:
+        return None
+    return unicode(ver,"utf-8")
+
 class Plugin(PluginBase, NamedService):
     service_name = "roster"
     def __init__(self,app,name):
@@ -85,6 +100,18 @@ class Plugin(PluginBase, NamedService):
         self.buffer=ListBuffer("Roster")
         self.buffer.preference=self.settings["buffer_preference"]
         self.extra_items=[]
+        # group -> {jid: item} for all the items known (shown or not)
+        self.group_items={}
+        # jid -> list of groups the item is in
+        self.item_groups={}
+        # key -> view of the rows currently in the buffer
+        self.rows={}
+        # guards extra_items, group_items, item_groups and rows, which are
+        # updated from both the stream thread ("roster updated") and the
+        # event loop thread ("presence changed")
+        self.lock=threading.RLock()
+        # version of self.cjc.roster (XEP-0237) or None
+        self.roster_ver=None
         ui.activate_cmdtable("roster",self)
 
     def info_rostername(self,k,v):
@@ -105,19 +132,20 @@ class Plugin(PluginBase, NamedService):
             self.load_cache()
 
     def ev_roster_updated(self,event,arg):
-        if not arg:
-            for item in self.cjc.roster.get_items():
-                for group,it in self.extra_items:
-                    if not isinstance(it,pyxmpp.JID) or group!=VG_UNKNOWN:
-                        continue
-                    jid=item.jid
-                    if group==VG_UNKNOWN and it==jid or it.bare()==jid:
-                        self.extra_items.remove((VG_UNKNOWN,it))
-                        if self.buffer.has_key((VG_UNKNOWN,it)):
-                            self.buffer.remove_item((VG_UNKNOWN,it))
-            self.write_all()
-            return
-        self.update_item(arg)
+        self.lock.acquire()
+        try:
+            if not arg:
+                jids={}
+                for item in self.cjc.roster.get_items():
+                    jids[item.jid]=True
+                self.extra_items=[(group,it) for group,it in self.extra_items
+                        if group!=VG_UNKNOWN or not (jids.has_key(it)
+                                                or jids.has_key(it.bare()))]
+                self.write_all()
+                return
+            self.update_item(arg)
+        finally:
+            self.lock.release()
 
     def ev_presence_changed(self,event,arg):
         if arg:
@@ -160,9 +188,15 @@ class Plugin(PluginBase, NamedService):
                                     "Cannot make directory {0}: {1}"
                                                     .format(parent, err))
                 return
+        items=[]
+        for item in self.cjc.roster.get_items():
+            items.append((item.jid.as_unicode(), item.name, item.subscription,
+                                                item.ask, list(item.groups)))
+        data = {"format": CACHE_FORMAT, "ver": self.roster_ver,
+                                                            "items": items}
         try:
-            with open(filename, "w") as roster_file:
-                print >>roster_file, str(self.cjc.roster)
+            with open(filename, "wb") as roster_file:
+                cPickle.dump(data, roster_file, cPickle.HIGHEST_PROTOCOL)
         except IOError, err:
             self.error("Cannot write roster cache file {0}: {1}"
                                                 .format(filename, err))
@@ -174,60 +208,82 @@ class Plugin(PluginBase, NamedService):
         if not filename or not os.path.exists(filename):
             return
         try:
-            with open(filename, "r") as roster_file:
-                roster_data = roster_file.read().strip()
+            with open(filename, "rb") as roster_file:
+                roster_data = roster_file.read()
         except IOError, err:
             self.warning("Cannot read roster cache file {0}: {1}"
                                                 .format(filename, err))
             return
-        if not roster_data:
-            return
-        try:
-            xml = libxml2.parseDoc(roster_data)
-            roster = pyxmpp.roster.Roster(xml.getRootElement())
-        except (ValueError, libxml2.libxmlError), err:
-            self.warning("Cannot read roster cache file {0}: {1}"
-                                                .format(filename, err))
+        if not roster_data.strip():
             return
+        if roster_data.lstrip().startswith("<"):
+            # cache written by older versions, as XML
+            try:
+                xml = libxml2.parseDoc(roster_data.strip())
+                roster = pyxmpp.roster.Roster(xml.getRootElement())
+            except (ValueError, libxml2.libxmlError), err:
+                self.warning("Cannot read roster cache file {0}: {1}"
+                                                    .format(filename, err))
+                return
+            ver = None
+        else:
+            try:
+                data = cPickle.loads(roster_data)
+                if data.get("format") != CACHE_FORMAT:
+                    self.debug("Ignoring roster cache in unknown format")
+                    return
+                roster = pyxmpp.roster.Roster()
+                for jid, name, subscription, ask, groups in data["items"]:
+                    roster.add_item(pyxmpp.roster.RosterItem(pyxmpp.JID(jid),
+                                            subscription, name, groups, ask))
+                ver = data.get("ver")
+            except Exception, err:
+                self.warning("Cannot read roster cache file {0}: {1}"
+                                                    .format(filename, err))
+                return
         self.cjc.roster = roster
+        self.roster_ver = ver
         self.write_all()
 
     def update_item(self,item):
         self.debug("Roster.update_item(%r): %r" % (item, item))
-        if isinstance(item,pyxmpp.JID):
-            if self.cjc.roster:
-                try:
-                    item=self.cjc.roster.get_item_by_jid(item)
-                except KeyError:
+        self.lock.acquire()
+        try:
+            if isinstance(item,pyxmpp.JID):
+                if self.cjc.roster:
                     try:
-                        item=self.cjc.roster.get_item_by_jid(item.bare())
+                        item=self.cjc.roster.get_item_by_jid(item)
                     except KeyError:
-                        pass
-        if isinstance(item,pyxmpp.roster.RosterItem):
-            jid=item.jid
-            groups=item.groups
-            for g,j in self.buffer.get_keys():
-                if j==jid and g not in groups:
-                    self.buffer.remove_item((g,j))
-                elif g==VG_UNKNOWN and j and (j==jid or j.bare()==jid):
-                    self.buffer.remove_item((g,j))
-            if groups:
+                        try:
+                            item=self.cjc.roster.get_item_by_jid(item.bare())
+                        except KeyError:
+                            pass
+            if isinstance(item,pyxmpp.roster.RosterItem):
+                jid=item.jid
+                groups=item.groups
+                if not groups:
+                    groups=[None]
+                for g in list(self.item_groups.get(jid,[])):
+                    if g not in groups:
+                        self.remove_member(g,jid)
+                unknown=self.group_items.get(VG_UNKNOWN)
+                if unknown:
+                    for j in unknown.keys():
+                        if j==jid or j.bare()==jid:
+                            self.remove_member(VG_UNKNOWN,j)
                 for group in groups:
                     self.write_item(group,item)
-            else:
-                self.write_item(None,item)
-        elif isinstance(item,pyxmpp.JID):
-            if item.bare()==self.cjc.jid.bare():
-                group=VG_ME
-                if not self.buffer.has_key((group,None)):
-                    self.buffer.insert_themed((group,None),"roster.group_me",{})
-            else:
-                group=VG_UNKNOWN
-                if not self.buffer.has_key((group,None)):
-                    self.buffer.insert_themed((group,None),"roster.group_unknown",{})
-            self.write_item(group,item)
-            self.extra_items.append((group,item))
-        self.buffer.update()
+            elif isinstance(item,pyxmpp.JID):
+                if item.bare()==self.cjc.jid.bare():
+                    group=VG_ME
+                else:
+                    group=VG_UNKNOWN
+                if item not in self.group_items.get(group,{}):
+                    self.extra_items.append((group,item))
+                self.write_item(group,item)
+            self.buffer.update()
+        finally:
+            self.lock.release()
 
     def get_item_format_params(self,group,item,show_list):
         if isinstance(item,pyxmpp.JID):
@@ -296,57 +352,216 @@ class Plugin(PluginBase, NamedService):
         p["available"]=available
         return p
 
-    def write_item(self,group,item):
-        self.debug("Roster.write_item(%r): %r" % (item, item))
-        if not self.buffer.has_key((group,None)):
-            if group:
-                p={"group":group}
-                self.buffer.insert_themed((group,None),"roster.group",p)
-            else:
-                self.buffer.insert_themed((group,None),"roster.group_none",{})
+    def group_format(self,group):
+        if group==VG_ME:
+            return "roster.group_me",{}
+        elif group==VG_UNKNOWN:
+            return "roster.group_unknown",{}
+        elif group:
+            return "roster.group",{"group":group}
+        else:
+            return "roster.group_none",{}
 
-        params=self.get_item_format_params(group,item,self.settings["show"])
+    def render_group(self,group):
+        format,params=self.group_format(group)
+        return cjc_globals.theme_manager.format_string(format,params)
 
+    def render_item(self,group,item):
+        """Return view of the roster row of `item` in `group` or `None` if
+        the item should not be shown."""
+        params=self.get_item_format_params(group,item,self.settings["show"])
         if params is None:
-            self.debug("Roster.write_item: removing item")
-            if isinstance(item,pyxmpp.JID):
-                jid=item
-            else:
-                jid=item.jid
-            try:
-                self.buffer.remove_item((group,jid))
-            except ListBufferError:
-                pass
+            return None
+        if params["available"]:
+            format="roster.available"
+        else:
+            format="roster.unavailable"
+        return cjc_globals.theme_manager.format_string(format,params)
+
+    def set_row(self,key,view):
+        """Show `view` as the buffer row `key` (remove the row if `view` is
+        `None`). Nothing is done when the row is already shown."""
+        old=self.rows.get(key)
+        if view is None:
+            if old is not None:
+                del self.rows[key]
+                self.buffer.remove_item(key)
             return
+        if old==view:
+            return
+        self.rows[key]=view
+        if old is None:
+            self.buffer.insert_sorted(key,view)
+        else:
+            self.buffer.update_item(key,view)
 
-        self.debug("Roster.write_item: updating item")
-        if params["available"]:
-            self.buffer.insert_themed((group,params["jid"]),"roster.available",params)
+    def add_member(self,group,item):
+        """Add `item` to the group index.
+
+        :Return: `True` if the group was empty."""
+        if isinstance(item,pyxmpp.JID):
+            jid=item
         else:
-            self.buffer.insert_themed((group,params["jid"]),"roster.unavailable",params)
+            jid=item.jid
+        members=self.group_items.get(group)
+        new_group=members is None
+        if new_group:
+            members={}
+            self.group_items[group]=members
+        members[jid]=item
+        groups=self.item_groups.setdefault(jid,[])
+        if group not in groups:
+            groups.append(group)
+        return new_group
+
+    def remove_member(self,group,jid):
+        members=self.group_items.get(group)
+        if not members or not members.has_key(jid):
+            return
+        del members[jid]
+        groups=self.item_groups[jid]
+        groups.remove(group)
+        if not groups:
+            del self.item_groups[jid]
+        self.set_row((group,jid),None)
+        if not members:
+            del self.group_items[group]
+            self.set_row((group,None),None)
+        if group in (VG_ME,VG_UNKNOWN):
+            self.extra_items=[(g,it) for g,it in self.extra_items
+                                        if g!=group or it!=jid]
 
-    def write_all(self):
-        self.buffer.clear()
-        groups_added=[]
-        for group,item in self.extra_items:
-            if group==VG_ME and group not in groups_added:
-                self.buffer.insert_themed((group,None),"roster.group_me",{})
-            elif group==VG_UNKNOWN and group not in groups_added:
-                self.buffer.insert_themed((group,None),"roster.group_unknown",{})
-            self.write_item(group,item)
+    def write_item(self,group,item):
+        self.debug("Roster.write_item(%r): %r" % (item, item))
+        if self.add_member(group,item):
+            self.set_row((group,None),self.render_group(group))
+        if isinstance(item,pyxmpp.JID):
+            jid=item
+        else:
+            jid=item.jid
+        self.set_row((group,jid),self.render_item(group,item))
 
-        if not self.cjc.roster:
+    def write_all(self):
+        self.lock.acquire()
+        try:
+            self.group_items={}
+            self.item_groups={}
+            items=list(self.extra_items)
+            if self.cjc.roster:
+                for group in self.cjc.roster.get_groups():
+                    for item in self.cjc.roster.get_items_by_group(group):
+                        items.append((group,item))
+            rows={}
+            for group,item in items:
+                if self.add_member(group,item):
+                    rows[(group,None)]=self.render_group(group)
+                view=self.render_item(group,item)
+                if view is None:
+                    continue
+                if isinstance(item,pyxmpp.JID):
+                    jid=item
+                else:
+                    jid=item.jid
+                rows[(group,jid)]=view
+            self.apply_rows(rows)
             self.buffer.update()
+        finally:
+            self.lock.release()
+
+    def apply_rows(self,rows):
+        """Make the buffer show `rows` (key to view mapping), touching only
+        the rows which changed, or reloading the whole buffer when most of
+        them did."""
+        changed=[key for key,view in rows.items() if self.rows.get(key)!=view]
+        removed=[key for key in self.rows if not rows.has_key(key)]
+        if not self.rows or len(changed)+len(removed)>len(rows)/2:
+            self.buffer.load_items(rows.items())
+            self.rows=rows
             return
-        groups=self.cjc.roster.get_groups()
-        groups.sort()
-        for group in groups:
-            for item in self.cjc.roster.get_items_by_group(group):
-                self.write_item(group,item)
-        self.buffer.update()
+        for key in removed:
+            self.set_row(key,None)
+        for key in changed:
+            self.set_row(key,rows[key])
 
     def session_started(self,stream):
-        self.cjc.request_roster()
+        if not self.cjc.roster:
+            self.load_cache()
+        self.request_roster(stream)
+
+    def request_roster(self,stream,versioned=True):
+        """Request the roster, only the changes since the cached one if
+        the server supports roster versioning (XEP-0237).
+
+        With versioning an empty 'ver' is sent when there is no cached
+        version, so the server starts versioning the roster."""
+        iq=pyxmpp.Iq(stanza_type="get")
+        q=iq.new_query(ROSTER_NS)
+        if versioned and self.rosterver_supported(stream):
+            if self.cjc.roster and self.roster_ver is not None:
+                ver=self.roster_ver
+                self.debug("Requesting roster changes since %r" % (ver,))
+            else:
+                ver=u""
+            q.setProp("ver",ver.encode("utf-8"))
+            error_handler=self.versioned_roster_error
+        else:
+            error_handler=self.roster_error
+        stream.set_response_handlers(iq,self.roster_result,error_handler)
+        stream.set_iq_set_handler("query",ROSTER_NS,self.roster_push)
+        stream.send(iq)
+
+    def rosterver_supported(self,stream):
+        features=getattr(stream,"features",None)
+        if features is None:
+            return False
+        n=features.children
+        while n:
+            if (n.type=="element" and n.name=="ver" and n.ns()
+                                    and n.ns().getContent()==ROSTERVER_NS):
+                return True
+            n=n.next
+        return False
+
+    def roster_result(self,iq):
+        q=iq.get_query()
+        if q is None:
+            # empty result: the cached roster is up to date, the changes
+            # (if any) will come as roster pushes
+            self.debug("Cached roster is up to date")
+            self.cjc.roster_updated()
+            return
+        self.cjc.roster=pyxmpp.roster.Roster(q)
+        self.roster_ver=get_ver(q)
+        self.cjc.roster_updated()
+
+    def roster_error(self,iq):
+        self.error(u"Roster retrieval failed")
+
+    def versioned_roster_error(self,iq):
+        """Retry a failed versioned roster request without the
+        version."""
+        self.debug("Versioned roster request failed, requesting the full roster")
+        self.roster_ver=None
+        stream=self.cjc.stream
+        if stream:
+            self.request_roster(stream,False)
+
+    def roster_push(self,iq):
+        fr=iq.get_from()
+        me=self.cjc.jid
+        if fr and fr!=me and fr!=me.bare():
+            self.warning(u"Got roster update from wrong source: %s"
+                                                        % (fr.as_unicode(),))
+            return iq.make_error_response("forbidden")
+        if not self.cjc.roster:
+            self.cjc.roster=pyxmpp.roster.Roster()
+        q=iq.get_query()
+        item=self.cjc.roster.update(q)
+        ver=get_ver(q)
+        if ver is not None:
+            self.roster_ver=ver
+        self.cjc.stream.send(iq.make_result_response())
+        self.cjc.roster_updated(item)
     
     def cmd_add(self,args):
         groups=[]
@@ -16,7 +16,7 @@
 
 """SQLite based message archive."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import os
 import sqlite3
@@ -26,6 +26,8 @@ import re
 import itertools
 import codecs
 import shutil
+import time
+import Queue
 
 from pyxmpp.jid import JID
 
@@ -37,10 +39,21 @@ from cjc import ui, cjc_globals
 
 logger = logging.getLogger("cjc.plugin.sqlite_archive")
 
+theme_formats = (
+    ("archive.search_hit", u"%[info][%(T:timestamp:%Y-%m-%d %H:%M)s]"
+                u" %(event_type)s %(direction)s %(J:peer)s:%[] %(snippet)s\n"),
+    ("archive.search_end", u"%[info]No more results.\n"),
+)
+
 SqliteArchiveRecord = collections.namedtuple("SqliteArchiveRecord",
         "event_type peer direction timestamp subject body thread")
 ArchiveRecord.register(SqliteArchiveRecord)
 
+# archive id of the records returned by `SqliteArchive.get_records`, also
+# a position for the keyset pagination
+SqliteArchiveId = collections.namedtuple("SqliteArchiveId",
+                                                "timestamp record_id")
+
 SCHEMA = ["""
 CREATE TABLE archive (
     record_id       INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -57,19 +70,393 @@ CREATE TABLE archive (
     "CREATE INDEX archive_timestamp_i ON archive(timestamp);",
     ]
 
+FTS5_SCHEMA = [
+    "CREATE VIRTUAL TABLE archive_fts USING fts5(subject, body,"
+                            " content='archive', content_rowid='record_id');",
+    "CREATE TRIGGER archive_fts_ai AFTER INSERT ON archive BEGIN"
+        " INSERT INTO archive_fts(rowid, subject, body)"
+            " VALUES(new.record_id, new.subject, new.body);"
+    " END;",
+    "CREATE TRIGGER archive_fts_ad AFTER DELETE ON archive BEGIN"
+        " INSERT INTO archive_fts(archive_fts, rowid, subject, body)"
+            " VALUES('delete', old.record_id, old.subject, old.body);"
+    " END;",
+    "CREATE TRIGGER archive_fts_au AFTER UPDATE ON archive BEGIN"
+        " INSERT INTO archive_fts(archive_fts, rowid, subject, body)"
+            " VALUES('delete', old.record_id, old.subject, old.body);"
+        " INSERT INTO archive_fts(rowid, subject, body)"
+            " VALUES(new.record_id, new.subject, new.body);"
+    " END;",
+    ]
+
+FTS4_SCHEMA = [
+    "CREATE VIRTUAL TABLE archive_fts USING fts4(content='archive',"
+                                                        " subject, body);",
+    "CREATE TRIGGER archive_fts_ai AFTER INSERT ON archive BEGIN"
+        " INSERT INTO archive_fts(docid, subject, body)"
+            " VALUES(new.record_id, new.subject, new.body);"
+    " END;",
+    "CREATE TRIGGER archive_fts_bd BEFORE DELETE ON archive BEGIN"
+        " DELETE FROM archive_fts WHERE docid = old.record_id;"
+    " END;",
+    "CREATE TRIGGER archive_fts_bu BEFORE UPDATE ON archive BEGIN"
+        " DELETE FROM archive_fts WHERE docid = old.record_id;"
+    " END;",
+    "CREATE TRIGGER archive_fts_au AFTER UPDATE ON archive BEGIN"
+        " INSERT INTO archive_fts(docid, subject, body)"
+            " VALUES(new.record_id, new.subject, new.body);"
+    " END;",
+    ]
+
+def create_fulltext_index(database):
+    """Create the full-text index of the archive (FTS5 or, if that is not
+    available, FTS4) kept up to date by triggers."""
+    for schema in (FTS5_SCHEMA, FTS4_SCHEMA):
+        try:
+            database.execute(schema[0])
+        except sqlite3.OperationalError, err:
+            logger.debug("Cannot create the full-text index: {0}"
+                                                                .format(err))
+            continue
+        for command in schema[1:]:
+            database.execute(command)
+        database.execute("INSERT INTO archive_fts(archive_fts)"
+                                                    " VALUES('rebuild')")
+        return
+    logger.warning("SQLite full-text search not available,"
+                                        " archive search will not work")
+
+def fulltext_version(database):
+    """Return version of the full-text index available (4 or 5) or
+    `None`."""
+    row = database.execute("SELECT sql FROM sqlite_master"
+                                " WHERE name = 'archive_fts'").fetchone()
+    if row is None:
+        return None
+    if "fts5" in row[0].lower():
+        return 5
+    return 4
+
+def to_epoch(timestamp):
+    """Convert a (local time) `datetime` to the integer Unix time stored
+    in the database."""
+    return int(time.mktime(timestamp.timetuple()))
+
+def _iso_to_epoch(value):
+    """Convert the ISO timestamp stored by the old schema to the Unix
+    time.
+
+    :Return: the Unix time or `None` if `value` cannot be parsed"""
+    if not value:
+        return None
+    value = value.split(".", 1)[0]
+    for pattern in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return to_epoch(datetime.strptime(value, pattern))
+        except ValueError:
+            continue
+    return None
+
+NORMALIZED_SCHEMA = [
+    "CREATE TABLE peers (peer_id INTEGER PRIMARY KEY, jid TEXT NOT NULL"
+                                                                " UNIQUE);",
+    "INSERT INTO peers(jid) SELECT DISTINCT peer FROM archive"
+                                                " WHERE peer IS NOT NULL;",
+    """
+CREATE TABLE archive_new (
+    record_id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_type      TEXT,
+    peer_id         INTEGER REFERENCES peers(peer_id),
+    peer_resource   TEXT,
+    direction       TEXT,
+    timestamp       INTEGER NOT NULL,
+    subject         TEXT,
+    body            TEXT,
+    thread          TEXT
+    );""",
+    "INSERT INTO archive_new(record_id, event_type, peer_id, peer_resource,"
+                        " direction, timestamp, subject, body, thread)"
+        " SELECT record_id, event_type, peers.peer_id, peer_resource,"
+                " direction, epochs.timestamp, subject, body,"
+                " NULLIF(thread, 'None')"
+        " FROM archive JOIN temp.archive_epochs AS epochs USING(record_id)"
+        " LEFT JOIN peers ON peers.jid = archive.peer"
+        " ORDER BY record_id;",
+    "DROP TABLE temp.archive_epochs;",
+    "DROP TABLE archive;",
+    "ALTER TABLE archive_new RENAME TO archive;",
+    "CREATE INDEX archive_peer_type_timestamp_i"
+                            " ON archive(peer_id, event_type, timestamp);",
+    "CREATE INDEX archive_timestamp_i ON archive(timestamp);",
+    ]
+
+def _migrated_epochs(database):
+    """Yield (record_id, Unix time) pairs for the old schema records.
+
+    Records with a missing or invalid timestamp get the time of the
+    previous valid record (or 0), so they keep their place in the
+    history."""
+    last = 0
+    cursor = database.execute("SELECT record_id, timestamp FROM archive"
+                                                    " ORDER BY record_id")
+    for record_id, timestamp in cursor:
+        epoch = _iso_to_epoch(timestamp)
+        if epoch is None:
+            logger.warning("Invalid timestamp {0!r} of archive record {1},"
+                    " using {2}".format(timestamp, record_id, last))
+            epoch = last
+        else:
+            last = epoch
+        yield record_id, epoch
+
+def normalize_schema(database):
+    """Move the peer JIDs to the `peers` table, store timestamps as the
+    Unix time and missing threads as NULL.
+
+    The full-text index is kept, as the record ids do not change, only its
+    triggers are recreated."""
+    version = fulltext_version(database)
+    database.execute("CREATE TEMP TABLE archive_epochs (record_id INTEGER"
+                                " PRIMARY KEY, timestamp INTEGER NOT NULL)")
+    database.executemany("INSERT INTO temp.archive_epochs VALUES(?, ?)",
+                                                _migrated_epochs(database))
+    for command in NORMALIZED_SCHEMA:
+        database.execute(command)
+    if version == 5:
+        triggers = FTS5_SCHEMA[1:]
+    elif version == 4:
+        triggers = FTS4_SCHEMA[1:]
+    else:
+        triggers = []
+    for command in triggers:
+        database.execute(command)
+
+# schema changes applied to databases created with `SCHEMA` (lists of SQL
+# commands or functions to call with the database), the number of changes
+# applied is stored as the database 'user_version'
+MIGRATIONS = [
+    # 1: conversation history paging: peer and event_type equality,
+    # ordered by timestamp (and record_id, which is the rowid)
+    [
+        "CREATE INDEX archive_peer_type_timestamp_i"
+                                " ON archive(peer, event_type, timestamp);",
+        "DROP INDEX archive_peer_i;",
+    ],
+    # 2: full-text index
+    create_fulltext_index,
+    # 3: interned peer JIDs, integer timestamps
+    normalize_schema,
+    ]
+
+# `ArchiveWriter` queue item requesting a commit of the records collected
+FLUSH = object()
+
+class ArchiveWriter(threading.Thread):
+    """Thread writing the archive records queued by `SqliteArchive`.
+
+    Records are written in transactions of up to `batch_size` records or
+    covering up to `commit_interval` seconds, whichever limit is reached
+    first.
+
+    :Ivariables:
+        - `archive`: the archive
+        - `queue`: queue of records (tuples of `SqliteArchive._log_event`
+          arguments), `FLUSH` to commit the records collected so far or
+          `None` to stop the thread
+        - `last_maintenance`: time of the last `maintenance` call
+        - `queued`: number of records queued by `put`
+        - `written`: number of the queued records processed (committed or
+          lost)
+        - `condition`: condition guarding `queued` and `written`, notified
+          when records are processed
+    """
+    def __init__(self, archive):
+        threading.Thread.__init__(self, name = "Archive writer")
+        self.setDaemon(True)
+        self.archive = archive
+        self.queue = Queue.Queue()
+        self.last_maintenance = time.time()
+        self.queued = 0
+        self.written = 0
+        self.condition = threading.Condition()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if not self._write_batch(item):
+                    break
+            except:
+                logger.exception("Archive write failed")
+            interval = self.archive.settings.get("maintenance_interval")
+            if interval and time.time() >= self.last_maintenance + interval:
+                self.maintenance()
+        self.maintenance()
+        self.archive._close_database()
+
+    def maintenance(self):
+        """Checkpoint the write-ahead log and let SQLite update its
+        statistics."""
+        self.last_maintenance = time.time()
+        database = self.archive._database
+        if database is None:
+            return
+        try:
+            database.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+            database.execute("PRAGMA optimize").fetchall()
+        except sqlite3.Error, err:
+            logger.warning("Archive database maintenance failed: {0}"
+                                                                .format(err))
+
+    def _write_batch(self, item):
+        """Collect `item` and the following records and write them in one
+        transaction.
+
+        :Return: `False` when the thread should stop."""
+        settings = self.archive.settings
+        batch_size = settings.get("batch_size") or 1
+        deadline = time.time() + (settings.get("commit_interval") or 0)
+        records = []
+        running = True
+        while True:
+            if item is None:
+                running = False
+                break
+            elif item is FLUSH:
+                break
+            records.append(item)
+            if len(records) >= batch_size:
+                break
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(True, timeout)
+            except Queue.Empty:
+                break
+        try:
+            if records:
+                self._write_records(records)
+        finally:
+            self.condition.acquire()
+            try:
+                self.written += len(records)
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+        return running
+
+    def _write_records(self, records):
+        """Write `records` in one transaction.
+
+        When that fails the records are written one by one, so only the
+        failing ones are lost."""
+        archive = self.archive
+        if archive._start_transaction() is None:
+            logger.error("Archive database not available, {0} records lost"
+                                                        .format(len(records)))
+            return
+        try:
+            for record in records:
+                archive._log_event(*record)
+            archive._commit()
+        except Exception:
+            logger.exception("Archive batch write failed, retrying"
+                                                    " record by record")
+            archive._rollback()
+        else:
+            return
+        for record in records:
+            try:
+                archive._log_event(*record)
+                archive._commit()
+            except Exception:
+                logger.exception("Archive record lost: {0!r}"
+                                                        .format(record[:3]))
+                archive._rollback()
+
+    def put(self, record):
+        """Queue `record` for writing."""
+        self.condition.acquire()
+        try:
+            self.queued += 1
+            self.queue.put(record)
+        finally:
+            self.condition.release()
+
+    def pending(self):
+        """Return the number of records queued and not written yet."""
+        self.condition.acquire()
+        try:
+            return self.queued - self.written
+        finally:
+            self.condition.release()
+
+    def flush(self):
+        """Wait until the records queued so far are committed.
+
+        Returns immediately when there are none and does not wait for
+        the database maintenance done after them."""
+        self.condition.acquire()
+        try:
+            target = self.queued
+            if self.written < target:
+                self.queue.put(FLUSH)
+            while self.written < target and self.isAlive():
+                self.condition.wait(1)
+        finally:
+            self.condition.release()
+
+    def stop(self):
+        """Commit all the records queued and stop the thread."""
+        self.queue.put(None)
+        self.join()
+
 class SqliteArchive(Plugin, Archiver, Archive, Configurable, EventListener):
     """Reimplementation of the old logging by the message, chat and muc
     plugins."""
     settings_namespace = "sqlite_archive"
     available_settings = {
             "filename": ("Archive database filename", (str, None)),
+            "durability": ("'full' to commit every record to the database"
+                    " before continuing, 'batch' to write records in"
+                    " a separate thread, in batches (records from the last"
+                    " commit_interval seconds may be lost on a crash)",
+                    (str, None)),
+            "batch_size": ("Maximum number of records written in one"
+                    " transaction", int),
+            "commit_interval": ("Maximum time (in seconds) records wait"
+                    " for a commit", float),
+            "synchronous": ("SQLite synchronous mode: 'off', 'normal' (safe"
+                    " with the write-ahead log, the last transactions may be"
+                    " lost on a power failure) or 'full'", (str, None)),
+            "cache_size": ("Database page cache size (in KiB) for each"
+                    " connection", int),
+            "mmap_size": ("Maximum size (in bytes) of the database file"
+                    " part accessed through memory mapping (0 to disable)",
+                    int),
+            "maintenance_interval": ("Minimum time (in seconds) between"
+                    " the write-ahead log checkpoints and database"
+                    " optimization done by the writer thread", float),
+            "search_page_size": ("Number of /search results shown at once",
+                    int),
             };
     settings = None
     def __init__(self):
         self.settings = {
                 "filename": "~/.cjc/archive.db",
+                "durability": "batch",
+                "batch_size": 200,
+                "commit_interval": 1.0,
+                "synchronous": "normal",
+                "cache_size": 8192,
+                "mmap_size": 67108864,
+                "maintenance_interval": 600.0,
+                "search_page_size": 20,
                 }
         self._local = threading.local()
+        self._writer = None
+        self._writer_lock = threading.Lock()
 
     @event_handler("config loaded")
     def ev_config_loaded(self, event, arg):
@@ -93,11 +480,54 @@ class SqliteArchive(Plugin, Archiver, Archive, Configurable, EventListener):
     @_database.setter
     def _database(self, value):
         self._local.database = value
+        # peer JID to peer id mapping, may include ids not committed yet
+        self._local.peer_ids = {}
+        # (peer id, resource) to `JID` mapping
+        self._local.jids = {}
+
+    @event_handler("exit")
+    def ev_exit(self, event, arg):
+        """Write the queued records before exit."""
+        self._stop_writer()
 
     def unload(self):
         """Allow plugin unload/reload."""
+        self._stop_writer()
         return True
 
+    def _stop_writer(self):
+        self._writer_lock.acquire()
+        try:
+            writer = self._writer
+            self._writer = None
+        finally:
+            self._writer_lock.release()
+        if writer:
+            writer.stop()
+
+    def _flush_writer(self):
+        """Wait until the records queued for the writer thread are
+        committed, so they can be read back."""
+        writer = self._writer
+        if (writer and writer is not threading.currentThread()
+                                                    and writer.pending()):
+            writer.flush()
+
+    def _get_writer(self):
+        self._writer_lock.acquire()
+        try:
+            if self._writer is None:
+                self._writer = ArchiveWriter(self)
+                self._writer.start()
+            return self._writer
+        finally:
+            self._writer_lock.release()
+
+    def _close_database(self):
+        if self._database is not None:
+            self._database.close()
+            self._database = None
+
     def _open_database(self):
         filename = self.filename
         if os.path.exists(filename):
@@ -106,30 +536,95 @@ class SqliteArchive(Plugin, Archiver, Archive, Configurable, EventListener):
             new = True
             logger.info("Sqlite archive: no database found, will create a new one.")
         try:
-            self._database = sqlite3.connect(filename,
-                                    detect_types = sqlite3.PARSE_COLNAMES)
+            self._database = sqlite3.connect(filename)
             self._database.row_factory = sqlite3.Row
-            if not new:
-                return self._database
-            for command in SCHEMA:
-                self._database.execute(command)
+            self._configure_database(self._database)
+            if new:
+                for command in SCHEMA:
+                    self._database.execute(command)
+                self._database.commit()
+            self._migrate(self._database)
         except Exception, err:
             if self._database:
                 self._database.rollback()
+                self._database.close()
+                self._database = None
             logger.error("Couldn't open archive database {0!r}: {1}".format(
                                                                 filename, err))
-            try:
-                os.unlink(filename)
-            except OSError:
-                pass
+            if new:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
             return None
-        self._database.commit()
         if new:
             logger.warning("New sqlite archive created."
                     " You may want to use /migrate_archive command to load old"
                     " log files into the new archive.")
         return self._database
 
+    @staticmethod
+    def _migrate(database):
+        """Apply the `MIGRATIONS` missing in the database, in a single
+        transaction."""
+        version = database.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+        isolation_level = database.isolation_level
+        database.isolation_level = None
+        try:
+            database.execute("BEGIN IMMEDIATE")
+            try:
+                # could have been migrated by another connection meanwhile
+                version = database.execute("PRAGMA user_version").fetchone()[0]
+                for i in range(version, len(MIGRATIONS)):
+                    logger.info("Upgrading the archive database schema"
+                                            " to version {0}".format(i + 1))
+                    migration = MIGRATIONS[i]
+                    if callable(migration):
+                        migration(database)
+                        continue
+                    for command in migration:
+                        database.execute(command)
+                database.execute("PRAGMA user_version = {0:d}"
+                                                    .format(len(MIGRATIONS)))
+            except:
+                database.execute("ROLLBACK")
+                raise
+            database.execute("COMMIT")
+        finally:
+            database.isolation_level = isolation_level
+
+    def _configure_database(self, database):
+        """Switch the database to the write-ahead log mode, so readers
+        do not wait for the writer, and set the connection pragmas.
+
+        Failures are only logged, the database is usable without that."""
+        try:
+            self._set_pragmas(database)
+        except sqlite3.Error, err:
+            logger.warning("Couldn't configure the archive database: {0}"
+                                                                .format(err))
+
+    def _set_pragmas(self, database):
+        mode = database.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != "wal":
+            logger.warning("Could not switch the archive database to the WAL"
+                                    " mode, journal mode is: {0}".format(mode))
+        synchronous = (self.settings.get("synchronous") or "normal").upper()
+        if synchronous not in ("OFF", "NORMAL", "FULL"):
+            logger.warning("Invalid sqlite_archive.synchronous value: {0!r}"
+                                                        .format(synchronous))
+            synchronous = "NORMAL"
+        database.execute("PRAGMA synchronous={0}".format(synchronous))
+        cache_size = self.settings.get("cache_size")
+        if cache_size:
+            database.execute("PRAGMA cache_size={0:d}".format(-cache_size))
+        mmap_size = self.settings.get("mmap_size")
+        if mmap_size is not None:
+            database.execute("PRAGMA mmap_size={0:d}".format(mmap_size)
+                                                                ).fetchall()
+
     def _start_transaction(self):
         if self._database is None:
             self._open_database()
@@ -138,6 +633,7 @@ class SqliteArchive(Plugin, Archiver, Archive, Configurable, EventListener):
         return self._database
 
     def _rollback(self):
+        self._local.peer_ids = {}
         return self._database.rollback()
 
     def _commit(self):
@@ -148,14 +644,38 @@ class SqliteArchive(Plugin, Archiver, Archive, Configurable, EventListener):
         """Log an event using existing transaction."""
         if timestamp is None:
             timestamp = datetime.now()
-        peer_resource = peer.resource
-        peer = peer.bare()
+        peer_id = self._get_peer_id(peer, True)
         self._database.execute(
-                "INSERT INTO archive(event_type, peer, peer_resource,"
+                "INSERT INTO archive(event_type, peer_id, peer_resource,"
                         " direction, timestamp, subject, body, thread)"
                     " VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
-                    (event_type, peer.as_unicode(), peer_resource, direction,
-                                        timestamp, subject, body, str(thread)))
+                    (event_type, peer_id, peer.resource, direction,
+                            to_epoch(timestamp), subject, body, thread))
+
+    def _get_peer_id(self, peer, create = False):
+        """Return id of the bare JID of `peer` in the peers table.
+
+        :Parameters:
+            - `peer`: the JID
+            - `create`: if `True` add the JID to the table if it is missing
+              (within the current transaction)
+        :Return: the peer id or `None`"""
+        jid = peer.bare().as_unicode()
+        peer_ids = self._local.peer_ids
+        peer_id = peer_ids.get(jid)
+        if peer_id is not None:
+            return peer_id
+        row = self._database.execute("SELECT peer_id FROM peers"
+                                        " WHERE jid = ?", (jid,)).fetchone()
+        if row is not None:
+            peer_id = row[0]
+        elif create:
+            peer_id = self._database.execute("INSERT INTO peers(jid)"
+                                            " VALUES(?)", (jid,)).lastrowid
+        else:
+            return None
+        peer_ids[jid] = peer_id
+        return peer_id
 
     def log_event(self, event_type, peer, direction = None, timestamp = None,
                     subject = None, body = None, thread = None, **kwargs):
@@ -166,13 +686,21 @@ class SqliteArchive(Plugin, Archiver, Archive, Configurable, EventListener):
             return
         if direction not in ('in', 'out'):
             return
+        if timestamp is None:
+            timestamp = datetime.now()
+        if self.settings.get("durability") != "full":
+            self._get_writer().put((event_type, peer, direction,
+                                        timestamp, subject, body, thread))
+            return
+        if self._writer:
+            self._stop_writer()
         if not self._start_transaction():
             return
         try:
             self._log_event(event_type, peer, direction, timestamp, subject,
                                                         body, thread, **kwargs)
         except:
-            self._database.rollback()
+            self._rollback()
             raise
         else:
             self._database.commit()
@@ -180,61 +708,189 @@ class SqliteArchive(Plugin, Archiver, Archive, Configurable, EventListener):
     def get_records(self, event_type = None, peer = None,
             older_than = None, newer_than = None, limit = None,
                                             order = None, *kwargs):
+        """Get records from archive.
+
+        Archive ids of the records are `SqliteArchiveId` objects, when used as
+        `older_than` or `newer_than` the records are found with the
+        (timestamp, record_id) index range (keyset pagination), so getting
+        the next page costs the same regardless of the position. Plain
+        record ids are also accepted.
+
+        Records still queued for the writer thread are committed first,
+        unless `older_than` is given (the older pages are not affected by
+        them)."""
+        if older_than is None:
+            self._flush_writer()
         if self._database is None:
             self._open_database()
             if self._database is None:
                 return
-        query = ('SELECT record_id, event_type, peer, peer_resource,' 
-                    ' direction, timestamp AS "timestamp [TIMESTAMP]",' 
-                    ' subject, body, thread FROM archive')
+        query = ('SELECT record_id, event_type, archive.peer_id, jid,'
+                    ' peer_resource, direction, timestamp, subject, body,'
+                    ' thread FROM archive'
+                    ' LEFT JOIN peers ON peers.peer_id = archive.peer_id')
         where = []
         params = []
         if event_type is not None:
             where.append("event_type = ?")
             params.append(event_type)
         if peer is not None:
-            if limit and order in (self.CHRONOLOGICAL,
-                                            self.REVERSE_CHRONOLOGICAL):
-                where.append("+peer = ?")
-            else:
-                where.append("peer = ?")
-            params.append(unicode(peer.bare()))
+            peer_id = self._get_peer_id(peer)
+            if peer_id is None:
+                return
+            where.append("archive.peer_id = ?")
+            params.append(peer_id)
             if peer.resource:
                 where.append("peer_resource = ?")
                 params.append(peer.resource)
-        if isinstance(older_than, datetime):
-            where.append("timestamp < ?")
-            params.append(older_than)
-        elif older_than is not None:
-            where.append("timestamp < "
-                        " (select timestamp from archive where record_id = ?)")
-            params.append(older_than)
-        if isinstance(newer_than, datetime):
-            where.append("timestamp > ?")
-            params.append(newer_than)
-        elif newer_than is not None:
-            where.append("timestamp > "
-                        " (select timestamp from archive where record_id = ?)")
-            params.append(newer_than)
+        for value, operator in ((older_than, "<"), (newer_than, ">")):
+            if value is None:
+                continue
+            if isinstance(value, datetime):
+                where.append("timestamp {0} ?".format(operator))
+                params.append(to_epoch(value))
+                continue
+            if not isinstance(value, SqliteArchiveId):
+                value = self._get_archive_id(value)
+                if value is None:
+                    return
+            where.append("timestamp {0}= ? AND (timestamp {0} ?"
+                                    " OR record_id {0} ?)".format(operator))
+            params += [value.timestamp, value.timestamp, value.record_id]
         if where:
             query += " WHERE " + " AND ".join(where)
         if order == self.CHRONOLOGICAL:
-            query += " ORDER BY timestamp"
+            query += " ORDER BY timestamp, record_id"
         elif order == self.REVERSE_CHRONOLOGICAL:
-            query += " ORDER BY timestamp DESC"
+            query += " ORDER BY timestamp DESC, record_id DESC"
         if limit:
             query += " LIMIT ?"
             params.append(limit)
         logger.debug("Executing query: {0!r} with params: {1!r}"
                                                     .format(query, params))
-        result = []
-        for row in self._database.execute(query, params):
-            peer = JID(row['peer'])
-            if row['peer_resource']:
-                peer = JID(peer.node, peer.domain, row['peer_resource'])
-            yield (row['record_id'], SqliteArchiveRecord(
-                row['event_type'], peer, row['direction'],
-                row['timestamp'], row['subject'], row['body'], row['thread']))
+        cursor = self._database.cursor()
+        cursor.row_factory = self._record_factory
+        for record in cursor.execute(query, params):
+            yield record
+
+    def _record_factory(self, cursor, row):
+        """Row factory for the (record_id, event_type, peer_id, jid,
+        peer_resource, direction, timestamp, subject, body, thread, ...)
+        rows.
+
+        The `JID` objects are cached by the peer id and resource.
+
+        :Return: (archive id, record, ...) tuple, the columns following
+            the record are appended unchanged."""
+        jids = self._local.jids
+        key = (row[2], row[4])
+        peer = jids.get(key)
+        if peer is None:
+            bare = jids.get((row[2], None))
+            if bare is None:
+                bare = JID(row[3])
+                jids[(row[2], None)] = bare
+            if row[4]:
+                peer = JID(bare.node, bare.domain, row[4])
+                jids[key] = peer
+            else:
+                peer = bare
+        if row[6] is None:
+            timestamp = None
+        else:
+            timestamp = datetime.fromtimestamp(row[6])
+        return (SqliteArchiveId(row[6], row[0]),
+                SqliteArchiveRecord(row[1], peer, row[5], timestamp,
+                                    row[7], row[8], row[9])) + row[10:]
+
+    def _fulltext_version(self):
+        """Return version of the full-text index available (4 or 5) or
+        `None`."""
+        return fulltext_version(self._database)
+
+    def search(self, text, event_type = None, peer = None, since = None,
+                                        until = None, limit = None, offset = 0):
+        """Search the archive using the full-text index.
+
+        With FTS5 the results are sorted by relevance, with FTS4 the newest
+        records come first.
+
+        :Parameters:
+            - `text`: full-text query (SQLite FTS query syntax)
+            - `event_type`: type of the records to return
+            - `peer`: conversation peer of the records to return
+            - `since`: return records not older than this timestamp
+            - `until`: return records older than this timestamp
+            - `limit`: maximum number of records to return
+            - `offset`: number of the matching records to skip
+        :Types:
+            - `text`: `unicode`
+            - `event_type`: `str`
+            - `peer`: `JID`
+            - `since`: `datetime`
+            - `until`: `datetime`
+            - `limit`: `int`
+            - `offset`: `int`
+
+        :Return: (archive id, record, snippet) tuples. May raise
+            `sqlite3.Error`, e.g. on invalid query syntax."""
+        if not offset:
+            self._flush_writer()
+        if self._database is None:
+            self._open_database()
+            if self._database is None:
+                return
+        version = self._fulltext_version()
+        if version is None:
+            raise sqlite3.OperationalError("Full-text index not available")
+        if version == 5:
+            snippet = "snippet(archive_fts, -1, '*', '*', '...', 12)"
+            join = "archive.record_id = archive_fts.rowid"
+            order = "archive_fts.rank"
+        else:
+            snippet = "snippet(archive_fts, '*', '*', '...', -1, 12)"
+            join = "archive.record_id = archive_fts.docid"
+            order = "archive.timestamp DESC"
+        query = ('SELECT archive.record_id, event_type, archive.peer_id, jid,'
+                    ' peer_resource, direction, archive.timestamp,'
+                    ' archive.subject, archive.body, thread, {0}'
+                    ' FROM archive_fts JOIN archive ON {1}'
+                    ' LEFT JOIN peers ON peers.peer_id = archive.peer_id'
+                    ' WHERE archive_fts MATCH ?'.format(snippet, join))
+        params = [text]
+        if event_type is not None:
+            query += " AND archive.event_type = ?"
+            params.append(event_type)
+        if peer is not None:
+            peer_id = self._get_peer_id(peer)
+            if peer_id is None:
+                return
+            query += " AND archive.peer_id = ?"
+            params.append(peer_id)
+        if since is not None:
+            query += " AND archive.timestamp >= ?"
+            params.append(to_epoch(since))
+        if until is not None:
+            query += " AND archive.timestamp < ?"
+            params.append(to_epoch(until))
+        query += " ORDER BY " + order
+        query += " LIMIT ? OFFSET ?"
+        params += [limit or -1, offset]
+        logger.debug("Executing query: {0!r} with params: {1!r}"
+                                                    .format(query, params))
+        cursor = self._database.cursor()
+        cursor.row_factory = self._record_factory
+        for result in cursor.execute(query, params):
+            yield result
+
+    def _get_archive_id(self, record_id):
+        """Return `SqliteArchiveId` for a record id or `None` if there is no
+        such record."""
+        row = self._database.execute("SELECT timestamp FROM archive"
+                        " WHERE record_id = ?", (record_id,)).fetchone()
+        if row is None:
+            return None
+        return SqliteArchiveId(row[0], record_id)
 
 
 IMPORT_PATTERNS = {
@@ -569,8 +1225,119 @@ class ArchiveImporter(object):
         self.info()
         self.info("You may now want to disable file logging.")
     
+class ArchiveSearch(object):
+    """Archive search results, shown a page at once in a text buffer."""
+    def __init__(self, archive, text, event_type = None, peer = None,
+                                            since = None, until = None):
+        self.archive = archive
+        self.text = text
+        self.event_type = event_type
+        self.peer = peer
+        self.since = since
+        self.until = until
+        self.offset = 0
+        self.buffer = ui.TextBuffer({"buffer_name": u"Search: " + text},
+                                                command_table = "buffer")
+        cjc_globals.screen.display_buffer(self.buffer)
+
+    def show_page(self):
+        """Show the next page of the results."""
+        page_size = self.archive.settings.get("search_page_size") or 20
+        try:
+            hits = list(self.archive.search(self.text, self.event_type,
+                                    self.peer, self.since, self.until,
+                                    page_size, self.offset))
+        except sqlite3.Error, err:
+            self.buffer.append_themed("error", u"Search failed: {0}"
+                                                                .format(err))
+            self.buffer.ask_question("[C]lose", "choice", "c",
+                                            self.response, values = ["c"])
+            self.buffer.update()
+            return
+        lines = []
+        for archive_id, record, snippet in hits:
+            params = {
+                    "timestamp": record.timestamp,
+                    "event_type": record.event_type,
+                    "direction": record.direction,
+                    "peer": record.peer,
+                    "snippet": snippet,
+                    }
+            lines.append(("archive.search_hit", params))
+        self.buffer.append_themed_many(lines)
+        self.offset += len(hits)
+        if len(hits) < page_size:
+            self.buffer.append_themed("archive.search_end", {})
+            self.buffer.ask_question("[C]lose", "choice", "c",
+                                            self.response, values = ["c"])
+        else:
+            self.buffer.ask_question("[M]ore results or [C]lose", "choice",
+                                    "m", self.response, values = ["m", "c"])
+        self.buffer.update()
+
+    def response(self, response):
+        if response == "m":
+            self.show_page()
+        else:
+            self.buffer.close()
+
 class ArchiveCLI(Plugin, CLI):
     command_table_name = "sqlite_archive"
+    def __init__(self):
+        cjc_globals.theme_manager.set_default_formats(theme_formats)
+
+    @cli_command
+    def cmd_search(self, args):
+        """/search [-peer user] [-type chat|message|muc] [-since YYYY-MM-DD] [-until YYYY-MM-DD] text
+
+        Search the message archive. 'text' is a full-text query: words
+        (all must match), "quoted phrases", prefixes (word*) and OR may be
+        used."""
+        cjc = Application.instance
+        event_type = None
+        peer = None
+        since = None
+        until = None
+        while True:
+            arg = args.get()
+            if arg == "-peer":
+                args.shift()
+                peer = cjc.get_user(args.shift())
+                if peer is None:
+                    return
+            elif arg == "-type":
+                args.shift()
+                event_type = args.shift()
+                if event_type not in ("chat", "message", "muc"):
+                    logger.error(u"Bad event type: {0!r}".format(event_type))
+                    return
+            elif arg in ("-since", "-until"):
+                args.shift()
+                date = args.shift()
+                try:
+                    date = datetime.strptime(date or "", "%Y-%m-%d")
+                except ValueError:
+                    logger.error(u"Bad date: {0!r}, YYYY-MM-DD expected"
+                                                            .format(date))
+                    return
+                if arg == "-since":
+                    since = date
+                else:
+                    until = date + timedelta(1)
+            else:
+                break
+        text = args.all()
+        if not text or not text.strip():
+            logger.error(u"/search without a query")
+            return
+        archive = cjc.plugins.get_service(SqliteArchive)
+        if not archive:
+            logger.error(u"Could not locate the sqlite3 archive service.")
+            return
+        search = ArchiveSearch(archive, text.strip(), event_type, peer, since,
+                                                                        until)
+        search.show_page()
+
     @cli_command
     def cmd_migrate_archive(self, args):
         """/migrate_archive
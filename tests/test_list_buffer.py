@@ -0,0 +1,120 @@
+# Console Jabber Client
+# Copyright (C) 2004-2010 Jacek Konieczny
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""ListBuffer key index and sorted insertion."""
+
+import random
+
+import pytest
+
+pytest.importorskip("pyxmpp")
+
+from cjc.ui.list_buffer import ListBuffer, ListBufferError
+
+def view(text):
+    return [(0, text)]
+
+def check_index(buf, expected):
+    """Check `buf` against a key to view dictionary."""
+    assert buf.get_keys() == sorted(expected)
+    for key, item in expected.items():
+        assert buf.has_key(key)
+        assert buf.items[buf.index(key)] == item
+
+def test_insert_sorted():
+    buf = ListBuffer("test")
+    for key in (5, 1, 3, 9, 0, 4):
+        buf.insert_sorted(key, view(unicode(key)))
+    check_index(buf, dict((key, view(unicode(key)))
+                                    for key in (0, 1, 3, 4, 5, 9)))
+    with pytest.raises(ListBufferError):
+        buf.insert_sorted(3, view(u"again"))
+
+def test_update_and_remove():
+    buf = ListBuffer("test")
+    for key in range(10):
+        buf.insert_sorted(key, view(u"x"))
+    buf.update_item(4, view(u"four"))
+    assert buf.items[buf.index(4)] == view(u"four")
+    buf.remove_item(0)
+    buf.remove_item(7)
+    assert not buf.has_key(7)
+    with pytest.raises(ValueError):
+        buf.index(7)
+    with pytest.raises(ListBufferError):
+        buf.remove_item(7)
+    with pytest.raises(ListBufferError):
+        buf.update_item(7, view(u"seven"))
+    # indices shifted after the removals
+    assert buf.index(8) == 6
+    assert buf.index(1) == 0
+
+def test_clean_item():
+    buf = ListBuffer("test")
+    buf.insert_sorted(1, [(0, u"a\nb\tc")])
+    assert buf.items[0] == [(0, u"a b c")]
+
+def test_append_out_of_order():
+    buf = ListBuffer("test")
+    for key in (u"b", u"c", u"a"):
+        buf.append(key, view(key))
+    assert buf.get_keys() == [u"b", u"c", u"a"]
+    assert buf.index(u"a") == 2
+    # insertion into an unsorted buffer still goes before the first
+    # greater key
+    buf.insert_sorted(u"bb", view(u"bb"))
+    assert buf.get_keys() == [u"b", u"bb", u"c", u"a"]
+    assert buf.index(u"a") == 3
+    assert buf.index(u"c") == 2
+
+def test_load_items():
+    buf = ListBuffer("test")
+    buf.insert_sorted(100, view(u"old"))
+    buf.load_items([(3, view(u"3")), (1, view(u"1")), (2, view(u"2"))])
+    check_index(buf, {1: view(u"1"), 2: view(u"2"), 3: view(u"3")})
+    assert not buf.has_key(100)
+    with pytest.raises(ListBufferError):
+        buf.load_items([(1, view(u"1")), (1, view(u"again"))])
+
+def test_random_operations():
+    rand = random.Random(3)
+    buf = ListBuffer("test")
+    expected = {}
+    for n in range(3000):
+        key = (rand.choice([None, 1, 2, u"a"]),
+                        rand.choice([None, u"j{0}".format(rand.randint(0, 30))]))
+        item = view(u"v{0}".format(n))
+        operation = rand.random()
+        if operation < 0.5:
+            if buf.has_key(key):
+                buf.update_item(key, item)
+            else:
+                buf.insert_sorted(key, item)
+            expected[key] = item
+        elif operation < 0.8:
+            if key in expected:
+                buf.remove_item(key)
+                del expected[key]
+            else:
+                with pytest.raises(ListBufferError):
+                    buf.remove_item(key)
+        elif operation < 0.81:
+            items = dict(((rand.choice([None, 1]), u"z{0}".format(i)),
+                                    view(u"q")) for i in range(rand.randint(0, 20)))
+            buf.load_items(items.items())
+            expected = items
+        check_index(buf, expected)
@@ -0,0 +1,220 @@
+# Console Jabber Client
+# Copyright (C) 2004-2010 Jacek Konieczny
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""Roster cache and roster versioning (XEP-0237)."""
+
+import cPickle
+
+import pytest
+
+pytest.importorskip("pyxmpp")
+
+import pyxmpp
+import pyxmpp.roster
+
+from cjc import cjc_globals
+import roster
+from roster import ROSTER_NS, ROSTERVER_NS
+
+class FakeThemeManager(object):
+    def set_default_attrs(self, attrs):
+        pass
+
+    def set_default_formats(self, formats):
+        pass
+
+    def format_string(self, format, params):
+        return [(0, u"{0} {1!r}".format(format, sorted(params.items())))]
+
+    def substitute(self, format, params):
+        return format % params
+
+class FakeApp(object):
+    def __init__(self):
+        self.jid = pyxmpp.JID(u"me@example.org/cjc")
+        self.settings = {"jid": self.jid}
+        self.roster = None
+        self.stream = None
+        self.roster_updates = []
+
+    def add_info_handler(self, var, handler):
+        pass
+
+    def add_event_handler(self, event, handler):
+        pass
+
+    def get_user_info(self, jid, var = None):
+        return None
+
+    def set_user_info(self, jid, var, value):
+        pass
+
+    set_bare_user_info = set_user_info
+
+    def roster_updated(self, item = None):
+        self.roster_updates.append(item)
+
+class FakeStream(object):
+    """Records the stanzas sent and the handlers set."""
+    def __init__(self, rosterver = True):
+        self.sent = []
+        self.response_handlers = None
+        if rosterver:
+            iq = pyxmpp.Iq(stanza_type = "get")
+            features = iq.xmlnode.newChild(None, "features", None)
+            ver = features.newChild(None, "ver", None)
+            ver.setNs(ver.newNs(ROSTERVER_NS, None))
+            self.features = features
+        else:
+            self.features = None
+
+    def set_response_handlers(self, iq, result, error):
+        self.response_handlers = (result, error)
+
+    def set_iq_set_handler(self, element, namespace, handler):
+        pass
+
+    def send(self, stanza):
+        self.sent.append(stanza)
+
+@pytest.fixture
+def plugin(monkeypatch, tmpdir):
+    monkeypatch.setattr(cjc_globals, "theme_manager", FakeThemeManager())
+    app = FakeApp()
+    plugin = roster.Plugin(app, "roster")
+    plugin.settings["cache_file"] = str(tmpdir.join("%(jid)s.roster"))
+    return plugin
+
+def roster_query(iq, items, ver = None):
+    """Add a roster query with `items` ((jid, name, groups) tuples) to
+    `iq`."""
+    query = iq.new_query(ROSTER_NS)
+    if ver is not None:
+        query.setProp("ver", ver)
+    for jid, name, groups in items:
+        item = query.newChild(query.ns(), "item", None)
+        item.setProp("jid", jid)
+        item.setProp("name", name)
+        item.setProp("subscription", "both")
+        for group in groups:
+            item.newChild(query.ns(), "group", group)
+    return query
+
+def make_roster(items):
+    iq = pyxmpp.Iq(stanza_type = "result")
+    return pyxmpp.roster.Roster(roster_query(iq, items))
+
+def roster_content(roster):
+    return sorted((item.jid.as_unicode(), item.name, sorted(item.groups))
+                                            for item in roster.get_items())
+
+ITEMS = [("a@example.org", "A", ["friends"]),
+            ("b@example.org", "B", ["friends", "work"]),
+            ("c@example.org", "C", [])]
+
+def test_cache_round_trip(plugin):
+    plugin.cjc.roster = make_roster(ITEMS)
+    plugin.roster_ver = u"v1"
+    plugin.save_cache()
+    loaded = roster.Plugin(FakeApp(), "roster")
+    loaded.settings["cache_file"] = plugin.settings["cache_file"]
+    loaded.load_cache()
+    assert roster_content(loaded.cjc.roster) == roster_content(
+                                                        plugin.cjc.roster)
+    assert loaded.roster_ver == u"v1"
+    assert loaded.buffer.has_key((u"friends", None))
+
+def test_load_xml_cache(plugin):
+    with open(plugin.cache_filename, "w") as cache_file:
+        cache_file.write("<query xmlns='jabber:iq:roster'>"
+                "<item jid='a@example.org' name='A' subscription='both'>"
+                "<group>friends</group></item></query>")
+    plugin.load_cache()
+    assert roster_content(plugin.cjc.roster) == [
+                                        (u"a@example.org", u"A", [u"friends"])]
+    assert plugin.roster_ver is None
+
+def test_cache_format_mismatch(plugin):
+    with open(plugin.cache_filename, "wb") as cache_file:
+        cPickle.dump({"format": roster.CACHE_FORMAT + 1, "ver": u"v1",
+                "items": [(u"a@example.org", u"A", "both", None, [])]},
+                cache_file)
+    plugin.load_cache()
+    assert plugin.cjc.roster is None
+    assert plugin.roster_ver is None
+
+def test_request_roster_versions(plugin):
+    stream = FakeStream()
+    plugin.request_roster(stream)
+    # no cached roster: empty version to start versioning
+    assert stream.sent[-1].get_query().prop("ver") == ""
+    plugin.cjc.roster = make_roster(ITEMS)
+    plugin.roster_ver = u"v1"
+    plugin.request_roster(stream)
+    assert stream.sent[-1].get_query().prop("ver") == "v1"
+    stream = FakeStream(rosterver = False)
+    plugin.request_roster(stream)
+    assert stream.sent[-1].get_query().prop("ver") is None
+
+def test_versioned_request_error(plugin):
+    stream = FakeStream()
+    plugin.cjc.stream = stream
+    plugin.cjc.roster = make_roster(ITEMS)
+    plugin.roster_ver = u"v1"
+    plugin.request_roster(stream)
+    error_handler = stream.response_handlers[1]
+    error_handler(stream.sent[-1].make_error_response("bad-request"))
+    assert plugin.roster_ver is None
+    assert len(stream.sent) == 2
+    assert stream.sent[-1].get_query().prop("ver") is None
+
+def test_empty_result_keeps_cache(plugin):
+    cached = make_roster(ITEMS)
+    plugin.cjc.roster = cached
+    plugin.roster_ver = u"v1"
+    plugin.roster_result(pyxmpp.Iq(stanza_type = "result"))
+    assert plugin.cjc.roster is cached
+    assert plugin.roster_ver == u"v1"
+    assert plugin.cjc.roster_updates == [None]
+
+def test_full_result_replaces_cache(plugin):
+    plugin.cjc.roster = make_roster(ITEMS)
+    plugin.roster_ver = u"v1"
+    iq = pyxmpp.Iq(stanza_type = "result")
+    roster_query(iq, [("d@example.org", "D", ["new"])], "v2")
+    plugin.roster_result(iq)
+    assert roster_content(plugin.cjc.roster) == [
+                                            (u"d@example.org", u"D", [u"new"])]
+    assert plugin.roster_ver == u"v2"
+
+def test_push_updates_version(plugin):
+    stream = FakeStream()
+    plugin.cjc.stream = stream
+    plugin.cjc.roster = make_roster(ITEMS)
+    plugin.roster_ver = u"v1"
+    iq = pyxmpp.Iq(stanza_type = "set")
+    roster_query(iq, [("a@example.org", "Renamed", ["friends"])], "v2")
+    plugin.roster_push(iq)
+    assert plugin.roster_ver == u"v2"
+    assert plugin.cjc.roster.get_item_by_jid(
+                            pyxmpp.JID(u"a@example.org")).name == u"Renamed"
+    assert stream.sent[-1].get_type() == "result"
+    # pushes without a version keep the last one
+    iq = pyxmpp.Iq(stanza_type = "set")
+    roster_query(iq, [("c@example.org", "C", ["work"])])
+    plugin.roster_push(iq)
+    assert plugin.roster_ver == u"v2"
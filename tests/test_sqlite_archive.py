@@ -0,0 +1,447 @@
+# Console Jabber Client
+# Copyright (C) 2004-2010 Jacek Konieczny
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+
+"""SQLite archive plugin tests."""
+
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("pyxmpp")
+
+from pyxmpp.jid import JID
+
+from cjc import cjc_globals
+
+import sqlite_archive
+from sqlite_archive import SqliteArchive, SqliteArchiveId, to_epoch
+from sqlite_archive import ArchiveSearch
+
+BASE = datetime(2020, 1, 1, 12, 0, 0)
+
+def open_archive(filename, **settings):
+    archive = SqliteArchive()
+    archive.settings["filename"] = filename
+    archive.settings.update(settings)
+    assert archive._open_database() is not None
+    return archive
+
+@pytest.fixture
+def archive(tmpdir):
+    archive = open_archive(str(tmpdir.join("archive.db")),
+                                                        durability = "full")
+    yield archive
+    archive._stop_writer()
+    archive._close_database()
+
+def create_old_database(filename, rows):
+    """Create database with the original schema.
+
+    `rows` are (event_type, peer, timestamp, body, thread) tuples."""
+    database = sqlite3.connect(filename)
+    for command in sqlite_archive.SCHEMA:
+        database.execute(command)
+    for event_type, peer, timestamp, body, thread in rows:
+        database.execute("INSERT INTO archive(event_type, peer,"
+                    " peer_resource, direction, timestamp, subject, body,"
+                    " thread) VALUES(?, ?, NULL, 'in', ?, NULL, ?, ?)",
+                    (event_type, peer, timestamp, body, thread))
+    database.commit()
+    database.close()
+
+def page_through(archive, peer, reverse, page_size = 3, **kwargs):
+    """Return bodies of all the records read `page_size` at once."""
+    if reverse:
+        order = archive.REVERSE_CHRONOLOGICAL
+        position = "older_than"
+    else:
+        order = archive.CHRONOLOGICAL
+        position = "newer_than"
+    result = []
+    cursor = None
+    while True:
+        kwargs[position] = cursor
+        page = list(archive.get_records("chat", peer, limit = page_size,
+                                                    order = order, **kwargs))
+        if not page:
+            return result
+        assert len(page) <= page_size
+        result += [record.body for archive_id, record in page]
+        cursor = page[-1][0]
+
+def test_new_database_schema(archive):
+    database = archive._database
+    version = database.execute("PRAGMA user_version").fetchone()[0]
+    assert version == len(sqlite_archive.MIGRATIONS)
+    columns = [row[1] for row
+                    in database.execute("PRAGMA table_info(archive)")]
+    assert "peer_id" in columns
+    assert "peer" not in columns
+
+def test_log_and_read(archive):
+    peer = JID(u"peer@example.org/res")
+    archive.log_event("chat", peer, "in", BASE, None, u"hello", None)
+    archive.log_event("chat", peer, "out", BASE + timedelta(seconds = 1),
+                                            None, u"bye", u"thread1")
+    archive.log_event("chat", JID(u"other@example.org"), "in", BASE, None,
+                                                            u"other", None)
+    records = list(archive.get_records("chat", JID(u"peer@example.org"),
+                                        order = archive.CHRONOLOGICAL))
+    assert [record.body for archive_id, record in records] == [u"hello",
+                                                                    u"bye"]
+    archive_id, record = records[0]
+    assert isinstance(archive_id, SqliteArchiveId)
+    assert record.peer == peer
+    assert record.direction == "in"
+    assert record.timestamp == BASE
+    assert record.thread is None
+    assert records[1][1].thread == u"thread1"
+    # one row per bare JID
+    assert archive._database.execute("SELECT count(*) FROM peers"
+                                                    ).fetchone()[0] == 2
+    assert list(archive.get_records("chat", JID(u"nobody@example.org"))) == []
+
+def test_unsupported_events_ignored(archive):
+    archive.log_event("presence", JID(u"peer@example.org"), "in")
+    archive.log_event("chat", JID(u"peer@example.org"), "sideways")
+    assert list(archive.get_records()) == []
+
+def test_keyset_paging(archive):
+    peer = JID(u"peer@example.org")
+    bodies = []
+    for i in range(20):
+        # several records share a timestamp
+        timestamp = BASE + timedelta(seconds = i // 4)
+        body = u"m{0}".format(i)
+        archive.log_event("chat", peer, "in", timestamp, None, body, None)
+        bodies.append(body)
+    archive.log_event("message", peer, "in", BASE, None, u"other type", None)
+    assert page_through(archive, peer, False) == bodies
+    assert page_through(archive, peer, True) == bodies[::-1]
+    assert page_through(archive, peer, True,
+            newer_than = BASE + timedelta(seconds = 2)) == bodies[12:][::-1]
+    records = list(archive.get_records("chat", peer,
+                                        order = archive.CHRONOLOGICAL))
+    # plain record ids are accepted as positions too
+    record_id = records[10][0].record_id
+    older = list(archive.get_records("chat", peer, older_than = record_id,
+                        limit = 3, order = archive.REVERSE_CHRONOLOGICAL))
+    assert [record.body for archive_id, record in older] == [u"m9", u"m8",
+                                                                    u"m7"]
+    newer = list(archive.get_records("chat", peer,
+                    newer_than = BASE + timedelta(seconds = 3),
+                    order = archive.CHRONOLOGICAL))
+    assert [record.body for archive_id, record in newer] == bodies[16:]
+
+def test_paging_uses_index(archive):
+    plan = archive._database.execute("EXPLAIN QUERY PLAN SELECT record_id"
+            " FROM archive WHERE peer_id = 1 AND event_type = 'chat'"
+            " AND timestamp <= 0 AND (timestamp < 0 OR record_id < 5)"
+            " ORDER BY timestamp DESC, record_id DESC LIMIT 5").fetchall()
+    plan = u" ".join(row[-1] for row in plan)
+    assert "archive_peer_type_timestamp_i" in plan
+    assert "TEMP B-TREE" not in plan
+
+def test_migrate_old_database(tmpdir):
+    filename = str(tmpdir.join("old.db"))
+    rows = [
+        ("chat", u"a@example.org", BASE, u"first", "None"),
+        ("chat", u"b@example.org", BASE + timedelta(seconds = 1),
+                                                        u"second", u"t1"),
+        ("chat", u"a@example.org", "garbage", u"bad timestamp", "None"),
+        ("chat", u"a@example.org", None, u"no timestamp", "None"),
+        ("chat", u"a@example.org", BASE + timedelta(seconds = 5,
+                            microseconds = 250000), u"fraction", "None"),
+        ]
+    create_old_database(filename, rows)
+    archive = open_archive(filename, durability = "full")
+    try:
+        database = archive._database
+        assert (database.execute("PRAGMA user_version").fetchone()[0]
+                                        == len(sqlite_archive.MIGRATIONS))
+        assert tuple(database.execute("SELECT count(*), count(thread),"
+                " count(timestamp) FROM archive").fetchone()) == (5, 1, 5)
+        records = list(archive.get_records("chat", JID(u"a@example.org"),
+                                        order = archive.CHRONOLOGICAL))
+        result = [(record.body, record.timestamp, record.thread)
+                                        for archive_id, record in records]
+        # records without a valid timestamp get the previous one
+        assert result == [
+                (u"first", BASE, None),
+                (u"bad timestamp", BASE + timedelta(seconds = 1), None),
+                (u"no timestamp", BASE + timedelta(seconds = 1), None),
+                (u"fraction", BASE + timedelta(seconds = 5), None),
+                ]
+        assert (page_through(archive, JID(u"a@example.org"), True, 1)
+                            == [body for body, ts, thread in result][::-1])
+        # new records continue the record id sequence
+        archive.log_event("chat", JID(u"b@example.org"), "in", None, None,
+                                                                u"new", None)
+        newest = list(archive.get_records(None, None, limit = 1,
+                                    order = archive.REVERSE_CHRONOLOGICAL))
+        assert newest[0][0].record_id == len(rows) + 1
+        assert newest[0][1].body == u"new"
+    finally:
+        archive._close_database()
+
+def test_migrate_keeps_fulltext_index(tmpdir):
+    filename = str(tmpdir.join("v2.db"))
+    create_old_database(filename, [
+            ("chat", u"a@example.org", BASE, u"quick brown fox", "None")])
+    database = sqlite3.connect(filename)
+    for command in sqlite_archive.MIGRATIONS[0]:
+        database.execute(command)
+    sqlite_archive.MIGRATIONS[1](database)
+    database.execute("PRAGMA user_version = 2")
+    database.commit()
+    database.close()
+    archive = open_archive(filename, durability = "full")
+    try:
+        if archive._fulltext_version() is None:
+            pytest.skip("SQLite full-text search not available")
+        archive.log_event("chat", JID(u"b@example.org"), "in", None, None,
+                                                        u"lazy fox", None)
+        result = [(record.peer, record.body)
+                    for archive_id, record, snippet in archive.search(u"fox")]
+        assert sorted(result) == [(JID(u"a@example.org"), u"quick brown fox"),
+                                    (JID(u"b@example.org"), u"lazy fox")]
+        result = [record.body for archive_id, record, snippet
+                        in archive.search(u"fox", peer = JID(u"b@example.org"))]
+        assert result == [u"lazy fox"]
+    finally:
+        archive._close_database()
+
+def test_batch_writer(tmpdir):
+    archive = open_archive(str(tmpdir.join("archive.db")),
+                            durability = "batch", commit_interval = 10.0)
+    try:
+        peer = JID(u"peer@example.org")
+        for i in range(50):
+            archive.log_event("chat", peer, "in", BASE, None,
+                                                    u"m{0}".format(i), None)
+        # a record which cannot be written
+        archive.log_event("chat", None, "in", BASE, None, u"bad", None)
+        archive.log_event("chat", peer, "in", BASE, None, u"last", None)
+        # reading waits for the queued records
+        records = list(archive.get_records("chat", peer,
+                                            order = archive.CHRONOLOGICAL))
+        assert len(records) == 51
+        assert records[-1][1].body == u"last"
+    finally:
+        archive._stop_writer()
+        archive._close_database()
+
+def count_committed(filename):
+    """Count the records visible to another database connection."""
+    database = sqlite3.connect(filename)
+    try:
+        return database.execute("SELECT count(*) FROM archive").fetchone()[0]
+    finally:
+        database.close()
+
+def test_writer_stop_commits_queued(tmpdir):
+    filename = str(tmpdir.join("archive.db"))
+    archive = open_archive(filename, durability = "batch",
+                                                    commit_interval = 10.0)
+    try:
+        for i in range(10):
+            archive.log_event("chat", JID(u"peer@example.org"), "in", BASE,
+                                            None, u"m{0}".format(i), None)
+        writer = archive._writer
+        archive._stop_writer()
+        assert not writer.isAlive()
+        assert archive._writer is None
+        assert count_committed(filename) == 10
+    finally:
+        archive._close_database()
+
+def test_full_durability(tmpdir):
+    filename = str(tmpdir.join("archive.db"))
+    archive = open_archive(filename, durability = "batch",
+                                                    commit_interval = 10.0)
+    try:
+        peer = JID(u"peer@example.org")
+        archive.log_event("chat", peer, "in", BASE, None, u"queued", None)
+        assert archive._writer is not None
+        # switching to 'full' writes the queued records first
+        archive.settings["durability"] = "full"
+        archive.log_event("chat", peer, "in", BASE, None, u"direct", None)
+        assert archive._writer is None
+        assert count_committed(filename) == 2
+        archive.log_event("chat", peer, "in", BASE, None, u"next", None)
+        assert archive._writer is None
+        assert count_committed(filename) == 3
+    finally:
+        archive._close_database()
+
+def test_wal_and_pragmas(tmpdir):
+    archive = open_archive(str(tmpdir.join("archive.db")),
+                            synchronous = "full", cache_size = 1024,
+                            mmap_size = 0)
+    try:
+        database = archive._database
+        pragma = lambda name: database.execute("PRAGMA " + name).fetchone()[0]
+        assert pragma("journal_mode").lower() == "wal"
+        assert pragma("synchronous") == 2
+        assert pragma("cache_size") == -1024
+        archive.settings["synchronous"] = "bogus"
+        archive._set_pragmas(database)
+        assert pragma("synchronous") == 1
+    finally:
+        archive._close_database()
+
+def test_reads_flush_only_when_needed(tmpdir):
+    archive = open_archive(str(tmpdir.join("archive.db")),
+                            durability = "batch", commit_interval = 10.0)
+    try:
+        peer = JID(u"peer@example.org")
+        archive.log_event("chat", peer, "in", BASE, None, u"first", None)
+        records = list(archive.get_records("chat", peer))
+        writer = archive._writer
+        assert writer.pending() == 0
+        # nothing queued: no flush request for the writer
+        list(archive.get_records("chat", peer))
+        assert writer.queue.empty()
+        archive.log_event("chat", peer, "in", BASE + timedelta(seconds = 1),
+                                                    None, u"second", None)
+        # older pages are read without waiting for the queued records
+        older = list(archive.get_records("chat", peer,
+                                                older_than = records[0][0]))
+        assert older == []
+        assert writer.pending() == 1
+        records = list(archive.get_records("chat", peer))
+        assert writer.pending() == 0
+        assert [record.body for archive_id, record in records] == [u"first",
+                                                                u"second"]
+        writer.maintenance()
+    finally:
+        archive._stop_writer()
+        archive._close_database()
+
+@pytest.fixture
+def search_archive(archive):
+    if archive._fulltext_version() is None:
+        pytest.skip("SQLite full-text search not available")
+    return archive
+
+def test_search_filters(search_archive):
+    archive = search_archive
+    alice = JID(u"alice@example.org/home")
+    bob = JID(u"bob@example.org")
+    archive.log_event("chat", alice, "in", BASE, None, u"red fox", None)
+    archive.log_event("muc", bob, "in", BASE + timedelta(days = 1), None,
+                                                        u"grey fox", None)
+    archive.log_event("chat", bob, "out", BASE + timedelta(days = 2),
+                                            u"fox subject", u"hello", None)
+    archive.log_event("chat", bob, "in", BASE, None, u"dog", None)
+    def bodies(**kwargs):
+        return sorted(record.body for archive_id, record, snippet
+                                    in archive.search(u"fox", **kwargs))
+    assert bodies() == [u"grey fox", u"hello", u"red fox"]
+    assert bodies(event_type = "chat") == [u"hello", u"red fox"]
+    assert bodies(peer = JID(u"alice@example.org")) == [u"red fox"]
+    assert bodies(peer = JID(u"nobody@example.org")) == []
+    assert bodies(since = BASE + timedelta(days = 1)) == [u"grey fox",
+                                                                u"hello"]
+    assert bodies(until = BASE + timedelta(days = 1)) == [u"red fox"]
+    assert len(list(archive.search(u"fox", limit = 2))) == 2
+    assert len(list(archive.search(u"fox", limit = 2, offset = 2))) == 1
+    hits = list(archive.search(u"red", peer = JID(u"alice@example.org")))
+    archive_id, record, snippet = hits[0]
+    assert record.peer == alice
+    assert u"*red*" in snippet
+    with pytest.raises(sqlite3.Error):
+        list(archive.search(u'"unterminated'))
+
+class FakeSearchBuffer(object):
+    def __init__(self, info, command_table = None):
+        self.lines = []
+        self.question = None
+        self.closed = False
+    def append_themed_many(self, lines):
+        self.lines += lines
+    def append_themed(self, format, params):
+        self.lines.append((format, params))
+    def ask_question(self, question, type, default, handler, values = None):
+        self.question = (question, handler, values)
+    def update(self):
+        pass
+    def close(self):
+        self.closed = True
+
+class FakeScreen(object):
+    def display_buffer(self, buf):
+        pass
+
+def test_search_show_page(search_archive, monkeypatch):
+    archive = search_archive
+    monkeypatch.setattr(sqlite_archive.ui, "TextBuffer", FakeSearchBuffer)
+    monkeypatch.setattr(cjc_globals, "screen", FakeScreen(), raising = False)
+    archive.settings["search_page_size"] = 2
+    peer = JID(u"peer@example.org")
+    for i in range(5):
+        archive.log_event("chat", peer, "in", BASE + timedelta(seconds = i),
+                                    None, u"fox number {0}".format(i), None)
+    search = ArchiveSearch(archive, u"fox")
+    buf = search.buffer
+    search.show_page()
+    assert len(buf.lines) == 2
+    question, handler, values = buf.question
+    assert values == ["m", "c"]
+    handler("m")
+    assert len(buf.lines) == 4
+    handler("m")
+    assert [format for format, params in buf.lines] == (
+                        ["archive.search_hit"] * 5 + ["archive.search_end"])
+    snippets = set(params["snippet"] for format, params in buf.lines[:5])
+    assert len(snippets) == 5
+    question, handler, values = buf.question
+    assert values == ["c"]
+    assert not buf.closed
+    handler("c")
+    assert buf.closed
+
+def test_search_show_page_error(search_archive, monkeypatch):
+    monkeypatch.setattr(sqlite_archive.ui, "TextBuffer", FakeSearchBuffer)
+    monkeypatch.setattr(cjc_globals, "screen", FakeScreen(), raising = False)
+    search = ArchiveSearch(search_archive, u'"unterminated')
+    search.show_page()
+    assert search.buffer.lines[0][0] == "error"
+    assert search.buffer.question[2] == ["c"]
+
+def test_to_epoch():
+    # whole seconds, local time
+    timestamp = BASE + timedelta(microseconds = 750000)
+    assert to_epoch(timestamp) == to_epoch(BASE)
+    # every day of a year (including the DST changes, if any), at noon,
+    # so the local time always exists
+    for days in range(366):
+        timestamp = BASE + timedelta(days = days, minutes = 7, seconds = 3)
+        epoch = to_epoch(timestamp)
+        assert isinstance(epoch, (int, long))
+        assert datetime.fromtimestamp(epoch) == timestamp
+        assert to_epoch(timestamp + timedelta(seconds = 1)) == epoch + 1
+
+def test_iso_to_epoch():
+    iso_to_epoch = sqlite_archive._iso_to_epoch
+    assert iso_to_epoch(u"2020-01-01 12:00:00") == to_epoch(BASE)
+    assert iso_to_epoch(u"2020-01-01 12:00:00.999999") == to_epoch(BASE)
+    assert iso_to_epoch(u"2020-01-01") == to_epoch(datetime(2020, 1, 1))
+    for value in (None, u"", u"garbage", u"2020-13-01 00:00:00",
+                                                        u"12:00:00"):
+        assert iso_to_epoch(value) is None
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Console Jabber Client
+# Copyright (C) 2004-2010 Jacek Konieczny
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""Compiled theme formats compared with the output of the formatter
+which interpreted the format strings on every call."""
+
+import curses
+import datetime
+
+import pytest
+
+pytest.importorskip("pyxmpp")
+
+from cjc import themes
+
+TIMESTAMP = datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+PARAMS = [
+    dict(active = u"*", locked = u"", buffer_num = 3, msg = u"hello",
+        key = u"k", function = u"f", issuer = None, not_after = u"na",
+        role = u"moderator", nick = u"nickname", affiliation = u"owner",
+        show = None, status = u"st", index = 5, color = u"bar",
+        ts = TIMESTAMP, lst = [(5, u"L1"), (6, u"L2")]),
+    dict(active = u"", locked = u"!", buffer_num = 12, msg = u"",
+        key = u"kkkkkkkkkkkkkkk", function = u"", issuer = u"iss",
+        not_after = u"", role = u"visitor", nick = u"", affiliation = u"none",
+        show = u"away", status = None, index = 0, color = u"nosuch",
+        ts = TIMESTAMP, lst = []),
+    # missing parameters: the format is returned verbatim
+    dict(role = u"participant", affiliation = u"member", ts = TIMESTAMP,
+        nick = u"ab", index = 42),
+    ]
+
+# (format, PARAMS index, output of the old formatter)
+CASES = [
+    (u'%[bar] %(active)s%(locked)s %(buffer_num)s: %{@sub}', 0,
+        [(2, u' * 3: '), (2, u'SUB[hello]')]),
+    (u'%[bar] %(active)s%(locked)s %(buffer_num)s: %{@sub}', 1,
+        [(2, u' ! 12: '), (2, u'SUB[]')]),
+    (u'%[bar] %(active)s%(locked)s %(buffer_num)s: %{@sub}', 2,
+        [(2, u' %(active)s%(locked)s %(buffer_num)s: '), (2, u'SUB[%(msg)s]')]),
+    (u'%[error][%(T:ts:%Y-%m-%d %H:%M)s] %(msg)s\n', 0,
+        [(3, u'[2020-01-02 03:04] hello\n')]),
+    (u'%[error][%(T:ts:%Y-%m-%d %H:%M)s] %(msg)s\n', 1,
+        [(3, u'[2020-01-02 03:04] \n')]),
+    (u'%[error][%(T:ts:%Y-%m-%d %H:%M)s] %(msg)s\n', 2,
+        [(3, u'[2020-01-02 03:04] %(msg)s\n')]),
+    (u'%[default]%(buffer_num)i', 0,
+        [(1, u'3')]),
+    (u'%[default]%(buffer_num)i', 1,
+        [(1, u'12')]),
+    (u'%[default]%(buffer_num)i', 2,
+        [(1, u'%(buffer_num)i')]),
+    (u'%[info]  %(key)-10s %(function)-8s|\n', 0,
+        [(4, u'  k          f       |\n')]),
+    (u'%[info]  %(key)-10s %(function)-8s|\n', 1,
+        [(4, u'  kkkkkkkkkkkkkkk         |\n')]),
+    (u'%[info]  %(key)-10s %(function)-8s|\n', 2,
+        [(4, u'  %(key)-10s %(function)-8s|\n')]),
+    (u'%(issuer?  Issuer\\: %(issuer)s\n)s  Valid: %(not_after)s\n', 0,
+        [(1, u'  Valid: na\n')]),
+    (u'%(issuer?  Issuer\\: %(issuer)s\n)s  Valid: %(not_after)s\n', 1,
+        [(1, u'  Issuer: iss\n  Valid: \n')]),
+    (u'%(issuer?  Issuer\\: %(issuer)s\n)s  Valid: %(not_after)s\n', 2,
+        [(1, u'%(issuer?  Issuer\\: %(issuer)s\n)s  Valid: %(not_after)s\n')]),
+    (u'%(role?moderator:@,visitor:-,)s%(nick)s', 0,
+        [(1, u'@nickname')]),
+    (u'%(role?moderator:@,visitor:-,)s%(nick)s', 1,
+        [(1, u'-')]),
+    (u'%(role?moderator:@,visitor:-,)s%(nick)s', 2,
+        [(1, u'ab')]),
+    (u'%(affiliation?none:, (%(affiliation)s))s%(role?participant:, (%(role)s))s', 0,
+        [(1, u' (owner) (moderator)')]),
+    (u'%(affiliation?none:, (%(affiliation)s))s%(role?participant:, (%(role)s))s', 1,
+        [(1, u' (visitor)')]),
+    (u'%(affiliation?none:, (%(affiliation)s))s%(role?participant:, (%(role)s))s', 2,
+        [(1, u' (member)')]),
+    (u'[%(show?%(show)s,online)s]%(status? %(status)s)s\n', 0,
+        [(1, u'[online] st\n')]),
+    (u'[%(show?%(show)s,online)s]%(status? %(status)s)s\n', 1,
+        [(1, u'[away]\n')]),
+    (u'[%(show?%(show)s,online)s]%(status? %(status)s)s\n', 2,
+        [(1, u'[%(show?%(show)s,online)s]%(status? %(status)s)s\n')]),
+    (u'100%% %(undefined)s %(nick)5.3s|%(index)05d', 0,
+        [(1, u'100% %(undefined)s   nic|00005')]),
+    (u'100%% %(undefined)s %(nick)5.3s|%(index)05d', 1,
+        [(1, u'100% %(undefined)s      |00000')]),
+    (u'100%% %(undefined)s %(nick)5.3s|%(index)05d', 2,
+        [(1, u'100% %(undefined)s    ab|00042')]),
+    (u'%[%(color)s]colored%[] plain', 0,
+        [(2, u'colored'), (1, u' plain')]),
+    (u'%[%(color)s]colored%[] plain', 1,
+        [(1, u'colored'), (1, u' plain')]),
+    (u'%[%(color)s]colored%[] plain', 2,
+        [(1, u'colored'), (1, u' plain')]),
+    (u'%[info]* %(msg)s\n%{lst}', 0,
+        [(4, u'* hello\n'), (5, u'L1'), (6, u'L2')]),
+    (u'%[info]* %(msg)s\n%{lst}', 1,
+        [(4, u'* \n')]),
+    (u'%[info]* %(msg)s\n%{lst}', 2,
+        [(4, u'* %(msg)s\n%{lst}')]),
+    ]
+
+@pytest.fixture
+def theme_manager(monkeypatch):
+    # no curses screen in the tests
+    monkeypatch.delattr(curses, "use_default_colors", raising = False)
+    manager = themes.ThemeManager(None)
+    manager.attrs = {"default": 1, "bar": 2, "error": 3, "info": 4}
+    manager.set_format("sub", u"SUB[%(msg)s]")
+    return manager
+
+@pytest.mark.parametrize(("format", "params", "expected"), CASES)
+def test_do_format_string(theme_manager, format, params, expected):
+    result = theme_manager.do_format_string(format, "default",
+                                                        PARAMS[params])
+    assert result == expected
+    # the second call uses the cached template
+    assert theme_manager.do_format_string(format, "default",
+                                                PARAMS[params]) == expected
+
+@pytest.mark.parametrize(("format", "params", "expected"), CASES)
+def test_format_string(theme_manager, format, params, expected):
+    theme_manager.set_format("test", format)
+    assert theme_manager.format_string("test", PARAMS[params]) == expected
+
+def test_params_not_modified(theme_manager):
+    params = dict(PARAMS[0])
+    theme_manager.do_format_string(u"%(msg)s %{@sub}", "default", params)
+    assert params == PARAMS[0]
+
+def test_string_params(theme_manager):
+    assert (theme_manager.do_format_string(u"%[info]<%(msg)s>", "default",
+                                        u"text") == [(4, u"<text>")])
+
+def test_substitute(theme_manager):
+    assert (theme_manager.substitute(u"%(a)s/%(b?yes,no)s/%(c?yes,no)s",
+                        {"a": u"x", "b": 1, "c": 0}) == u"x/yes/no")